@@ -0,0 +1,136 @@
+"""Persistent cache of partial charges shared across runs.
+
+Assigning AM1BCC charges is one of the most expensive parts of building each
+system, and every benchmark run repeats it for the same molecules, as does the
+ChargeCheckFilter in ``datasets/download_and_filter_dataset.py``. The charges
+computed by any of these are stored in an sqlite database in the store cache
+directory, keyed by the molecule's mapped SMILES, the charge method, and the
+toolkits (and their versions) asked to compute them, so that later runs only
+need to look them up. Because of the method key, the AM1BCC-ELF10 charges
+stored by the ChargeCheckFilter are only reused by later runs of the filter,
+not by benchmarks, whose force fields request AM1BCC charges.
+
+``install_charge_cache`` hooks ``Molecule.assign_partial_charges`` to consult
+the cache, in the same way as ``timings.counting_iterations``, since the
+charges are assigned deep inside yammbs and Interchange. Only calls that let
+the toolkit generate its own conformers are cached, because charges computed
+from user-supplied conformers depend on their coordinates. Failed charge
+calculations are not cached, since they may be caused by transient problems
+like an unavailable license, and are attempted again by later runs.
+
+The database uses sqlite's default rollback journal rather than WAL, which
+needs shared memory that network file systems like the NFS home directories
+of cluster nodes don't provide. Delete the database to start over.
+"""
+
+import inspect
+import os
+import sqlite3
+from pathlib import Path
+
+import numpy
+
+from store_cache import DEFAULT_CACHE_DIR
+
+CACHE_FILE = "charges.sqlite"
+
+# open connections in this process, by path
+_connections = dict()
+
+
+def cache_path(cache_dir=None) -> Path:
+    """Return the path of the charge cache database in ``cache_dir``."""
+    return Path(cache_dir or DEFAULT_CACHE_DIR) / CACHE_FILE
+
+
+def _connect(cache_dir=None) -> sqlite3.Connection:
+    # connections can't be shared with forked children, so key them by PID too
+    key = (os.getpid(), cache_path(cache_dir))
+    if key not in _connections:
+        path = key[1]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=60)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS toolkit_charges ("
+            "smiles TEXT, method TEXT, toolkit TEXT, charges BLOB, "
+            "PRIMARY KEY (smiles, method, toolkit))"
+        )
+        conn.commit()
+        _connections[key] = conn
+    return _connections[key]
+
+
+def toolkit_key(registry) -> str:
+    """Return the names and versions of the toolkits in the ``ToolkitRegistry``
+    or ``ToolkitWrapper`` ``registry``, to key the charges it computes by."""
+    toolkits = getattr(registry, "registered_toolkits", [registry])
+    return ",".join(f"{type(t).__name__}-{t.toolkit_version}" for t in toolkits)
+
+
+def lookup(smiles, method, toolkit, cache_dir=None) -> numpy.ndarray | None:
+    """Return the charges for the mapped SMILES ``smiles`` computed with
+    ``method`` by the toolkits in the ``toolkit_key`` ``toolkit``, in units of
+    the elementary charge, or ``None`` if they aren't in the cache."""
+    row = (
+        _connect(cache_dir)
+        .execute(
+            "SELECT charges FROM toolkit_charges "
+            "WHERE smiles = ? AND method = ? AND toolkit = ?",
+            (smiles, method, toolkit),
+        )
+        .fetchone()
+    )
+    if row is None:
+        return None
+    return numpy.frombuffer(row[0], dtype=numpy.float64)
+
+
+def store(smiles, method, toolkit, charges, cache_dir=None):
+    """Record the ``charges`` for the mapped SMILES ``smiles`` computed with
+    ``method`` by the toolkits in the ``toolkit_key`` ``toolkit``."""
+    blob = numpy.asarray(charges, dtype=numpy.float64).tobytes()
+    conn = _connect(cache_dir)
+    conn.execute(
+        "INSERT OR REPLACE INTO toolkit_charges VALUES (?, ?, ?, ?)",
+        (smiles, method, toolkit, blob),
+    )
+    conn.commit()
+
+
+def install_charge_cache(cache_dir=None):
+    """Wrap ``Molecule.assign_partial_charges`` in this process so that it
+    reads charges from and saves them to the cache in ``cache_dir``. This is
+    intended to be called from a ``multiprocessing.Pool`` initializer."""
+    from openff.toolkit import Molecule
+    from openff.units import unit
+
+    assign = Molecule.assign_partial_charges
+    signature = inspect.signature(assign)
+
+    def cached(self, *args, **kwargs):
+        call = signature.bind(self, *args, **kwargs)
+        call.apply_defaults()
+        if (
+            call.arguments["use_conformers"] is not None
+            or not call.arguments["normalize_partial_charges"]
+        ):
+            return assign(self, *args, **kwargs)
+
+        method = call.arguments["partial_charge_method"]
+        toolkit = toolkit_key(call.arguments["toolkit_registry"])
+        smiles = self.to_smiles(mapped=True)
+        charges = lookup(smiles, method, toolkit, cache_dir)
+        if charges is not None:
+            self.partial_charges = unit.Quantity(charges, unit.elementary_charge)
+            return
+
+        assign(self, *args, **kwargs)
+        store(
+            smiles,
+            method,
+            toolkit,
+            self.partial_charges.m_as(unit.elementary_charge),
+            cache_dir,
+        )
+
+    Molecule.assign_partial_charges = cached
@@ -5,8 +5,20 @@ import yaml
 
 @dataclass
 class Config:
-    forcefield: str
+    forcefield: str | list[str]
     datasets: list[str]
+    # optional baseline force field, and the directory holding the sqlite
+    # stores from a run with it, for delta benchmarking
+    baseline_forcefield: str | None = None
+    baseline_dir: str | None = None
+
+    @property
+    def forcefields(self) -> list[str]:
+        """The force field(s) to benchmark, as a list even if ``forcefield``
+        was given as a single string."""
+        if isinstance(self.forcefield, str):
+            return [self.forcefield]
+        return list(self.forcefield)
 
     @classmethod
     def from_file(cls, filename):
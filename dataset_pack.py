@@ -0,0 +1,376 @@
+"""Indexed, compressed containers for dataset JSON files.
+
+Usage:
+    python dataset_pack.py pack [--chunk-size N] DATASET.json OUT.pack
+    python dataset_pack.py unpack DATASET.pack OUT.json
+    python dataset_pack.py subset [--first N] [--ids ID ...] DATASET OUT.json
+
+The ``raw.json`` and ``filtered.json`` files written for each dataset are
+``OptimizationResultCollection``s, and ``cache.json`` is a yammbs
+``QCArchiveDataset`` (or a ``QCArchiveTorsionDataset`` for torsion drives).
+All of them are a single JSON document with one large list of entries, so
+reading any one entry means parsing the whole file, and the files are stored
+uncompressed.
+
+A pack holds the same document in a sqlite database instead. The entries are
+stored in order in zlib-compressed chunks of ``CHUNK_SIZE`` entries, with an
+index from the record ID of each entry to its chunk, and the rest of the
+document is stored alongside as JSON. Reading a single entry only decompresses
+its chunk, and reading every entry in order decompresses each chunk once, so a
+pack can be read in bounded memory. Since the entries are compressed, packs
+are also considerably smaller than the JSON they were made from.
+
+``ingest.iter_entries`` reads packs as well as JSON files, so a pack can be
+listed in the ``datasets`` of a submission's input file in place of
+``cache.json``. Use ``PackedDataset`` directly to look entries up by record
+ID, and ``subset`` above to extract some of them to a new JSON dataset, for
+example for a quick test run. Packs are recognized by their contents, not
+their file extension.
+"""
+
+import argparse
+import json
+import sqlite3
+import zlib
+from itertools import batched
+from pathlib import Path
+
+import ijson
+
+FORMAT_VERSION = 1
+
+# entries per compressed chunk
+CHUNK_SIZE = 64
+
+# the key of the list of entries in each kind of dataset. The entries of an
+# OptimizationResultCollection are further grouped by server address
+LIST_KEYS = ("qm_molecules", "qm_torsions", "entries")
+
+# the first of these present in an entry is its record ID
+ID_FIELDS = ("qcarchive_id", "record_id", "id")
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE chunks (id INTEGER PRIMARY KEY, data BLOB);
+CREATE TABLE entries (
+    seq INTEGER PRIMARY KEY,
+    grp TEXT,
+    id INTEGER,
+    chunk INTEGER,
+    pos INTEGER
+);
+CREATE UNIQUE INDEX entry_ids ON entries (grp, id);
+"""
+
+
+def is_packed(path) -> bool:
+    """Return whether ``path`` is a pack rather than a JSON file."""
+    with open(path, "rb") as inp:
+        return inp.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def record_id(entry) -> int:
+    """Return the record ID of the dataset entry ``entry``."""
+    for field in ID_FIELDS:
+        if field in entry:
+            return entry[field]
+    raise KeyError(f"dataset entry has none of the ID fields {ID_FIELDS}")
+
+
+def _walk(path):
+    """Yield ``(group, entry)`` for each entry in the dataset JSON file
+    ``path``, where ``group`` is the server address for the entries of an
+    ``OptimizationResultCollection`` and ``""`` otherwise, followed by
+    ``(None, header)``, where ``header`` is the rest of the document with
+    empty lists in place of the entries."""
+    header = ijson.ObjectBuilder()
+    list_key = group = item = entry = None
+    with open(path, "rb") as inp:
+        for prefix, event, value in ijson.parse(inp, use_float=True):
+            if entry is not None:
+                entry.event(event, value)
+                if prefix == item and event == "end_map":
+                    yield group, entry.value
+                    entry = None
+                continue
+
+            if prefix == "" and event == "map_key" and value in LIST_KEYS:
+                list_key = value
+                group = ""
+                item = f"{list_key}.item"
+            elif list_key == "entries" and prefix == "entries" and event == "map_key":
+                group = value
+                item = f"entries.{group}.item"
+            elif list_key is not None and prefix == item and event == "start_map":
+                entry = ijson.ObjectBuilder()
+                entry.event(event, value)
+                continue
+            header.event(event, value)
+    if list_key is None:
+        raise ValueError(f"{path} has none of the dataset lists {LIST_KEYS}")
+    yield None, header.value
+
+
+def _list_key(header) -> str:
+    return next(key for key in LIST_KEYS if key in header)
+
+
+def _document(header, entries) -> dict:
+    """Return the dataset document with the rest of the document ``header``
+    and the ``(group, entry)`` pairs in ``entries``."""
+    ret = json.loads(json.dumps(header))
+    key = _list_key(header)
+    if key == "entries":
+        ret["entries"] = dict()
+        for group, entry in entries:
+            ret["entries"].setdefault(group, list()).append(entry)
+    else:
+        ret[key] = [entry for _, entry in entries]
+    return ret
+
+
+def _count(doc) -> int:
+    key = _list_key(doc)
+    if key == "entries":
+        return sum(len(entries) for entries in doc["entries"].values())
+    return len(doc[key])
+
+
+def pack(dataset, path, chunk_size=CHUNK_SIZE) -> int:
+    """Pack the dataset JSON file ``dataset`` into a new pack at ``path``,
+    ``chunk_size`` entries to a chunk, and return the number of entries."""
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    conn = sqlite3.connect(tmp)
+    conn.executescript(SCHEMA)
+
+    entries = _walk(dataset)
+    n = 0
+    header = None
+    for chunk, batch in enumerate(batched(entries, chunk_size)):
+        if batch[-1][0] is None:
+            header = batch[-1][1]
+            batch = batch[:-1]
+            if not batch:
+                break
+        data = json.dumps([entry for _, entry in batch]).encode()
+        conn.execute("INSERT INTO chunks VALUES (?, ?)", (chunk, zlib.compress(data)))
+        conn.executemany(
+            "INSERT INTO entries (grp, id, chunk, pos) VALUES (?, ?, ?, ?)",
+            (
+                (group, record_id(entry), chunk, pos)
+                for pos, (group, entry) in enumerate(batch)
+            ),
+        )
+        n += len(batch)
+
+    conn.executemany(
+        "INSERT INTO meta VALUES (?, ?)",
+        [("version", str(FORMAT_VERSION)), ("header", json.dumps(header))],
+    )
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    tmp.replace(path)
+    return n
+
+
+class PackedDataset:
+    """Read-only access to the pack at ``path``.
+
+    Entries are identified by their record ID and, for the entries of an
+    ``OptimizationResultCollection``, the address of the server they came
+    from. ``group`` may be left out when all of the entries come from the same
+    server."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        if int(meta["version"]) != FORMAT_VERSION:
+            raise ValueError(
+                f"{path} is a version {meta['version']} pack, expected "
+                f"version {FORMAT_VERSION}"
+            )
+        self.header = json.loads(meta["header"])
+        self.list_key = _list_key(self.header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __contains__(self, record_id) -> bool:
+        return self._locate(record_id) is not None
+
+    def _chunk(self, chunk) -> list[dict]:
+        (data,) = self.conn.execute(
+            "SELECT data FROM chunks WHERE id = ?", (chunk,)
+        ).fetchone()
+        return json.loads(zlib.decompress(data))
+
+    def _locate(self, record_id, group=None):
+        if group is None:
+            rows = self.conn.execute(
+                "SELECT chunk, pos FROM entries WHERE id = ?", (record_id,)
+            ).fetchall()
+            if len(rows) > 1:
+                raise ValueError(
+                    f"record {record_id} is in more than one group of {self.path}"
+                )
+            return rows[0] if rows else None
+        return self.conn.execute(
+            "SELECT chunk, pos FROM entries WHERE grp = ? AND id = ?",
+            (group, record_id),
+        ).fetchone()
+
+    def ids(self, group=None) -> list[int]:
+        """Return the record IDs of the entries, in order, optionally only
+        those in ``group``."""
+        if group is None:
+            rows = self.conn.execute("SELECT id FROM entries ORDER BY seq")
+        else:
+            rows = self.conn.execute(
+                "SELECT id FROM entries WHERE grp = ? ORDER BY seq", (group,)
+            )
+        return [record_id for (record_id,) in rows]
+
+    def get(self, record_id, group=None) -> dict:
+        """Return the entry with ``record_id``, raising a ``KeyError`` if
+        there isn't one."""
+        found = self._locate(record_id, group)
+        if found is None:
+            raise KeyError(record_id)
+        chunk, pos = found
+        return self._chunk(chunk)[pos]
+
+    def entries(self, record_ids=None, group=None):
+        """Yield ``(group, entry)`` for each entry in order, or only those
+        with one of ``record_ids``, decompressing each chunk at most once."""
+        query = "SELECT grp, id, chunk, pos FROM entries"
+        params = ()
+        if group is not None:
+            query += " WHERE grp = ?"
+            params = (group,)
+        if record_ids is not None:
+            record_ids = set(record_ids)
+        current, data = None, None
+        for grp, rid, chunk, pos in self.conn.execute(query + " ORDER BY seq", params):
+            if record_ids is not None and rid not in record_ids:
+                continue
+            if chunk != current:
+                current, data = chunk, self._chunk(chunk)
+            yield grp, data[pos]
+
+    def __iter__(self):
+        for _, entry in self.entries():
+            yield entry
+
+    def document(self, record_ids=None) -> dict:
+        """Return the whole dataset as it was before packing, or with only the
+        entries with one of ``record_ids``, as a dict ready to validate with
+        the corresponding pydantic model."""
+        return _document(self.header, self.entries(record_ids))
+
+
+def unpack(path, dataset, record_ids=None) -> int:
+    """Write the pack at ``path`` back out as the JSON file ``dataset``,
+    optionally only with the entries with one of ``record_ids``, and return
+    the number of entries written."""
+    with PackedDataset(path) as packed:
+        doc = packed.document(record_ids)
+    with open(dataset, "w") as out:
+        json.dump(doc, out)
+    return _count(doc)
+
+
+def subset(dataset, out, record_ids=None, first=None) -> int:
+    """Write the entries of ``dataset``, a pack or JSON file, with one of
+    ``record_ids``, or only the ``first`` of those, to the JSON file ``out``,
+    returning the number written."""
+    if record_ids is not None:
+        record_ids = set(record_ids)
+
+    if is_packed(dataset):
+        with PackedDataset(dataset) as packed:
+            ids = packed.ids()
+        if record_ids is not None:
+            ids = [i for i in ids if i in record_ids]
+        return unpack(dataset, out, ids[:first])
+
+    entries = list()
+    for group, entry in _walk(dataset):
+        if group is None:
+            header = entry
+        elif first is not None and len(entries) == first:
+            # keep going to reach the rest of the document
+            continue
+        elif record_ids is None or record_id(entry) in record_ids:
+            entries.append((group, entry))
+    doc = _document(header, entries)
+    with open(out, "w") as f:
+        json.dump(doc, f)
+    return _count(doc)
+
+
+def main():
+    a = argparse.ArgumentParser(
+        prog="python dataset_pack.py",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    sub = a.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("pack", help="Convert a dataset JSON file to a pack")
+    p.add_argument("dataset", help="The dataset JSON file")
+    p.add_argument("out", help="The pack to write")
+    p.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="The number of entries to compress together. Defaults to %(default)d",
+    )
+
+    p = sub.add_parser("unpack", help="Convert a pack back to a JSON file")
+    p.add_argument("dataset", help="The pack")
+    p.add_argument("out", help="The dataset JSON file to write")
+
+    p = sub.add_parser("subset", help="Extract some entries to a JSON file")
+    p.add_argument("dataset", help="The pack or dataset JSON file")
+    p.add_argument("out", help="The dataset JSON file to write")
+    p.add_argument(
+        "--ids", type=int, nargs="+", default=None, help="Record IDs to extract"
+    )
+    p.add_argument(
+        "--first", type=int, default=None, help="Only extract the first N entries"
+    )
+
+    args = a.parse_args()
+    if args.command == "pack":
+        n = pack(args.dataset, args.out, args.chunk_size)
+        before, after = Path(args.dataset).stat().st_size, Path(args.out).stat().st_size
+        print(
+            f"packed {n} entries from {args.dataset} into {args.out}, "
+            f"{before / 2**20:.1f} MiB -> {after / 2**20:.1f} MiB",
+            flush=True,
+        )
+    elif args.command == "unpack":
+        n = unpack(args.dataset, args.out)
+        print(f"unpacked {n} entries from {args.dataset} to {args.out}", flush=True)
+    else:
+        n = subset(args.dataset, args.out, args.ids, args.first)
+        print(f"wrote {n} entries from {args.dataset} to {args.out}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
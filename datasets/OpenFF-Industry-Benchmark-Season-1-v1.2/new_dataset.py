@@ -4,10 +4,8 @@ from collections import defaultdict
 from dataclasses import dataclass
 from multiprocessing import Pool
 from pathlib import Path
-from tempfile import TemporaryDirectory
 
 import yaml
-from openff.qcsubmit.results import OptimizationResultCollection
 from openff.qcsubmit.results.filters import (
     ConformerRMSDFilter,
     ConnectivityFilter,
@@ -16,16 +14,25 @@ from openff.qcsubmit.results.filters import (
     SinglepointRecordFilter,
     T,
 )
-from openff.qcsubmit.utils import _CachedPortalClient, portal_client_manager
+from openff.qcsubmit.utils import portal_client_manager
 from openff.toolkit.utils.exceptions import (
     ChargeCalculationError,
     ConformerGenerationError,
 )
 from openff.toolkit.utils.toolkits import OpenEyeToolkitWrapper
-from qcportal import PortalClient
 from tqdm import tqdm
 from yammbs.inputs import QCArchiveDataset
 
+# the QCArchive cache is shared from the top level of the repository, which
+# must be on PYTHONPATH
+from qca_cache import (
+    QCA_ADDRESS,
+    PersistentPortalClient,
+    add_cache_arguments,
+    download_collection,
+    evict,
+)
+
 
 @dataclass
 class Config:
@@ -41,11 +48,14 @@ class Config:
             return ret
 
 
-def download_dataset(client: PortalClient, dsname: str, out_dir: Path):
-    """Download the named ``OptimizationResultCollection``, write it to
-    ``raw.json`` in ``out_dir`` and return the result collection."""
+def download_dataset(
+    client: PersistentPortalClient, dsname: str, out_dir: Path, cache_dir: Path
+):
+    """Download the named ``OptimizationResultCollection``, or load it from
+    ``cache_dir`` if ``client`` is offline, write it to ``raw.json`` in
+    ``out_dir`` and return the result collection."""
 
-    ds = OptimizationResultCollection.from_server(client, dsname)
+    ds = download_collection(client, dsname, cache_dir)
     with open(out_dir / "raw.json", "w") as out:
         out.write(ds.json())
 
@@ -159,13 +169,12 @@ def main():
     a = argparse.ArgumentParser()
     a.add_argument("input_file")
     a.add_argument("--nprocs", "-n", type=int, default=1)
+    add_cache_arguments(a)
     args = a.parse_args()
 
     conf = Config.from_file(args.input_file)
-    with TemporaryDirectory() as d:
-        client = _CachedPortalClient(
-            "https://api.qcarchive.molssi.org:443/", d
-        )
+    client = PersistentPortalClient(QCA_ADDRESS, args.qca_cache_dir, args.offline)
+    try:
         out_dir = Path.cwd()
         if conf.ds_name.replace(" ", "-") not in str(out_dir):
             raise FileNotFoundError(
@@ -173,7 +182,7 @@ def main():
             f"the required path segment {conf.ds_name.replace(' ', '-')}.")
 
         logger.info(f"Downloading dataset {conf.ds_name} to {out_dir}")
-        ds = download_dataset(client, conf.ds_name, out_dir)
+        ds = download_dataset(client, conf.ds_name, out_dir, args.qca_cache_dir)
 
         with portal_client_manager(lambda _: client):
             logger.info("Filtering dataset with")
@@ -183,6 +192,8 @@ def main():
             ds = QCArchiveDataset.from_qcsubmit_collection(ds)
             with open(out_dir / "cache.json", "w") as out:
                 out.write(ds.model_dump_json())
+    finally:
+        evict(args.qca_cache_dir, args.qca_cache_size)
 
 
 if __name__ == "__main__":
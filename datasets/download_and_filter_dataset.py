@@ -1,7 +1,11 @@
 """Downloads and filters a named dataset from QCArchive.
 
 Usage:
-    python download_and_filter_dataset.py [-n NPROCS] [-c CHUNKSIZE] DS_NAME
+    PYTHONPATH=.. python download_and_filter_dataset.py [-n NPROCS] [-c CHUNKSIZE]
+        [--max-tasks-per-worker N] [--max-worker-rss MIB] [--memory-budget MIB]
+        [--events PATH] [--qca-cache-dir DIR] [--qca-cache-size GIB] [--offline]
+        [--resume] [--baseline DIR | --download-only | --shard i/N | --merge N]
+        DS_NAME
 
 This script retrieves the OptimizationResultCollection named DS_NAME from
 QCArchive, applies the RecordStatus, Connectivity, ConformerRMSD, and
@@ -12,21 +16,73 @@ filtered version as filtered.json, and the final yammbs.QCArchiveDataset to be
 used for benchmark runs is saved as cache.json.
 
 The optional arguments NPROCS and CHUNKSIZE control the parallelism of the
-process. NPROCS specifies the size of the multiprocessing.Pool to use for the
-ChargeCheckFilter, while CHUNKSIZE is the Pool.imap chunksize argument
-controlling the number of molecules to batch together. For maximum speed, set
+process. NPROCS specifies the size of the process pool shared by all of the
+filters, while CHUNKSIZE is the Pool.imap chunksize argument controlling the
+number of molecules (or groups of conformers) to batch together. The records
+and molecules are retrieved from QCArchive once and reused by every filter. For maximum speed, set
 NPROCS as high as the number of available cores. Similarly, a CHUNKSIZE of 32
 has worked well in previous experiments but something larger should work too. A
 smaller CHUNKSIZE can cause additional overhead submitting small tasks to the
-process Pool.
+process Pool. The remaining options bound the memory used by the pool, as
+described in ../mempool.py.
+
+This script shares the charge cache, QCArchive cache, dataset streaming,
+worker pool, sharding, and telemetry modules in the top level of the
+repository, so that directory must be on PYTHONPATH, as in the usage above
+when running from this directory.
+
+The AM1BCC-ELF10 charges computed by the ChargeCheck filter are saved in the
+persistent charge cache described in ../charge_cache.py, so repeated molecules
+and later runs of the filter only need to look them up. Failures are not
+cached and are checked again. The charges are stored under the am1bccelf10
+method, so they are not reused by benchmark runs, which assign am1bcc charges.
+Progress is written to a JSON-lines events file, as described in
+../telemetry.py.
+
+Records downloaded from QCArchive are kept in the persistent, size-bounded
+cache described in ../qca_cache.py, so reruns and later versions of a dataset
+only download new records. With --offline, the dataset and its records are
+read from that cache alone, which rebuilds filtered.json and cache.json without
+network access.
+
+The outcome of the ChargeCheck filter for each record is appended to
+charge_check.jsonl in the output directory as soon as it is known. If a run is
+interrupted, rerunning the same command with --resume skips the records
+already in that journal, so only the remaining charge checks are repeated.
+Without --resume, including with --offline, a journal left by an earlier run
+is deleted first, so every record is checked again.
+
+When building a new version of a dataset, pass the directory of the previous
+version as --baseline DIR. The records added, removed, or changed since its
+raw.json are reported, and only the records of the molecules they belong to
+are filtered again, since the ConformerRMSD filter compares all the conformers
+of a molecule. The other records keep their outcome from the baseline's
+filtered.json, and their entries in cache.json are copied from the baseline's
+rather than converted again. Records are compared by their entries in
+raw.json, so a record whose entry is unchanged is assumed to be unchanged.
+
+The filters can also be split across nodes, for example with a Slurm job
+array. First, running with --download-only writes raw.json and downloads
+every record to the QCArchive cache, without filtering. Running with --shard
+i/N then filters and converts only the i-th of N cost-balanced slices of the
+molecules in that raw.json, counting from 1, and writes
+filtered-shard-i-of-N.json, cache-shard-i-of-N.json, and a
+charge_check-shard-i-of-N.jsonl journal instead of the usual files. Once every
+shard has finished, running with --merge N combines the fragments into
+filtered.json and cache.json, in the order of the records in raw.json. The
+shards and the merge never contact QCArchive, so they all see the same
+snapshot of the dataset, even if it changes on the server while they run. The
+shards also only read the QCArchive cache, so the nodes never write to the
+same cache files at once.
 """
 
 import argparse
+import json
 import logging
+import os
+import time
 from collections import defaultdict
-from multiprocessing import Pool
 from pathlib import Path
-from tempfile import TemporaryDirectory
 
 from openff.qcsubmit.results import OptimizationResultCollection
 from openff.qcsubmit.results.filters import (
@@ -34,135 +90,467 @@ from openff.qcsubmit.results.filters import (
     ConnectivityFilter,
     RecordStatusEnum,
     RecordStatusFilter,
+    ResultRecordGroupFilter,
     SinglepointRecordFilter,
-    T,
 )
-from openff.qcsubmit.utils import _CachedPortalClient, portal_client_manager
+from openff.qcsubmit.utils import portal_client_manager
 from openff.toolkit.utils.exceptions import (
     ChargeCalculationError,
     ConformerGenerationError,
 )
 from openff.toolkit.utils.toolkits import OpenEyeToolkitWrapper
-from qcportal import PortalClient
+from openff.units import unit
 from tqdm import tqdm
 from yammbs.inputs import QCArchiveDataset
 
+import charge_cache
+from ingest import iter_entries
+from mempool import MemoryBoundedPool, add_limit_arguments, limits_from_args
+from qca_cache import (
+    QCA_ADDRESS,
+    PersistentPortalClient,
+    add_cache_arguments,
+    download_collection,
+    evict,
+)
+from shard import conformer_cost, fragment_path, parse_shard, select
+from telemetry import add_events_argument, configure, emit, progress, stage
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ChargeCheck outcomes are appended to this file in the output directory
+JOURNAL_FILE = "charge_check.jsonl"
+
+# seconds between forcing the journal to disk
+JOURNAL_SYNC_INTERVAL = 60
+
 
-def download_dataset(client: PortalClient, dsname: str, out_dir: Path):
-    """Download the named ``OptimizationResultCollection``, write it to
-    ``raw.json`` in ``out_dir`` and return the result collection."""
+def download_dataset(
+    client: PersistentPortalClient, dsname: str, out_dir: Path, cache_dir: Path
+):
+    """Download the named ``OptimizationResultCollection``, or load it from
+    ``cache_dir`` if ``client`` is offline, write it to ``raw.json`` in
+    ``out_dir`` and return the result collection."""
 
-    ds = OptimizationResultCollection.from_server(client, dsname)
+    ds = download_collection(client, dsname, cache_dir)
     with open(out_dir / "raw.json", "w") as out:
         out.write(ds.json())
 
     return ds
 
 
-def imap_fn(record_and_molecule):
-    """record here is actually only a record.id because the records maintain a
-    reference to a PortalClient, which cannot be pickled for multiprocessing.
-    """
-    record, molecule = record_and_molecule
+def check_charges(molecule) -> bool:
+    """Return whether AM1BCC-ELF10 charges can be assigned to ``molecule``,
+    looking them up in and saving them to the charge cache."""
+    smiles = molecule.to_smiles(mapped=True)
+    toolkit = OpenEyeToolkitWrapper()
+    key = charge_cache.toolkit_key(toolkit)
+    if charge_cache.lookup(smiles, "am1bccelf10", key) is not None:
+        return True
+
     try:
-        OpenEyeToolkitWrapper().assign_partial_charges(
-            molecule, partial_charge_method="am1bccelf10"
-        )
+        toolkit.assign_partial_charges(molecule, partial_charge_method="am1bccelf10")
     except (ChargeCalculationError, ConformerGenerationError):
-        ok = False
-    else:
-        ok = True
+        return False
 
-    return record, ok
+    charge_cache.store(
+        smiles,
+        "am1bccelf10",
+        key,
+        molecule.partial_charges.m_as(unit.elementary_charge),
+    )
+    return True
+
+
+def read_journal(path) -> dict[tuple[str, int], bool]:
+    """Return the ChargeCheck outcome recorded in the journal at ``path`` for
+    each pair of server address and record ID."""
+    ret = dict()
+    if path is None or not os.path.exists(path):
+        return ret
+    with open(path) as inp:
+        for line in inp:
+            if not line.endswith("\n"):
+                # partially written when the run was interrupted
+                break
+            entry = json.loads(line)
+            ret[entry["address"], entry["record_id"]] = entry["ok"]
+    return ret
+
+
+def open_journal(path):
+    """Open the journal at ``path`` for appending, first truncating any
+    partially written last line, or open the null device if ``path`` is
+    ``None``."""
+    if path is None:
+        return open(os.devnull, "a")
+    if os.path.exists(path):
+        with open(path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+    return open(path, "a")
 
 
 class ChargeCheckFilter(SinglepointRecordFilter):
-    nprocs: int = 1
-    chunksize: int = 1
-
-    # this is not needed now that I overrode _apply, and I need to pass along
-    # the record_id anyway, but pydantic requires it to be here
-    def _filter_function(self, result, record, molecule) -> bool:
-        raise NotImplementedError()
-
-    def _apply(self, result_collection: T) -> T:
-        """Copy of SinglepointRecordFilter._apply with added logging, progress
-        reporting, and eventually parallelism."""
+    """Filter out records whose molecules can't be assigned AM1BCC-ELF10
+    charges. When applied by ``run_filters``, each outcome is appended to
+    ``journal`` as it arrives, and records already in it are skipped, so an
+    interrupted run can pick up where it left off."""
 
-        all_records_and_molecules = defaultdict(list)
-
-        logger.info("starting to_records")
-
-        for record, molecule in result_collection.to_records():
-            all_records_and_molecules[record._client.address].append(
-                (record.id, molecule)
-            )
+    journal: str | None = None
 
-        logger.info("finished to records")
+    def _filter_function(self, result, record, molecule) -> bool:
+        return check_charges(molecule)
+
+
+# (entry, record, molecule, address) for each record in the collection being
+# filtered by run_filters. This is set before the pool's workers are started,
+# so they inherit it and only need to be sent indices into it, since the
+# records hold a reference to a PortalClient, which cannot be pickled.
+_records = list()
+
+
+def _check(task):
+    """Apply a filter to some of ``_records``. ``task`` holds the filter and
+    either the index of one record or, for a ``ResultRecordGroupFilter``, a
+    tuple of the indices of a group of conformers. Returns a list of pairs of
+    record index and whether the record passed."""
+    f, item = task
+    if isinstance(f, ResultRecordGroupFilter):
+        kept = {
+            (entry.record_id, address)
+            for entry, *_, address in f._filter_function([_records[i] for i in item])
+        }
+        return [(i, (_records[i][0].record_id, _records[i][3]) in kept) for i in item]
+    entry, record, molecule, _ = _records[item]
+    return [(item, f._filter_function(entry, record, molecule))]
+
+
+def _apply_filter(pool, f, alive, chunksize) -> list[int]:
+    """Apply the filter ``f`` to the indices ``alive`` of ``_records`` in
+    ``pool`` and return the indices of the records that pass."""
+    name = type(f).__name__
+    print(f"starting filter: {name} on {len(alive)} records", flush=True)
+    emit("filter", name=name, records=len(alive))
+
+    def key(i):
+        return _records[i][3], _records[i][0].record_id
+
+    journal_path = getattr(f, "journal", None)
+    passed = read_journal(journal_path)
+    if passed:
+        logger.info(f"skipping {len(passed)} records found in {journal_path}")
+
+    if isinstance(f, ResultRecordGroupFilter):
+        groups = defaultdict(list)
+        for i in alive:
+            groups[_records[i][0].inchi_key].append(i)
+        items = [tuple(group) for group in groups.values()]
+    else:
+        items = [i for i in alive if key(i) not in passed]
+
+    synced = time.time()
+    with open_journal(journal_path) as journal:
+        for result in tqdm(
+            progress(
+                pool.imap_unordered(
+                    _check, ((f, item) for item in items), chunksize=chunksize
+                ),
+                name,
+                len(items),
+                failed=lambda result: not all(ok for _, ok in result),
+            ),
+            total=len(items),
+            desc=f"Filtering with {name}",
+        ):
+            for i, ok in result:
+                passed[key(i)] = ok
+                if journal_path is None:
+                    continue
+                address, record_id = key(i)
+                record = dict(address=address, record_id=record_id, ok=ok)
+                journal.write(json.dumps(record) + "\n")
+            journal.flush()
+            if time.time() - synced > JOURNAL_SYNC_INTERVAL:
+                os.fsync(journal.fileno())
+                synced = time.time()
+
+    # the pool raises if it loses any items, but never let a record without
+    # an outcome silently fail the filter
+    missing = [key(i) for i in alive if key(i) not in passed]
+    if missing:
+        raise RuntimeError(
+            f"{name} produced no outcome for {len(missing)} records, including "
+            f"{', '.join(str(record_id) for _, record_id in missing[:10])}"
+        )
 
-        filtered_results = {}
+    return [i for i in alive if passed[key(i)]]
+
+
+def keyed_entries(collection) -> dict[tuple[str, int], object]:
+    """Return the entries of ``collection`` keyed by server address and record
+    ID."""
+    return {
+        (address, entry.record_id): entry
+        for address, entries in collection.entries.items()
+        for entry in entries
+    }
+
+
+def select_entries(collection, keys):
+    """Return a copy of ``collection`` with only the entries in ``keys``."""
+    ret = collection.copy(deep=True)
+    ret.entries = dict()
+    for address, entries in collection.entries.items():
+        entries = [entry for entry in entries if (address, entry.record_id) in keys]
+        if entries:
+            ret.entries[address] = entries
+    return ret
+
+
+def run_filters(collection, filters, nprocs=1, chunksize=1, limits=None):
+    """Apply each of ``filters`` to the ``OptimizationResultCollection``
+    ``collection`` in turn, in a pool of ``nprocs`` processes sent
+    ``chunksize`` records or conformer groups at a time, subject to
+    ``limits``, and return the filtered collection.
+
+    This does the same as ``collection.filter(*filters)``, except that the
+    records and molecules are retrieved with ``to_records`` once rather than
+    once per filter, and every filter runs in the same pool."""
+    entries = keyed_entries(collection)
+
+    logger.info("starting to_records")
+    _records.clear()
+    for record, molecule in collection.to_records():
+        address = record._client.address
+        _records.append((entries[address, record.id], record, molecule, address))
+    logger.info("finished to_records")
+
+    alive = list(range(len(_records)))
+    with MemoryBoundedPool(nprocs, limits=limits) as pool:
+        for f in filters:
+            alive = _apply_filter(pool, f, alive, chunksize)
+    print(f"{len(alive)} records passed every filter", flush=True)
+
+    kept = {(_records[i][3], _records[i][0].record_id) for i in alive}
+    _records.clear()
+
+    filtered = select_entries(collection, kept)
+    applied = filtered.provenance.setdefault("applied-filters", dict())
+    for f in filters:
+        # the journal path is specific to this run
+        applied[f"{type(f).__name__}-{len(applied)}"] = f.dict(exclude={"journal"})
+    return filtered
+
+
+def dataset_filters(journal):
+    """Return the filters applied to every dataset, journaling the ChargeCheck
+    outcomes in ``journal``."""
+    return [
+        RecordStatusFilter(status=RecordStatusEnum.complete),
+        ConnectivityFilter(tolerance=1.2),
+        ConformerRMSDFilter(),
+        ChargeCheckFilter(journal=str(journal)),
+    ]
 
-        for address, entries in result_collection.entries.items():
-            records_and_molecules = all_records_and_molecules[address]
 
-            filtered_ids = []
-            with Pool(processes=self.nprocs) as p:
-                for record_id, ok in tqdm(
-                    p.imap(
-                        imap_fn,
-                        records_and_molecules,
-                        chunksize=self.chunksize,
-                    ),
-                    total=len(records_and_molecules),
-                    desc="Filtering charge errors",
-                ):
-                    if ok:
-                        filtered_ids.append(record_id)
+def journal_path(out_dir, shard=None) -> Path:
+    """Return the path of the ChargeCheck journal in ``out_dir``, or of the
+    journal for ``shard``."""
+    journal = out_dir / JOURNAL_FILE
+    if shard is not None:
+        journal = fragment_path(journal, *shard)
+    return journal
 
-            filtered_results[address] = [
-                entry for entry in entries if entry.record_id in filtered_ids
-            ]
 
-        result_collection.entries = filtered_results
+def filter_dataset(ds, nprocs, chunksize, out_dir, limits=None, shard=None):
+    """Filter ``ds`` and write the result to ``filtered.json`` in ``out_dir``,
+    or to the fragment of it for ``shard``, which has its own journal."""
+    filtered_file = out_dir / "filtered.json"
+    if shard is not None:
+        filtered_file = fragment_path(filtered_file, *shard)
 
-        return result_collection
+    ds = run_filters(
+        ds, dataset_filters(journal_path(out_dir, shard)), nprocs, chunksize, limits
+    )
 
+    with open(filtered_file, "w") as out:
+        out.write(ds.json())
 
-class NoisyFilter(SinglepointRecordFilter):
-    """A filter that always returns true but can be used for signaling progress
-    through a sequence of real filters."""
+    return ds
 
-    name: str
 
-    def _apply(self, result_collection):
-        n = result_collection.n_results
-        print(f"starting filter: {self.name} on {n} records")
-        return super()._apply(result_collection)
+def shard_entries(ds, index, count) -> set[tuple[str, int]]:
+    """Return the keys of the entries of ``ds`` assigned to shard ``index`` of
+    ``count``.
+
+    Molecules are assigned to shards whole, since the ConformerRMSD filter
+    compares the conformers of each molecule, and are balanced by the
+    estimated cost of their conformers. The assignment only depends on the
+    contents of ``ds``, so every shard agrees on it."""
+    entries = keyed_entries(ds)
+    costs = defaultdict(float)
+    for entry in entries.values():
+        costs[entry.inchi_key] += conformer_cost(entry.cmiles)
+    molecules = select(costs, index, count)
+    return {key for key, entry in entries.items() if entry.inchi_key in molecules}
+
+
+def diff_collections(old, new) -> tuple[set, set, set]:
+    """Return the keys of the entries added, removed, and changed between the
+    keyed entries ``old`` and ``new``."""
+    added = new.keys() - old.keys()
+    removed = old.keys() - new.keys()
+    changed = {key for key in new.keys() & old.keys() if new[key] != old[key]}
+    return added, removed, changed
+
+
+def filter_incrementally(ds, baseline, nprocs, chunksize, out_dir, limits=None):
+    """Filter ``ds`` like ``filter_dataset``, but reuse the filter outcomes of
+    the previous version of the dataset in the directory ``baseline`` for the
+    records that haven't changed since. Return the filtered dataset and the
+    part of it that was filtered again.
+
+    The conformer filter compares the records of each molecule with each
+    other, so every record of a molecule with any added, removed, or changed
+    record is filtered again, not just the records that differ."""
+    old = keyed_entries(OptimizationResultCollection.parse_file(baseline / "raw.json"))
+    baseline_filtered = OptimizationResultCollection.parse_file(
+        baseline / "filtered.json"
+    )
+    passed = keyed_entries(baseline_filtered)
+    new = keyed_entries(ds)
+    added, removed, changed = diff_collections(old, new)
+    print(
+        f"{len(added)} records added, {len(removed)} removed, and {len(changed)} "
+        f"changed since {baseline}",
+        flush=True,
+    )
+    emit(
+        "baseline_diff",
+        baseline=str(baseline),
+        added=len(added),
+        removed=len(removed),
+        changed=len(changed),
+    )
 
-    def _filter_function(self, result, record, molecule) -> bool:
-        return True
+    touched = {new[key].inchi_key for key in added | changed}
+    touched |= {old[key].inchi_key for key in removed | changed}
+    redo = {key for key, entry in new.items() if entry.inchi_key in touched}
+    reused = {key for key in new.keys() - redo if key in passed}
+    print(
+        f"filtering {len(redo)} records and reusing {len(reused)} that passed "
+        "the baseline filters",
+        flush=True,
+    )
 
+    refiltered = select_entries(ds, redo)
+    if refiltered.entries:
+        refiltered = run_filters(
+            refiltered,
+            dataset_filters(journal_path(out_dir)),
+            nprocs,
+            chunksize,
+            limits,
+        )
 
-def filter_dataset(ds, nprocs, chunksize, out_dir):
-    ds = ds.filter(
-        NoisyFilter(name="RecordStatus"),
-        RecordStatusFilter(status=RecordStatusEnum.complete),
-        NoisyFilter(name="Connectivity"),
-        ConnectivityFilter(tolerance=1.2),
-        NoisyFilter(name="ConformerRMSD"),
-        ConformerRMSDFilter(),
-        NoisyFilter(name="ChargeCheck"),
-        ChargeCheckFilter(nprocs=nprocs, chunksize=chunksize),
-        NoisyFilter(name="End"),
+    ds = select_entries(ds, reused | keyed_entries(refiltered).keys())
+    # the same filters were applied to the reused and refiltered records
+    ds.provenance["applied-filters"] = refiltered.provenance.get(
+        "applied-filters", baseline_filtered.provenance.get("applied-filters")
     )
-
+    ds.provenance["baseline"] = baseline.name
     with open(out_dir / "filtered.json", "w") as out:
         out.write(ds.json())
 
-    return ds
+    return ds, refiltered
+
+
+def convert_incrementally(ds, refiltered, baseline) -> QCArchiveDataset:
+    """Convert the filtered collection ``ds`` to a ``QCArchiveDataset``,
+    copying the molecules for records outside of ``refiltered`` from the
+    ``cache.json`` of the previous version of the dataset in ``baseline``."""
+    kept = {key[1] for key in keyed_entries(ds)}
+    redone = {key[1] for key in keyed_entries(refiltered)}
+    molecules = [
+        molecule
+        for molecule in iter_entries(baseline / "cache.json", "qm_molecules")
+        if molecule["qcarchive_id"] in kept and molecule["qcarchive_id"] not in redone
+    ]
+    if refiltered.entries:
+        new = QCArchiveDataset.from_qcsubmit_collection(refiltered)
+        molecules.extend(molecule.model_dump() for molecule in new.qm_molecules)
+    return ordered_dataset(ds, molecules)
+
+
+def ordered_dataset(ds, molecules) -> QCArchiveDataset:
+    """Return a ``QCArchiveDataset`` of the ``qm_molecules`` dicts in
+    ``molecules``, in the order of their records in the collection ``ds``."""
+    order = {key[1]: i for i, key in enumerate(keyed_entries(ds))}
+    molecules.sort(key=lambda molecule: order[molecule["qcarchive_id"]])
+    return QCArchiveDataset(qm_molecules=molecules)
+
+
+def write_dataset(dataset, path):
+    """Write the ``QCArchiveDataset`` ``dataset`` to ``path``, under a
+    temporary name first, so the file only exists once it is complete."""
+    tmp = path.with_name(f"{path.name}.tmp")
+    with open(tmp, "w") as out:
+        out.write(dataset.model_dump_json())
+    tmp.replace(path)
+
+
+def read_snapshot(out_dir):
+    """Return the collection written to ``raw.json`` in ``out_dir`` by
+    ``--download-only``."""
+    raw_file = out_dir / "raw.json"
+    if not raw_file.exists():
+        raise FileNotFoundError(
+            f"{raw_file} does not exist, run with --download-only first"
+        )
+    return OptimizationResultCollection.parse_file(raw_file)
+
+
+def fetch_records(ds):
+    """Download the records and molecules of the collection ``ds`` into the
+    QCArchive cache of the current portal client."""
+    n = len(ds.to_records())
+    print(f"downloaded {n} records to the QCArchive cache", flush=True)
+
+
+def merge_shards(ds, count, out_dir):
+    """Combine the filtered collections and converted datasets written to
+    ``out_dir`` by the ``count`` shards of the raw collection ``ds``, writing
+    ``filtered.json`` and returning the filtered collection and the
+    ``QCArchiveDataset``."""
+    filtered_file, cache_file = out_dir / "filtered.json", out_dir / "cache.json"
+    shards = range(1, count + 1)
+    caches = [fragment_path(cache_file, i, count) for i in shards]
+    # the cache fragment is written last, so its filtered fragment is complete
+    missing = [str(path) for path in caches if not path.exists()]
+    if missing:
+        raise FileNotFoundError(f"missing shard outputs: {', '.join(missing)}")
+
+    kept, applied = set(), None
+    for i in shards:
+        part = OptimizationResultCollection.parse_file(
+            fragment_path(filtered_file, i, count)
+        )
+        kept |= keyed_entries(part).keys()
+        applied = part.provenance.get("applied-filters", applied)
+    print(f"{len(kept)} records passed every filter in {count} shards", flush=True)
+
+    ds = select_entries(ds, kept)
+    ds.provenance["applied-filters"] = applied
+    with open(filtered_file, "w") as out:
+        out.write(ds.json())
+
+    molecules = [
+        molecule for path in caches for molecule in iter_entries(path, "qm_molecules")
+    ]
+    return ds, ordered_dataset(ds, molecules)
 
 
 def main():
@@ -189,26 +577,138 @@ def main():
         default=1,
         help="The chunk size to use for Pool.imap. Defaults to %(default)d",
     )
+    a.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run in an existing output directory, "
+        "skipping the records whose ChargeCheck outcomes are in its journal. "
+        "Otherwise the journal is deleted and every record is checked again",
+    )
+    a.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="Directory of a previous version of the dataset, whose raw.json, "
+        "filtered.json, and cache.json are reused for unchanged records",
+    )
+    a.add_argument(
+        "--download-only",
+        action="store_true",
+        help="Only download the dataset to raw.json and its records to the "
+        "QCArchive cache, for --shard and --merge to read",
+    )
+    a.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Only filter shard i of N, given as i/N, of the dataset in the "
+        "raw.json written by --download-only, writing the results to fragments "
+        "of filtered.json and cache.json. Combine the fragments with --merge N",
+    )
+    a.add_argument(
+        "--merge",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Combine the fragments written by running with --shard i/N for "
+        "every i from 1 to N into filtered.json and cache.json",
+    )
+    add_limit_arguments(a)
+    add_events_argument(a)
+    add_cache_arguments(a)
     args = a.parse_args()
-
-    with TemporaryDirectory() as d:
-        client = _CachedPortalClient(
-            "https://api.qcarchive.molssi.org:443/", d
+    modes = (args.baseline, args.download_only or None, args.shard, args.merge)
+    if sum(x is not None for x in modes) > 1:
+        a.error(
+            "only one of --baseline, --download-only, --shard, and --merge may be given"
         )
-        out_dir = Path(args.ds_name.replace(" ", "-"))
-        out_dir.mkdir()
-
-        logger.info(f"Downloading dataset {args.ds_name} to {out_dir}")
-        ds = download_dataset(client, args.ds_name, out_dir)
-
-        with portal_client_manager(lambda _: client):
-            logger.info("Filtering dataset with")
-            ds = filter_dataset(ds, args.nprocs, args.chunksize, out_dir)
+    configure(args.events)
+
+    sharded = args.shard is not None or args.merge is not None
+    # the shards may run at the same time on different nodes, so they and the
+    # merge only read the records fetched by --download-only from the cache
+    client = PersistentPortalClient(
+        QCA_ADDRESS,
+        args.qca_cache_dir,
+        args.offline,
+        read_only=sharded,
+    )
+    out_dir = Path(args.ds_name.replace(" ", "-"))
+    # rebuilding from the cache, resuming, and the steps of a sharded run all
+    # write into an existing dataset directory
+    out_dir.mkdir(exist_ok=args.offline or args.resume or args.download_only or sharded)
+
+    cache_file = out_dir / "cache.json"
+    if args.shard is not None:
+        cache_file = fragment_path(cache_file, *args.shard)
+
+    logger.info(f"Downloading dataset {args.ds_name} to {out_dir}")
+    with stage("download"):
+        if not sharded:
+            ds = download_dataset(client, args.ds_name, out_dir, args.qca_cache_dir)
+        else:
+            # the dataset on the server may change while the shards run,
+            # so every shard and the merge use the same snapshot of it
+            ds = read_snapshot(out_dir)
+        if args.shard is not None:
+            ds = select_entries(ds, shard_entries(ds, *args.shard))
+            print(
+                f"shard {args.shard[0]}/{args.shard[1]} has {ds.n_results} records",
+                flush=True,
+            )
 
-            logger.info("Converting dataset to yammbs input format")
-            ds = QCArchiveDataset.from_qcsubmit_collection(ds)
-            with open(out_dir / "cache.json", "w") as out:
-                out.write(ds.model_dump_json())
+    if args.download_only:
+        with stage("download_records"), portal_client_manager(lambda _: client):
+            fetch_records(ds)
+        return
+
+    if args.merge is not None:
+        with stage("merge"):
+            _, ds = merge_shards(ds, args.merge, out_dir)
+            write_dataset(ds, cache_file)
+        # the shards read the records fetched by --download-only from the
+        # cache, so only evict once they have all been merged
+        evict(args.qca_cache_dir, args.qca_cache_size)
+        return
+
+    journal = journal_path(out_dir, args.shard)
+    if not args.resume and journal.exists():
+        logger.info(f"deleting {journal} from an earlier run")
+        journal.unlink()
+
+    with portal_client_manager(lambda _: client):
+        logger.info("Filtering dataset")
+        with stage("filter"):
+            if args.baseline is None:
+                ds = filter_dataset(
+                    ds,
+                    args.nprocs,
+                    args.chunksize,
+                    out_dir,
+                    limits_from_args(args),
+                    args.shard,
+                )
+            else:
+                ds, refiltered = filter_incrementally(
+                    ds,
+                    args.baseline,
+                    args.nprocs,
+                    args.chunksize,
+                    out_dir,
+                    limits_from_args(args),
+                )
+
+        logger.info("Converting dataset to yammbs input format")
+        with stage("convert"):
+            if args.baseline is None:
+                ds = QCArchiveDataset.from_qcsubmit_collection(ds)
+            else:
+                ds = convert_incrementally(ds, refiltered, args.baseline)
+            write_dataset(ds, cache_file)
+
+    # a shard leaves evicting to the merge, once every shard has finished
+    if args.shard is None:
+        evict(args.qca_cache_dir, args.qca_cache_size)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 #!/bin/bash
 
 # Usage:
-# ./submit.sh [-h] [-d] [-t CPU_HOURS] [-m GB_MEMORY] [-n NCPUS] [-c CHUNKSIZE] DS_NAME
+# ./submit.sh [-h] [-d] [-t CPU_HOURS] [-m GB_MEMORY] [-n NCPUS] [-c CHUNKSIZE] \
+#     [-a NSHARDS] DS_NAME
 #
 # The required argument DS_NAME should be the name of an optimization dataset on
 # QCArchive. The other optional flags control job submission and are described
@@ -15,10 +16,22 @@
 # -n The number of CPUs to request via the SBATCH --cpus-per-task flag, defaults
 #    to 16
 # -c The chunk size to pass to download_and_filter_dataset.py, defaults to 32
+# -a Split the filtering into a job array of NSHARDS tasks, each running
+#    download_and_filter_dataset.py --shard on its own node with the resources
+#    above. The array waits for a single-CPU job that downloads the dataset
+#    with --download-only, and is followed by a single-CPU job that waits for
+#    all of the shards and merges their results with --merge. The download and
+#    merge jobs request io_hours CPU hours and io_mem GB of RAM, set below,
+#    instead of the -t and -m limits
 #
-# Slurm output is saved to logs/$date.$pid.out
+# Slurm output is saved to logs/$date.$pid.out, or to
+# logs/$date.$pid-download.out for the download, logs/$date.$pid-$i.out for
+# each shard, and logs/$date.$pid-merge.out for the merge of a job array
+#
+# Jobs are requeued if they are preempted, and a requeued job resumes from the
+# ChargeCheck journal written by the interrupted one.
 
-usage="Usage: $0 [-h] [-d] [-t CPU_HOURS] [-m GB_MEMORY] [-n NCPUS] [-c CHUNKSIZE] DS_NAME"
+usage="Usage: $0 [-h] [-d] [-t CPU_HOURS] [-m GB_MEMORY] [-n NCPUS] [-c CHUNKSIZE] [-a NSHARDS] DS_NAME"
 
 case $# in
 	0) echo 'error: no arguments provided'
@@ -32,8 +45,13 @@ mem=96
 cmd=sbatch
 ncpus=16
 chunksize=32
+nshards=
+
+# limits for the single-CPU download and merge jobs of a job array
+io_hours=24
+io_mem=16
 
-while getopts "hdt:m:n:c:" arg
+while getopts "hdt:m:n:c:a:" arg
 do
 	case $arg in
 		h) echo $usage
@@ -43,6 +61,7 @@ do
 		m) mem=$OPTARG;;
 		n) ncpus=$OPTARG;;
 		c) chunksize=$OPTARG;;
+		a) nshards=$OPTARG;;
 	esac
 done
 
@@ -53,25 +72,24 @@ ds_name=${1?No dataset name provided}
 day=$(date +%Y-%m-%d)
 pid=$$
 
-logfile=logs/$day.$pid.out
-
-echo requesting $hours CPU hours, $mem GB RAM, and $ncpus CPUs for cmd:
-echo $*
-echo saving slurm output to
-echo $logfile
-
-$cmd <<INP
+# print a batch script for the job named $1 with $2 CPUs, $3 hours, and $4 GB
+# of RAM, the extra #SBATCH lines in $5, and the download_and_filter_dataset.py
+# arguments in $6
+batch_script() {
+cat <<INP
 #!/bin/bash
-#SBATCH -J filter-dataset
+#SBATCH -J $1
 #SBATCH -p standard
-#SBATCH -t ${hours}:00:00
+#SBATCH -t $3:00:00
 #SBATCH --nodes=1
-#SBATCH --cpus-per-task=${ncpus}
-#SBATCH --mem=${mem}gb
+#SBATCH --cpus-per-task=$2
+#SBATCH --mem=$4gb
 #SBATCH --account dmobley_lab
 #SBATCH --export ALL
 #SBATCH --constraint=fastscratch
-#SBATCH --output=${logfile}
+#SBATCH --requeue
+#SBATCH --open-mode=append
+$5
 
 date
 hostname
@@ -86,7 +104,53 @@ echo
 
 echo \$OE_LICENSE
 
-python download_and_filter_dataset.py --nprocs ${ncpus} --chunksize ${chunksize} ${ds_name}
+PYTHONPATH=.. python download_and_filter_dataset.py $6 "${ds_name}"
 
 date
 INP
+}
+
+filter_args="--nprocs ${ncpus} --chunksize ${chunksize} \\
+	--memory-budget $((mem * 1024 * 9 / 10)) --resume"
+
+if [ -z "$nshards" ]; then
+	logfile=logs/$day.$pid.out
+	echo requesting $hours CPU hours, $mem GB RAM, and $ncpus CPUs for cmd:
+	echo $*
+	echo saving slurm output to
+	echo $logfile
+
+	batch_script filter-dataset $ncpus $hours $mem "#SBATCH --output=${logfile}" \
+		"$filter_args" | $cmd
+	exit
+fi
+
+echo requesting $nshards shards with $hours CPU hours, $mem GB RAM, and \
+	$ncpus CPUs each for cmd:
+echo $*
+echo saving slurm output to
+echo logs/$day.$pid-download.out, logs/$day.$pid-\{1..$nshards\}.out, and \
+	logs/$day.$pid-merge.out
+
+# submit the batch script $2, or print it for a dry run, and set jobid to the
+# ID of the submitted job, or to the placeholder $1 for a dry run
+submit() {
+	if [ $cmd = cat ]; then
+		echo "$2"
+		jobid=$1
+	else
+		jobid=$(echo "$2" | sbatch --parsable) || exit 1
+		echo submitted job $jobid
+	fi
+}
+
+submit DOWNLOAD_JOB_ID "$(batch_script download-dataset 1 $io_hours $io_mem \
+	"#SBATCH --output=logs/$day.$pid-download.out" "--download-only")"
+
+submit ARRAY_JOB_ID "$(batch_script filter-dataset $ncpus $hours $mem "#SBATCH --array=1-${nshards}
+#SBATCH --dependency=afterok:${jobid}
+#SBATCH --output=logs/$day.$pid-%a.out" \
+	"$filter_args --shard \$SLURM_ARRAY_TASK_ID/${nshards}")"
+
+batch_script merge-dataset 1 $io_hours $io_mem "#SBATCH --dependency=afterok:${jobid}
+#SBATCH --output=logs/$day.$pid-merge.out" "--merge ${nshards}" | $cmd
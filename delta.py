@@ -0,0 +1,158 @@
+"""Delta benchmarking against a baseline force field.
+
+Many submissions only change a handful of parameters relative to an earlier
+force field, so most molecules end up with exactly the same parameters and
+charges and would minimize to exactly the same MM conformers. When a
+submission's config names a ``baseline_forcefield`` and a ``baseline_dir``
+holding the sqlite stores from a run with that force field, ``main.py`` labels
+every molecule with both force fields, and copies the baseline's MM conformers
+for the molecules whose assignments are identical into the new store before
+minimizing. Only the affected molecules are then minimized, and the metrics
+are computed over the combined set as usual.
+
+Assignments are compared by parameter values, ignoring SMIRKS patterns and
+IDs, so renaming or reordering parameters doesn't count as a change. Any
+change to the attributes of a handler itself, such as a cutoff, a scaling
+factor, or the charge model, affects every molecule.
+"""
+
+from multiprocessing import Pool
+from pathlib import Path
+
+from openff.toolkit import ForceField, Molecule
+from tqdm import tqdm
+
+# per-process state set up by _init_worker
+_worker = dict()
+
+
+def load_force_field(force_field) -> ForceField:
+    return ForceField(force_field, allow_cosmetic_attributes=True)
+
+
+def handler_attributes(force_field: ForceField) -> dict[str, dict]:
+    """Return the attributes of each parameter handler in ``force_field``,
+    excluding their parameters."""
+    ret = dict()
+    for name in force_field.registered_parameter_handlers:
+        handler = force_field.get_parameter_handler(name)
+        data = handler.to_dict(discard_cosmetic_attributes=True)
+        if handler._INFOTYPE is not None:
+            data.pop(handler._INFOTYPE._ELEMENT_NAME, None)
+        ret[name] = data
+    return ret
+
+
+def changed_handlers(force_field: ForceField, baseline: ForceField) -> set[str]:
+    """Return the names of the handlers whose own attributes differ between
+    ``force_field`` and ``baseline``, including those missing from either."""
+    new, old = handler_attributes(force_field), handler_attributes(baseline)
+    return {name for name in new.keys() | old.keys() if new.get(name) != old.get(name)}
+
+
+def assignments(force_field: ForceField, molecule: Molecule) -> dict[str, dict]:
+    """Return the values of the parameters ``force_field`` assigns to each
+    group of atoms in ``molecule``, by handler."""
+    labels = force_field.label_molecules(molecule.to_topology())[0]
+    ret = dict()
+    for name, assigned in labels.items():
+        ret[name] = dict()
+        for atoms, parameter in assigned.items():
+            values = parameter.to_dict(discard_cosmetic_attributes=True)
+            values.pop("smirks", None)
+            values.pop("id", None)
+            ret[name][atoms] = values
+    return ret
+
+
+def _init_worker(force_field, baseline):
+    _worker["force_field"] = load_force_field(force_field)
+    _worker["baseline"] = load_force_field(baseline)
+
+
+def _is_affected(item):
+    inchi_key, mapped_smiles = item
+    molecule = Molecule.from_mapped_smiles(mapped_smiles, allow_undefined_stereo=True)
+    return inchi_key, assignments(_worker["force_field"], molecule) != assignments(
+        _worker["baseline"], molecule
+    )
+
+
+def affected_molecules(
+    store, force_field, baseline, n_processes, chunksize=16
+) -> set[str]:
+    """Return the InChI keys of the molecules in the ``MoleculeStore``
+    ``store`` that are assigned different parameters by ``force_field`` and
+    the ``baseline`` force field."""
+    inchi_keys = store.get_inchi_keys()
+    if changed_handlers(load_force_field(force_field), load_force_field(baseline)):
+        return set(inchi_keys)
+
+    items = [
+        (
+            inchi_key,
+            store.get_smiles_by_molecule_id(
+                store.get_molecule_id_by_inchi_key(inchi_key)
+            ),
+        )
+        for inchi_key in inchi_keys
+    ]
+    ret = set()
+    with Pool(
+        processes=n_processes,
+        initializer=_init_worker,
+        initargs=(force_field, baseline),
+    ) as pool:
+        for inchi_key, affected in tqdm(
+            pool.imap(_is_affected, items, chunksize=chunksize),
+            total=len(items),
+            desc=f"Comparing {Path(force_field).name} with {Path(baseline).name}",
+        ):
+            if affected:
+                ret.add(inchi_key)
+    return ret
+
+
+def copy_baseline(src, dst, force_field, baseline, skip, qcarchive_ids=None) -> int:
+    """Copy the MM conformers for ``baseline`` in the ``MoleculeStore`` ``src``
+    to ``dst``, stored as results for ``force_field``, for every molecule
+    except those whose InChI keys are in ``skip``. Only the records in
+    ``qcarchive_ids`` are copied if it is given. Molecules are matched by InChI
+    key and conformers by QCArchive ID, so the stores don't need to have been
+    built from the same dataset, and records already in ``dst`` are left
+    alone. Returns the number of conformers copied."""
+    src_ids = {
+        inchi_key: src.get_molecule_id_by_inchi_key(inchi_key)
+        for inchi_key in src.get_inchi_keys()
+    }
+    n = 0
+    with dst._get_session() as db:
+        for inchi_key in dst.get_inchi_keys():
+            if inchi_key in skip or inchi_key not in src_ids:
+                continue
+            molecule_id = dst.get_molecule_id_by_inchi_key(inchi_key)
+            qm_ids = {
+                record.qcarchive_id
+                for record in dst.get_qm_conformer_records_by_molecule_id(molecule_id)
+            }
+            done = {
+                record.qcarchive_id
+                for record in dst.get_mm_conformer_records_by_molecule_id(
+                    molecule_id, force_field
+                )
+            }
+            for record in src.get_mm_conformer_records_by_molecule_id(
+                src_ids[inchi_key], baseline
+            ):
+                i = record.qcarchive_id
+                if i not in qm_ids or i in done:
+                    continue
+                if qcarchive_ids is not None and i not in qcarchive_ids:
+                    continue
+                db.store_mm_conformer_record(
+                    record.model_copy(
+                        update=dict(molecule_id=molecule_id, force_field=force_field)
+                    )
+                )
+                n += 1
+    return n
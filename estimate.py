@@ -0,0 +1,188 @@
+"""Estimate the run time, memory, and cost of an optimization benchmark before
+dispatching it.
+
+Usage:
+    python estimate.py [--timing-history GLOB] [--shards N] [--instance TYPE ...]
+        path/to/config.yaml
+
+This reads the datasets and force fields in the submission's config file,
+summarizes the size of the molecules to be minimized, and predicts the wall
+time, peak memory, and cost of minimizing them on each instance type, assuming
+``main.py`` is run with one process per vCPU.
+
+Predictions are based on the ``timings.csv`` files from previous submissions:
+the cost of each conformer comes from ``schedule.estimate_costs``, and the
+wall time is the makespan of the longest-first schedule ``main.py`` uses over
+that many workers. Peak memory is the largest worker footprint recorded in the
+history times the number of workers, plus some room for the parent process.
+Only the minimizations are covered, not building the store or computing
+metrics.
+"""
+
+import argparse
+from collections import namedtuple
+
+import numpy
+
+from config import Config
+from ingest import iter_entries
+from schedule import HISTORY_GLOB, estimate_costs, history_timings, wall_times
+from shard import conformer_cost, n_atoms, partition
+
+# vCPUs, memory in GiB, and approximate on-demand price in USD per hour in
+# us-east-1
+INSTANCES = {
+    "c6a.2xlarge": (8, 16, 0.306),
+    "c6a.4xlarge": (16, 32, 0.612),
+    "c6a.8xlarge": (32, 64, 1.224),
+    "c6a.12xlarge": (48, 96, 1.836),
+    "c6a.16xlarge": (64, 128, 2.448),
+    "c6a.24xlarge": (96, 192, 3.672),
+    "c6a.32xlarge": (128, 256, 4.896),
+    "c6a.48xlarge": (192, 384, 7.344),
+}
+
+# memory in MiB assumed for each worker when the history doesn't record it,
+# and set aside for the parent process, which holds every input in memory
+WORKER_MEMORY = 1024
+PARENT_MEMORY = 2048
+
+Entry = namedtuple("Entry", ["qcarchive_id", "mapped_smiles", "force_field"])
+
+
+def load_entries(datasets, force_fields) -> list[Entry]:
+    """Return an ``Entry`` for minimizing each QM conformer in ``datasets``
+    with each of ``force_fields``."""
+    return [
+        Entry(entry["qcarchive_id"], entry["mapped_smiles"], force_field)
+        for dataset in datasets
+        for entry in iter_entries(dataset, "qm_molecules")
+        for force_field in force_fields
+    ]
+
+
+def makespan(costs, n_processes) -> float:
+    """Return the time taken to run tasks with ``costs`` on ``n_processes``
+    workers, handing out the most expensive tasks first."""
+    bins = partition(dict(enumerate(costs)), n_processes)
+    return max(sum(costs[k] for k in b) for b in bins)
+
+
+def shard_costs(entries, costs, count) -> list[list[float]]:
+    """Split ``costs`` into the ``count`` shards that ``main.py --shard`` would
+    assign ``entries`` to.
+
+    This treats every dataset as a single store, so it is only approximate
+    for submissions with more than one dataset."""
+    keys = {
+        (0, entry.qcarchive_id): conformer_cost(entry.mapped_smiles)
+        for entry in entries
+    }
+    by_key = dict()
+    for entry, cost in zip(entries, costs):
+        by_key.setdefault((0, entry.qcarchive_id), list()).append(cost)
+    return [
+        [cost for key in shard for cost in by_key[key]]
+        for shard in partition(keys, count)
+    ]
+
+
+def worker_memory(history) -> float:
+    """Return the largest peak memory of a single worker in ``history``, in
+    MiB, or ``WORKER_MEMORY`` if it wasn't recorded."""
+    if "max_rss" not in history or history["max_rss"].isna().all():
+        return WORKER_MEMORY
+    return history["max_rss"].max()
+
+
+def summarize(entries) -> str:
+    """Describe the conformers, molecules, and force fields in ``entries``,
+    which has an ``Entry`` for each minimization."""
+    smiles = {entry.qcarchive_id: entry.mapped_smiles for entry in entries}
+    atoms = numpy.array([n_atoms(s) for s in smiles.values()])
+    molecules = len(set(smiles.values()))
+    force_fields = list(dict.fromkeys(entry.force_field for entry in entries))
+    lines = [
+        f"{len(smiles)} conformers of {molecules} molecules, to be minimized "
+        f"with {len(force_fields)} force field(s): {', '.join(force_fields)}, "
+        f"for {len(entries)} minimizations in total",
+        f"atoms per molecule: min {atoms.min()}, median "
+        f"{numpy.median(atoms):.0f}, 90th percentile "
+        f"{numpy.percentile(atoms, 90):.0f}, max {atoms.max()}",
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    a = argparse.ArgumentParser(
+        prog="python estimate.py",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    a.add_argument("config", help="Path to the submission's input YAML file")
+    a.add_argument(
+        "--timing-history",
+        default=HISTORY_GLOB,
+        help="Glob pattern for timings.csv files from previous runs. Defaults "
+        "to %(default)s",
+    )
+    a.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="The number of shards the run will be split into, each on its "
+        "own instance. Defaults to %(default)d",
+    )
+    a.add_argument(
+        "--instance",
+        action="append",
+        choices=INSTANCES,
+        help="Only estimate for this instance type. May be repeated",
+    )
+    args = a.parse_args()
+
+    conf = Config.from_file(args.config)
+    entries = load_entries(conf.datasets, conf.forcefields)
+    if not entries:
+        a.exit(1, "no conformers found in the submission's datasets\n")
+    print(summarize(entries))
+
+    history = history_timings(args.timing_history)
+    if history.empty:
+        a.exit(
+            1,
+            f"no timings found matching {args.timing_history}, so run times "
+            "can't be estimated\n",
+        )
+    known = wall_times(history)
+    costs = estimate_costs(entries, known)
+    recorded = sum(
+        (entry.qcarchive_id, entry.force_field) in known for entry in entries
+    )
+    print(
+        f"{recorded} of {len(entries)} minimizations have recorded timings in "
+        f"{len(known)} previous minimizations"
+    )
+
+    # every force field is minimized in the same pool
+    shards = shard_costs(entries, costs, args.shards)
+    worker = worker_memory(history)
+
+    print()
+    print(
+        f"{'instance':>14} {'vCPUs':>6} {'hours':>8} {'peak GiB':>9} "
+        f"{'RAM GiB':>8} {'cost USD':>9}"
+    )
+    for name in args.instance or INSTANCES:
+        vcpus, memory, price = INSTANCES[name]
+        hours = max(makespan(shard, vcpus) for shard in shards) / 3600
+        peak = (vcpus * worker + PARENT_MEMORY) / 1024
+        warning = "  (exceeds memory)" if peak > memory else ""
+        print(
+            f"{name:>14} {vcpus:>6} {hours:>8.2f} {peak:>9.1f} {memory:>8} "
+            f"{hours * price * args.shards:>9.2f}{warning}"
+        )
+
+
+if __name__ == "__main__":
+    main()
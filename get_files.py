@@ -19,6 +19,7 @@ def maybe_print(path):
 
 
 conf = Config.from_file(sys.argv[1])
-maybe_print(conf.forcefield)
+for ff in conf.forcefields:
+    maybe_print(ff)
 for ds in conf.datasets:
     maybe_print(ds)
@@ -0,0 +1,118 @@
+"""Streaming ingestion of yammbs input datasets into sqlite stores.
+
+Loading a dataset with ``model_validate_json(inp.read())`` holds both the raw
+JSON string and the fully validated pydantic model in memory before anything
+is written to the store. The functions here instead parse the entries of the
+dataset one at a time with ijson and add them to the store in batches. Peak
+memory is therefore bounded by the batch size rather than the size of the
+dataset.
+
+The yammbs constructors, ``MoleculeStore.from_qcarchive_dataset`` and
+``TorsionStore.from_torsion_dataset``, refuse to write to a database that
+already exists, so they are only used to create an empty store. Each batch is
+then validated as a small dataset and inserted through the store's session in
+a single transaction, the same way the constructors insert a whole dataset.
+Like ``minimize.store_conformers``, this uses the private ``_get_session``
+method of the stores, since yammbs has no public way to add QM data to an
+existing store. Datasets may also be given as packs, described in
+dataset_pack.py, which are read one compressed chunk at a time.
+"""
+
+from itertools import batched
+
+import ijson
+from openff.toolkit import Molecule
+from yammbs import MoleculeStore
+from yammbs.inputs import QCArchiveDataset
+from yammbs.models import QMConformerRecord
+from yammbs.torsion import TorsionStore
+from yammbs.torsion.inputs import QCArchiveTorsionDataset
+from yammbs.torsion.models import QMTorsionPointRecord, TorsionRecord
+
+from dataset_pack import PackedDataset, is_packed
+
+# number of dataset entries to validate and insert at a time
+BATCH_SIZE = 1000
+
+
+def iter_entries(dataset, key):
+    """Yield the entries of the list ``key`` in the JSON file or pack
+    ``dataset`` one at a time as plain dicts."""
+    if is_packed(dataset):
+        with PackedDataset(dataset) as packed:
+            if packed.list_key != key:
+                raise ValueError(f"{dataset} holds {packed.list_key}, not {key}")
+            yield from packed
+        return
+    with open(dataset, "rb") as inp:
+        yield from ijson.items(inp, f"{key}.item", use_float=True)
+
+
+def store_molecules(store, dataset):
+    """Add the molecules in the ``QCArchiveDataset`` ``dataset`` to the
+    ``MoleculeStore`` ``store`` in a single transaction."""
+    with store._get_session() as db:
+        for qm_molecule in dataset.qm_molecules:
+            db.store_qcarchive(
+                QMConformerRecord(
+                    molecule_id="placeholder",
+                    qcarchive_id=qm_molecule.qcarchive_id,
+                    mapped_smiles=qm_molecule.mapped_smiles,
+                    coordinates=qm_molecule.coordinates,
+                    energy=qm_molecule.final_energy,
+                )
+            )
+
+
+def store_torsions(store, dataset):
+    """Add the torsion drives in the ``QCArchiveTorsionDataset`` ``dataset``
+    to the ``TorsionStore`` ``store`` in a single transaction."""
+    with store._get_session() as db:
+        for qm_torsion in dataset.qm_torsions:
+            molecule = Molecule.from_mapped_smiles(
+                qm_torsion.mapped_smiles, allow_undefined_stereo=True
+            )
+            db.store_torsion_record(
+                TorsionRecord(
+                    mapped_smiles=qm_torsion.mapped_smiles,
+                    inchi_key=molecule.to_inchi(fixed_hydrogens=True),
+                    dihedral_indices=qm_torsion.dihedral_indices,
+                )
+            )
+            for angle in qm_torsion.coordinates:
+                db.store_qm_torsion_point(
+                    QMTorsionPointRecord(
+                        molecule_id=qm_torsion.id,
+                        grid_id=angle,
+                        coordinates=qm_torsion.coordinates[angle],
+                        energy=qm_torsion.energies[angle],
+                    )
+                )
+
+
+def stream_molecule_store(dataset, sqlite_file, batch_size=BATCH_SIZE):
+    """Ingest the ``QCArchiveDataset`` JSON file ``dataset`` into a new
+    ``MoleculeStore`` at ``sqlite_file``, ``batch_size`` molecules at a
+    time."""
+    store = MoleculeStore.from_qcarchive_dataset(
+        QCArchiveDataset(qm_molecules=list()), sqlite_file
+    )
+    n = 0
+    for batch in batched(iter_entries(dataset, "qm_molecules"), batch_size):
+        store_molecules(store, QCArchiveDataset(qm_molecules=list(batch)))
+        n += len(batch)
+        print(f"ingested {n} molecules from {dataset}", flush=True)
+
+
+def stream_torsion_store(dataset, sqlite_file, batch_size=BATCH_SIZE):
+    """Ingest the ``QCArchiveTorsionDataset`` JSON file ``dataset`` into a new
+    ``TorsionStore`` at ``sqlite_file``, ``batch_size`` torsion drives at a
+    time."""
+    store = TorsionStore.from_torsion_dataset(
+        QCArchiveTorsionDataset(qm_torsions=list()), sqlite_file
+    )
+    n = 0
+    for batch in batched(iter_entries(dataset, "qm_torsions"), batch_size):
+        store_torsions(store, QCArchiveTorsionDataset(qm_torsions=list(batch)))
+        n += len(batch)
+        print(f"ingested {n} torsion drives from {dataset}", flush=True)
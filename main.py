@@ -1,8 +1,11 @@
 # Usage:
-# python main2.py path/to/config.yaml ncpus
+# python main.py [--cache-dir CACHE_DIR] [--resume] [--checkpoint-interval SEC] \
+#     [--shard i/N] [--timing-history GLOB] [--max-tasks-per-worker N] \
+#     [--max-worker-rss MIB] [--memory-budget MIB] [--events PATH] \
+#     path/to/config.yaml ncpus
 
+import argparse
 import os
-import sys
 import time
 from pathlib import Path
 
@@ -11,72 +14,283 @@ if True:  # to prevent future reordering around this import
 
 from openff.toolkit.utils import OpenEyeToolkitWrapper
 from yammbs import MoleculeStore
-from yammbs.inputs import QCArchiveDataset
 
 from config import Config
+from delta import affected_molecules, copy_baseline
+from ingest import stream_molecule_store
+from mempool import add_limit_arguments, limits_from_args
+from metrics import compute_metrics, identifiers, write_csvs, write_table
+from minimize import CHECKPOINT_INTERVAL, conformer_costs, optimize_mm
+from schedule import HISTORY_GLOB, load_history
+from shard import fragment_path, parse_shard, select
+from store_cache import clone_store
+from telemetry import add_events_argument, configure, stage
+from timings import load_timings, sidecar_path, write_timings
 
 assert OpenEyeToolkitWrapper().is_available()
 
 
-def make_csvs(store, forcefield, out_dir):
-    print("getting DDEs")
-    store.get_dde(forcefield, skip_check=True).to_csv(f"{out_dir}/dde.csv")
-    print("getting RMSDs")
-    store.get_rmsd(forcefield, skip_check=True).to_csv(f"{out_dir}/rmsd.csv")
-    print("getting TFDs")
-    store.get_tfd(forcefield, skip_check=True).to_csv(f"{out_dir}/tfd.csv")
-    print("getting internal coordinate RMSDs")
-    store.get_internal_coordinate_rmsd(forcefield, skip_check=True).to_csv(
-        f"{out_dir}/icrmsd.csv"
-    )
+def build_store(dataset, sqlite_file):
+    """Ingest the cached ``QCArchiveDataset`` in ``dataset`` into a new
+    ``MoleculeStore`` at ``sqlite_file``."""
+    print(f"loading cached dataset from {dataset}", flush=True)
+    stream_molecule_store(dataset, sqlite_file)
+
 
+def dataset_runs(datasets, shard=None) -> list[tuple[str, str, str | None]]:
+    """Return a ``(dataset, sqlite_file, name)`` tuple for each of
+    ``datasets``.
 
-def _main(forcefield, dataset, sqlite_file, out_dir, procs, invalidate_cache):
-    if invalidate_cache and os.path.exists(sqlite_file):
-        os.remove(sqlite_file)
-    if os.path.exists(sqlite_file):
-        print(f"loading existing database from {sqlite_file}", flush=True)
-        store = MoleculeStore(sqlite_file)
+    A single dataset uses ``tmp.sqlite`` and has no name, so its results are
+    written directly to the output directory. With multiple datasets, each one
+    gets its own store and is named after the directory containing the dataset
+    file, or after the directory and the file name if those are not unique.
+    If ``shard`` is given, the sqlite files are replaced by the fragment paths
+    for that shard."""
+    if len(datasets) == 1:
+        runs = [(datasets[0], "tmp.sqlite", None)]
     else:
-        print(f"loading cached dataset from {dataset}", flush=True)
-        with open(dataset) as inp:
-            crc = QCArchiveDataset.model_validate_json(inp.read())
-        store = MoleculeStore.from_qcarchive_dataset(crc, sqlite_file)
+        names = [Path(ds).parent.name for ds in datasets]
+        if len(set(names)) < len(names):
+            names = [f"{Path(ds).parent.name}-{Path(ds).stem}" for ds in datasets]
+        runs = [(ds, f"tmp-{name}.sqlite", name) for ds, name in zip(datasets, names)]
+
+    if shard is not None:
+        runs = [
+            (ds, str(fragment_path(sqlite_file, *shard)), name)
+            for ds, sqlite_file, name in runs
+        ]
+
+    return runs
+
+
+def forcefield_names(forcefields) -> dict[str, str]:
+    """Return the name of the results subdirectory for each of
+    ``forcefields``.
+
+    Force fields are named after their file stem, or after the directory and
+    the file stem if those are not unique. A ``ValueError`` is raised if the
+    names are still not unique, rather than letting one force field's results
+    overwrite another's."""
+    names = [Path(ff).stem for ff in forcefields]
+    if len(set(names)) < len(names):
+        names = [f"{Path(ff).parent.name}-{Path(ff).stem}" for ff in forcefields]
+    if len(set(names)) < len(names):
+        raise ValueError(
+            f"force fields must have unique file names: {', '.join(forcefields)}"
+        )
+    return dict(zip(forcefields, names))
+
+
+def result_dir(out_dir, forcefields, forcefield, dataset_name) -> Path:
+    """Return the directory for the results of ``forcefield`` on the dataset
+    named ``dataset_name``.
+
+    When benchmarking several force fields, each gets a subdirectory of
+    ``out_dir`` named by ``forcefield_names``, and each named dataset gets a
+    subdirectory below that."""
+    ret = Path(out_dir)
+    if len(forcefields) > 1:
+        ret /= forcefield_names(forcefields)[forcefield]
+    if dataset_name is not None:
+        ret /= dataset_name
+    return ret
+
+
+def apply_baseline(
+    stores, sqlite_files, forcefields, baseline, baseline_dir, procs, shard=None
+):
+    """Copy the MM conformers for the ``baseline`` force field from the stores
+    in ``baseline_dir`` into ``stores`` for each of ``forcefields``, skipping
+    any molecules whose parameters differ between the two force fields.
+
+    ``baseline_dir`` should hold the sqlite files from a run on the same
+    datasets, with the names in ``sqlite_files`` given by ``dataset_runs``.
+    When running a ``shard``, only the conformers assigned to it are copied,
+    so the fragments can still be merged."""
+    selected = None
+    if shard is not None:
+        selected = select(conformer_costs(stores), *shard)
+
+    for i, (store, sqlite_file) in enumerate(zip(stores, sqlite_files)):
+        src = Path(baseline_dir) / sqlite_file
+        if not src.exists():
+            print(f"no baseline store at {src}, minimizing everything", flush=True)
+            continue
+        qcarchive_ids = None
+        if selected is not None:
+            qcarchive_ids = {j for k, j in selected if k == i}
+        for forcefield in forcefields:
+            affected = affected_molecules(store, forcefield, baseline, procs)
+            n = copy_baseline(
+                MoleculeStore(str(src)),
+                store,
+                forcefield,
+                baseline,
+                affected,
+                qcarchive_ids,
+            )
+            print(
+                f"{len(affected)} molecules affected by the changes from "
+                f"{baseline} to {forcefield}, copied {n} conformers from {src}",
+                flush=True,
+            )
+
 
-    print("started optimizing store", flush=True)
+def _main(
+    forcefields,
+    datasets,
+    out_dir,
+    procs,
+    invalidate_cache,
+    cache_dir=None,
+    checkpoint_interval=CHECKPOINT_INTERVAL,
+    shard=None,
+    history=HISTORY_GLOB,
+    baseline=None,
+    baseline_dir=None,
+    limits=None,
+):
+    runs = dataset_runs(datasets, shard)
+    # check for clashing result directories before minimizing anything
+    forcefield_names(forcefields)
+
+    stores = list()
+    with stage("stores"):
+        for dataset, sqlite_file, _ in runs:
+            if invalidate_cache or not os.path.exists(sqlite_file):
+                clone_store(dataset, sqlite_file, build_store, "molecule", cache_dir)
+                sidecar_path(sqlite_file).unlink(missing_ok=True)
+            else:
+                print(f"loading existing database from {sqlite_file}", flush=True)
+            stores.append(MoleculeStore(sqlite_file))
+
+    if baseline is not None:
+        with stage("baseline"):
+            apply_baseline(
+                stores,
+                [sqlite_file for _, sqlite_file, _ in dataset_runs(datasets)],
+                forcefields,
+                baseline,
+                baseline_dir,
+                procs,
+                shard,
+            )
+
+    print(
+        f"started optimizing {len(stores)} store(s) with "
+        f"{len(forcefields)} force field(s)",
+        flush=True,
+    )
     start = time.time()
-    store.optimize_mm(force_field=forcefield, n_processes=procs)
+    with stage("minimize"):
+        optimize_mm(
+            stores,
+            forcefields,
+            n_processes=procs,
+            checkpoint_interval=checkpoint_interval,
+            shard=shard,
+            cache_dir=cache_dir,
+            timing_files=[sidecar_path(sqlite_file) for _, sqlite_file, _ in runs],
+            history=load_history(history),
+            limits=limits,
+        )
     print(f"finished optimizing after {time.time() - start} sec")
 
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
+    if shard is not None:
+        fragments = ", ".join(sqlite_file for _, sqlite_file, _ in runs)
+        print(f"finished shard {shard[0]}/{shard[1]}, wrote {fragments}")
+        return
+
+    write_results(runs, forcefields, out_dir, procs, limits)
+
+
+def write_results(runs, forcefields, out_dir, procs, limits=None):
+    """Compute the metrics for each of ``forcefields`` on the store for each
+    of the ``runs`` from ``dataset_runs`` and write them to CSV files, along
+    with the minimization timings recorded for each store."""
+    for dataset, sqlite_file, name in runs:
+        print(f"computing metrics for {dataset}", flush=True)
+        start = time.time()
+        with stage("metrics", dataset=dataset):
+            results = compute_metrics(sqlite_file, forcefields, procs, limits=limits)
+        ids = identifiers(sqlite_file)
+        timings = load_timings(sidecar_path(sqlite_file))
+        print(f"finished computing metrics after {time.time() - start} sec")
+
+        for forcefield in forcefields:
+            ds_out_dir = result_dir(out_dir, forcefields, forcefield, name)
+            if not os.path.exists(ds_out_dir):
+                os.makedirs(ds_out_dir)
 
-    make_csvs(store, forcefield, out_dir)
+            print(f"writing {forcefield} results for {dataset} to {ds_out_dir}")
+            write_csvs(results[forcefield], ds_out_dir)
+            write_table(results[forcefield], ids, ds_out_dir)
+            write_timings(timings[timings["force_field"] == forcefield], ds_out_dir)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Not enough arguments")
-        exit(1)
+    a = argparse.ArgumentParser(prog="python main.py")
+    a.add_argument("config", help="Path to the submission's input YAML file")
+    a.add_argument("nprocs", type=int, help="Number of processes to use")
+    a.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory holding pristine stores for each dataset. Defaults "
+        "to $YDS_CACHE_DIR or ~/.cache/yammbs-dataset-submission",
+    )
+    a.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue from an existing sqlite file, only minimizing the "
+        "conformers without results for the force field",
+    )
+    a.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=CHECKPOINT_INTERVAL,
+        help="Seconds between commits of minimization results to the "
+        "database. Defaults to %(default)d",
+    )
+    a.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Only minimize shard i of N, given as i/N, writing the results "
+        "to a separate sqlite fragment. Combine the fragments with merge.py",
+    )
+    a.add_argument(
+        "--timing-history",
+        default=HISTORY_GLOB,
+        help="Glob pattern for timings.csv files from previous runs, used to "
+        "schedule the most expensive minimizations first. Defaults to "
+        "%(default)s",
+    )
+    add_limit_arguments(a)
+    add_events_argument(a)
+    args = a.parse_args()
+    configure(args.events)
 
-    conf = Config.from_file(sys.argv[1])
+    conf = Config.from_file(args.config)
 
-    ndatasets = len(conf.datasets)
-    if ndatasets == 0:
+    if len(conf.datasets) == 0:
         print("Must provide at least one dataset")
         exit(1)
-    if ndatasets > 1:
-        print("Only single dataset currently supported")
-        exit(1)
 
-    p = Path(sys.argv[1])
+    p = Path(args.config)
     out_dir = p.parent / "output"
 
     _main(
-        forcefield=conf.forcefield,
-        dataset=conf.datasets[0],
-        sqlite_file="tmp.sqlite",
+        forcefields=conf.forcefields,
+        datasets=conf.datasets,
         out_dir=out_dir,
-        procs=int(sys.argv[2]),
-        invalidate_cache=True,
+        procs=args.nprocs,
+        invalidate_cache=not args.resume,
+        cache_dir=args.cache_dir,
+        checkpoint_interval=args.checkpoint_interval,
+        shard=args.shard,
+        history=args.timing_history,
+        baseline=conf.baseline_forcefield,
+        baseline_dir=conf.baseline_dir,
+        limits=limits_from_args(args),
     )
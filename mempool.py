@@ -0,0 +1,359 @@
+"""A process pool that keeps its workers' memory use in check.
+
+Long runs show the memory of ``multiprocessing.Pool`` workers creeping up as
+they build and minimize system after system, and a single worker being
+OOM-killed takes the whole run down with it. ``MemoryBoundedPool`` is a small
+replacement for the parts of ``Pool`` used here, with three guardrails:
+
+* workers are recycled after ``max_tasks`` tasks, like ``maxtasksperchild``;
+* a worker whose resident memory exceeds ``max_rss`` MiB after a task is
+  replaced with a fresh one; and
+* if the total resident memory of the workers exceeds ``budget`` MiB, the pool
+  retires its largest worker and runs with one fewer process, adding it back
+  once memory use has dropped well below the budget again.
+
+If a worker dies anyway, its task is retried once on another worker. Items
+whose task fails twice are skipped so that the others can finish, but
+``imap_unordered`` then raises a ``RuntimeError`` once every other result has
+been yielded, so an incomplete run never looks like a successful one.
+Exceptions raised by the initializer are raised in the parent, as are those
+raised by ``fn``, and a worker that dies without a task also raises, since
+something other than the items killed it. Results are yielded in completion
+order, as by ``Pool.imap_unordered``, and the peak memory of each worker is
+reported when the pool is closed.
+
+Memory is read from ``/proc``, so the RSS and budget limits only work on
+Linux.
+"""
+
+import logging
+import multiprocessing
+import os
+import resource
+import statistics
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from itertools import batched
+from multiprocessing.connection import wait
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks of the workers' memory use while waiting for results
+MONITOR_INTERVAL = 1.0
+
+# fraction of physical memory used as the default budget
+BUDGET_FRACTION = 0.9
+
+# concurrency is only raised again once memory use drops below this fraction
+# of the budget, and at least this many seconds after it was last lowered
+RECOVER_FRACTION = 0.75
+RECOVER_DELAY = 60
+
+
+@dataclass
+class Limits:
+    """Memory limits for a ``MemoryBoundedPool``. ``max_rss`` and ``budget``
+    are in MiB, and ``budget`` defaults to 90% of physical memory."""
+
+    max_tasks: int | None = None
+    max_rss: float | None = None
+    budget: float | None = None
+
+
+def add_limit_arguments(parser):
+    """Add command line flags for each of the ``Limits`` to the
+    ``argparse.ArgumentParser`` ``parser``."""
+    parser.add_argument(
+        "--max-tasks-per-worker",
+        type=int,
+        default=None,
+        help="Replace each worker process after this many tasks",
+    )
+    parser.add_argument(
+        "--max-worker-rss",
+        type=float,
+        default=None,
+        help="Replace a worker process once its resident memory exceeds this many MiB",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        help="Run fewer worker processes while their combined resident "
+        "memory exceeds this many MiB. Defaults to 90%% of physical memory",
+    )
+
+
+def limits_from_args(args) -> Limits:
+    """Return the ``Limits`` given by the flags from ``add_limit_arguments``."""
+    return Limits(
+        max_tasks=args.max_tasks_per_worker,
+        max_rss=args.max_worker_rss,
+        budget=args.memory_budget,
+    )
+
+
+def rss(pid="self") -> float | None:
+    """Return the current resident memory of process ``pid`` in MiB, or
+    ``None`` if it can't be read."""
+    try:
+        with open(f"/proc/{pid}/statm") as inp:
+            pages = int(inp.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def default_budget() -> float | None:
+    """Return ``BUDGET_FRACTION`` of the physical memory in MiB, or ``None``
+    if it can't be determined."""
+    try:
+        total = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+    return BUDGET_FRACTION * total / 2**20
+
+
+def _work(conn, fn, initializer, initargs):
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except Exception as e:
+            conn.send(("error", None, e, rss(), None))
+            conn.close()
+            return
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        k, chunk = task
+        try:
+            msg = ("done", k, [fn(item) for item in chunk])
+        except Exception as e:
+            msg = ("error", k, e)
+        current = rss()
+        # ru_maxrss is in KiB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        try:
+            conn.send((*msg, current, peak))
+        except Exception as e:
+            # the result or exception couldn't be pickled
+            conn.send(("error", k, RuntimeError(repr(e)), current, peak))
+    conn.close()
+
+
+@dataclass
+class _Worker:
+    process: multiprocessing.Process
+    conn: object
+    task: tuple | None = None
+    done: int = 0
+    retiring: bool = False
+
+
+@dataclass
+class _Stats:
+    peak_rss: dict = field(default_factory=dict)
+    recycled: int = 0
+    lost: int = 0
+    min_processes: int = 0
+
+
+class MemoryBoundedPool:
+    """A pool of ``processes`` workers, each of which calls ``initializer``
+    with ``initargs`` when it starts, subject to ``limits``. Use it as a
+    context manager, like ``multiprocessing.Pool``."""
+
+    def __init__(self, processes, initializer=None, initargs=(), limits=None):
+        self.processes = processes or os.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.limits = limits or Limits()
+        self.budget = self.limits.budget or default_budget()
+        self.target = self.processes
+        self.stats = _Stats(min_processes=self.processes)
+        self._workers = dict()
+        self._lowered = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def _spawn(self, fn):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_work,
+            args=(child, fn, self.initializer, self.initargs),
+            daemon=True,
+        )
+        process.start()
+        child.close()
+        self._workers[process.pid] = _Worker(process, parent)
+
+    def _retire(self, pid, recycled=True):
+        worker = self._workers.pop(pid)
+        try:
+            worker.conn.send(None)
+        except OSError:
+            pass
+        worker.process.join()
+        worker.conn.close()
+        self.stats.recycled += recycled
+
+    def _check_budget(self):
+        """Lower the number of workers if their total memory is over budget,
+        or raise it again if it has fallen well below."""
+        if self.budget is None:
+            return
+        current = {pid: rss(pid) or 0.0 for pid in self._workers}
+        for pid, mem in current.items():
+            self.stats.peak_rss[pid] = max(self.stats.peak_rss.get(pid, 0.0), mem)
+        total = sum(current.values())
+        if total > self.budget and self.target > 1:
+            if any(w.retiring for w in self._workers.values()):
+                return
+            self.target -= 1
+            self.stats.min_processes = min(self.stats.min_processes, self.target)
+            self._lowered = time.time()
+            pid = max(current, key=current.get)
+            logger.warning(
+                f"workers using {total:.0f} MiB, over the budget of "
+                f"{self.budget:.0f} MiB, dropping to {self.target} processes"
+            )
+            self._workers[pid].retiring = True
+            if self._workers[pid].task is None:
+                self._retire(pid)
+        elif (
+            total < RECOVER_FRACTION * self.budget
+            and self.target < self.processes
+            and time.time() - self._lowered > RECOVER_DELAY
+        ):
+            self.target += 1
+            self._lowered = time.time()
+
+    def imap_unordered(self, fn, items, chunksize=1):
+        """Yield ``fn(item)`` for each of ``items``, in the order they
+        finish. Items are sent to the workers ``chunksize`` at a time.
+
+        Raises a ``RuntimeError`` at the end if any items were lost because
+        their task killed a worker twice."""
+        queue = deque(enumerate(batched(items, chunksize)))
+        attempts = defaultdict(int)
+        lost = self.stats.lost
+
+        while queue or any(w.task is not None for w in self._workers.values()):
+            busy = sum(w.task is not None for w in self._workers.values())
+            while len(self._workers) < min(self.target, busy + len(queue)):
+                self._spawn(fn)
+            for worker in self._workers.values():
+                if worker.task is None and not worker.retiring and queue:
+                    worker.task = queue.popleft()
+                    try:
+                        worker.conn.send(worker.task)
+                    except OSError:
+                        # the worker already exited, which is handled below
+                        pass
+
+            workers = list(self._workers.values())
+            wait(
+                [w.conn for w in workers] + [w.process.sentinel for w in workers],
+                timeout=MONITOR_INTERVAL,
+            )
+
+            for pid, worker in list(self._workers.items()):
+                try:
+                    if not worker.conn.poll():
+                        if worker.process.is_alive():
+                            continue
+                        raise EOFError
+                    status, k, result, current, peak = worker.conn.recv()
+                except (EOFError, OSError):
+                    self._died(pid, queue, attempts)
+                    continue
+
+                if status == "error":
+                    raise result
+                worker.task = None
+                worker.done += 1
+                self.stats.peak_rss[pid] = max(self.stats.peak_rss.get(pid, 0.0), peak)
+                yield from result
+
+                if (
+                    worker.retiring
+                    or len(self._workers) > self.target
+                    or (self.limits.max_tasks and worker.done >= self.limits.max_tasks)
+                    or (
+                        self.limits.max_rss
+                        and current is not None
+                        and current > self.limits.max_rss
+                    )
+                ):
+                    self._retire(pid)
+
+            self._check_budget()
+
+        lost = self.stats.lost - lost
+        if lost > 0:
+            raise RuntimeError(
+                f"{lost} item(s) lost when their tasks killed a worker twice"
+            )
+
+    def _died(self, pid, queue, attempts):
+        """Handle the unexpected death of worker ``pid``, retrying its task
+        once. With a memory budget, also run with one fewer process in case
+        it ran out of memory, until ``_check_budget`` raises the number
+        again."""
+        worker = self._workers.pop(pid)
+        worker.process.join()
+        code = worker.process.exitcode
+        if worker.task is None:
+            raise RuntimeError(
+                f"worker {pid} exited with code {code} without a task, "
+                "as when the pool's initializer crashes"
+            )
+        if self.budget is not None and self.target > 1:
+            self.target -= 1
+            self.stats.min_processes = min(self.stats.min_processes, self.target)
+            self._lowered = time.time()
+        k, chunk = worker.task
+        attempts[k] += 1
+        if attempts[k] < 2:
+            logger.warning(f"worker {pid} exited with code {code}, retrying its task")
+            queue.append(worker.task)
+        else:
+            logger.warning(
+                f"worker {pid} exited with code {code}, dropping {len(chunk)} "
+                "item(s) that failed twice"
+            )
+            self.stats.lost += len(chunk)
+
+    def report(self) -> str:
+        """Return a one-line summary of the workers' peak memory."""
+        peaks = list(self.stats.peak_rss.values())
+        if not peaks:
+            return "no worker memory recorded"
+        return (
+            f"peak worker memory: max {max(peaks):.0f} MiB, median "
+            f"{statistics.median(peaks):.0f} MiB over {len(peaks)} workers; "
+            f"{self.stats.recycled} recycled, as few as "
+            f"{self.stats.min_processes} of {self.processes} processes, "
+            f"{self.stats.lost} item(s) lost"
+        )
+
+    def close(self):
+        """Shut down the workers and print the memory report."""
+        for pid in list(self._workers):
+            self._retire(pid, recycled=False)
+        print(self.report(), flush=True)
+
+    def terminate(self):
+        for worker in self._workers.values():
+            worker.process.terminate()
+            worker.process.join()
+        self._workers.clear()
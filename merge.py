@@ -0,0 +1,128 @@
+"""Merge sharded benchmark runs into a single store and output directory.
+
+Usage:
+    python merge.py [--torsions] [--cache-dir CACHE_DIR] [-n NPROCS] CONFIG NSHARDS
+
+This script combines the sqlite fragments written by running ``main.py
+--shard i/NSHARDS`` (or ``torsions.py --shard i/NSHARDS`` with ``--torsions``)
+for every i from 1 to NSHARDS. A fresh copy of the pristine store for each
+dataset is taken from the store cache, the MM results from every fragment are
+copied into it, and then the usual output files are written next to CONFIG,
+exactly as for an unsharded run. The fragments must all be present in the
+current directory, and CONFIG and the store cache must be the same as those
+used for the sharded runs.
+"""
+
+import argparse
+from pathlib import Path
+
+from config import Config
+from mempool import add_limit_arguments, limits_from_args
+from minimize import copy_mm_conformers, copy_torsion_points
+from shard import fragment_path
+from store_cache import clone_store
+from telemetry import add_events_argument, configure, stage
+from timings import append_timings, load_timings, sidecar_path
+
+
+def merge_stores(
+    dataset, sqlite_file, count, build, kind, store_cls, copy, cache_dir=None
+):
+    """Clone the pristine ``kind`` store for ``dataset`` to ``sqlite_file`` and
+    use ``copy`` to add the results from the ``count`` shard fragments of
+    ``sqlite_file`` to it, concatenating their timing files too."""
+    fragments = [fragment_path(sqlite_file, i, count) for i in range(1, count + 1)]
+    missing = [str(f) for f in fragments if not f.exists()]
+    if missing:
+        raise FileNotFoundError(f"missing shard fragments: {', '.join(missing)}")
+
+    clone_store(dataset, sqlite_file, build, kind, cache_dir)
+    store = store_cls(sqlite_file)
+    timing_file = sidecar_path(sqlite_file)
+    timing_file.unlink(missing_ok=True)
+    for fragment in fragments:
+        print(f"merging {fragment} into {sqlite_file}", flush=True)
+        with stage("merge", fragment=str(fragment)):
+            copy(store_cls(fragment), store)
+        timings = load_timings(sidecar_path(fragment))
+        append_timings(timing_file, timings.to_dict("records"))
+
+    return store
+
+
+def main():
+    a = argparse.ArgumentParser(
+        prog="python merge.py",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    a.add_argument("config", help="Path to the submission's input YAML file")
+    a.add_argument("nshards", type=int, help="The number of shards to merge")
+    a.add_argument(
+        "--nprocs",
+        "-n",
+        type=int,
+        default=1,
+        help="The number of processes to use for computing metrics. Defaults "
+        "to %(default)d",
+    )
+    a.add_argument(
+        "--torsions",
+        action="store_true",
+        help="Merge torsion benchmark fragments instead of optimizations",
+    )
+    a.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory holding pristine stores for each dataset. Defaults "
+        "to $YDS_CACHE_DIR or ~/.cache/yammbs-dataset-submission",
+    )
+    add_limit_arguments(a)
+    add_events_argument(a)
+    args = a.parse_args()
+    configure(args.events)
+
+    conf = Config.from_file(args.config)
+    out_dir = Path(args.config).parent / "output"
+
+    if args.torsions:
+        from yammbs.torsion import TorsionStore
+
+        import torsions
+        from torsion_outputs import write_results
+
+        store = merge_stores(
+            conf.datasets[0],
+            "torsions-dev.sqlite",
+            args.nshards,
+            torsions.build_store,
+            "torsion",
+            TorsionStore,
+            copy_torsion_points,
+            args.cache_dir,
+        )
+        write_results(store, conf.forcefields[0], out_dir)
+    else:
+        from yammbs import MoleculeStore
+
+        from main import build_store, dataset_runs, write_results
+
+        runs = dataset_runs(conf.datasets)
+        for dataset, sqlite_file, _ in runs:
+            merge_stores(
+                dataset,
+                sqlite_file,
+                args.nshards,
+                build_store,
+                "molecule",
+                MoleculeStore,
+                copy_mm_conformers,
+                args.cache_dir,
+            )
+        write_results(
+            runs, conf.forcefields, out_dir, args.nprocs, limits_from_args(args)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Parallel computation of the DDE, RMSD, TFD, and ICRMSD metrics.
+
+``MoleculeStore.get_dde``, ``get_rmsd``, ``get_tfd``, and
+``get_internal_coordinate_rmsd`` each walk the whole store on a single core,
+reading every QM and MM conformer again. ``compute_metrics`` instead hands
+molecule IDs to a process pool, where each worker reads a molecule's QM and MM
+conformers once and computes every requested metric for every requested force
+field from them. The results are written to the same CSV files, with the same
+headers, as the yammbs collection types produce.
+
+Alongside the CSV files, ``write_table`` writes a single zstd-compressed
+Parquet file holding every metric plus the molecule and conformer identifiers,
+keyed by QCArchive record ID, so that downstream tools can load only the
+columns they need in a single read.
+"""
+
+import logging
+from collections import defaultdict
+
+import numpy
+import pandas
+from openff.toolkit import Molecule
+from tqdm import tqdm
+from yammbs import MoleculeStore
+from yammbs.analysis import get_internal_coordinate_rmsds, get_rmsd, get_tfd
+
+from mempool import MemoryBoundedPool
+from telemetry import progress
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("dde", "rmsd", "tfd", "icrmsd")
+
+# the value column(s) for each metric, matching the yammbs CSV output
+COLUMNS = {
+    "dde": ["difference"],
+    "rmsd": ["rmsd"],
+    "tfd": ["tfd"],
+    "icrmsd": ["Bond", "Angle", "Dihedral", "Improper"],
+}
+
+# the column name(s) for each metric in the combined table
+TABLE_COLUMNS = {
+    "dde": {"difference": "dde"},
+    "rmsd": {"rmsd": "rmsd"},
+    "tfd": {"tfd": "tfd"},
+    "icrmsd": {
+        "Bond": "bonds",
+        "Angle": "angles",
+        "Dihedral": "dihedrals",
+        "Improper": "impropers",
+    },
+}
+
+TABLE_FILE = "results.parquet"
+
+# per-process state set up by _init_worker
+_worker = dict()
+
+
+def _init_worker(sqlite_file, force_fields, metrics):
+    _worker["store"] = MoleculeStore(sqlite_file)
+    _worker["force_fields"] = force_fields
+    _worker["metrics"] = metrics
+
+
+def _ddes(ids, qm, mm):
+    """Return ``(qcarchive_id, dde)`` pairs for a single molecule. Energies are
+    taken relative to the lowest-energy QM conformer, whose DDE is NaN."""
+    qm_energies = numpy.array([qm[i].energy for i in ids])
+    ref = qm_energies.argmin()
+    qm_energies -= qm_energies[ref]
+    mm_energies = numpy.array([mm[i].energy for i in ids])
+    mm_energies -= mm_energies[ref]
+    return [
+        (i, numpy.nan if k == ref else mm_energies[k] - qm_energies[k])
+        for k, i in enumerate(ids)
+    ]
+
+
+def _molecule_metrics(molecule_id):
+    """Compute the metrics for every force field for a single molecule,
+    returning a dict of ``force_field -> metric -> [(qcarchive_id, value)]``,
+    where ``value`` is a dict of column values for ICRMSDs and a float
+    otherwise."""
+    store = _worker["store"]
+    metrics = _worker["metrics"]
+
+    molecule = Molecule.from_mapped_smiles(
+        store.get_smiles_by_molecule_id(molecule_id),
+        allow_undefined_stereo=True,
+    )
+    qm = {
+        record.qcarchive_id: record
+        for record in store.get_qm_conformer_records_by_molecule_id(molecule_id)
+    }
+
+    ret = dict()
+    for force_field in _worker["force_fields"]:
+        mm = {
+            record.qcarchive_id: record
+            for record in store.get_mm_conformer_records_by_molecule_id(
+                molecule_id, force_field
+            )
+        }
+        ids = [i for i in qm if i in mm]
+        rows = defaultdict(list)
+
+        # as in yammbs, skip molecules with only one conformer, or with
+        # missing MM conformers, since there is no common reference
+        if "dde" in metrics and len(qm) > 1 and len(ids) == len(qm):
+            rows["dde"] = _ddes(ids, qm, mm)
+
+        for i in ids:
+            ref, target = qm[i].coordinates, mm[i].coordinates
+            if "rmsd" in metrics:
+                rows["rmsd"].append((i, get_rmsd(molecule, ref, target)))
+            if "tfd" in metrics:
+                try:
+                    rows["tfd"].append((i, get_tfd(molecule, ref, target)))
+                except Exception as e:
+                    logger.warning(f"TFD failed for record {i} with {e}")
+            if "icrmsd" in metrics:
+                rows["icrmsd"].append(
+                    (i, get_internal_coordinate_rmsds(molecule, ref, target))
+                )
+
+        ret[force_field] = rows
+
+    return ret
+
+
+def compute_metrics(
+    sqlite_file,
+    force_fields,
+    n_processes,
+    metrics=METRICS,
+    chunksize=8,
+    limits=None,
+) -> dict[str, dict[str, pandas.DataFrame]]:
+    """Compute ``metrics`` for each of ``force_fields`` on the ``MoleculeStore``
+    in ``sqlite_file`` using a pool of ``n_processes`` workers, subject to the
+    ``mempool.Limits`` in ``limits``.
+
+    Returns a dict of ``force_field -> metric -> DataFrame``, with each
+    DataFrame indexed by QCArchive record ID."""
+    molecule_ids = MoleculeStore(sqlite_file).get_molecule_ids()
+
+    rows = {ff: defaultdict(list) for ff in force_fields}
+    with MemoryBoundedPool(
+        n_processes,
+        initializer=_init_worker,
+        initargs=(sqlite_file, force_fields, metrics),
+        limits=limits,
+    ) as pool:
+        for result in tqdm(
+            progress(
+                pool.imap_unordered(
+                    _molecule_metrics, molecule_ids, chunksize=chunksize
+                ),
+                "metrics",
+                len(molecule_ids),
+            ),
+            total=len(molecule_ids),
+            desc="Computing metrics",
+        ):
+            for force_field, by_metric in result.items():
+                for metric, values in by_metric.items():
+                    rows[force_field][metric].extend(values)
+
+    ret = dict()
+    for force_field in force_fields:
+        ret[force_field] = dict()
+        for metric in metrics:
+            ids = [i for i, _ in rows[force_field][metric]]
+            values = [v for _, v in rows[force_field][metric]]
+            if metric == "icrmsd":
+                df = pandas.DataFrame(values, index=ids, columns=COLUMNS[metric])
+            else:
+                df = pandas.DataFrame({COLUMNS[metric][0]: values}, index=ids)
+            ret[force_field][metric] = df
+
+    return ret
+
+
+def write_csvs(frames: dict[str, pandas.DataFrame], out_dir):
+    """Write each metric DataFrame in ``frames`` to ``out_dir/{metric}.csv``."""
+    for metric, df in frames.items():
+        df.to_csv(f"{out_dir}/{metric}.csv")
+
+
+def identifiers(sqlite_file) -> pandas.DataFrame:
+    """Return a DataFrame of the molecule ID and mapped SMILES for each QM
+    conformer in the ``MoleculeStore`` in ``sqlite_file``, indexed by
+    QCArchive record ID."""
+    store = MoleculeStore(sqlite_file)
+    rows = [
+        (qm.qcarchive_id, molecule_id, qm.mapped_smiles)
+        for molecule_id in store.get_molecule_ids()
+        for qm in store.get_qm_conformer_records_by_molecule_id(molecule_id)
+    ]
+    return pandas.DataFrame(
+        rows, columns=["rec_id", "molecule_id", "mapped_smiles"]
+    ).set_index("rec_id")
+
+
+def write_table(frames: dict[str, pandas.DataFrame], ids, out_dir):
+    """Combine the metric DataFrames in ``frames`` with the ``identifiers`` in
+    ``ids`` and write them to a single Parquet file in ``out_dir``.
+
+    Records missing a metric, such as the DDE of molecules with a single
+    conformer, have null values in that column."""
+    df = ids.copy()
+    for metric, frame in frames.items():
+        df = df.join(frame.rename(columns=TABLE_COLUMNS[metric]), how="left")
+    df = df.reset_index().astype(
+        {"rec_id": "int64", "molecule_id": "int64", "mapped_smiles": "string"}
+    )
+    df.to_parquet(
+        f"{out_dir}/{TABLE_FILE}",
+        engine="pyarrow",
+        compression="zstd",
+        index=False,
+    )
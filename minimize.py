@@ -0,0 +1,422 @@
+"""Checkpointed, resumable replacements for ``MoleculeStore.optimize_mm`` and
+``TorsionStore.optimize_mm``.
+
+The yammbs versions minimize every conformer before writing any of the results
+to the database, so a run that dies partway through loses all of its work.
+These versions only minimize the conformers (or torsion drives) that don't
+already have MM results for the requested force field in the store, and they
+commit results back to the store every ``checkpoint_interval`` seconds, so
+rerunning on the same sqlite file picks up where the last run left off.
+
+These functions rely on private parts of the yammbs API, so they may need to be
+updated along with the yammbs version in devtools/env.yaml.
+"""
+
+import time
+from collections import defaultdict
+
+from tqdm import tqdm
+from yammbs._minimize import MinimizationInput, _run_openmm
+from yammbs.models import MMConformerRecord
+from yammbs.torsion._minimize import (
+    ConstrainedMinimizationInput,
+    _minimize_constrained,
+)
+from yammbs.torsion.models import MMTorsionPointRecord
+
+from charge_cache import install_charge_cache
+from mempool import MemoryBoundedPool
+from schedule import estimate_costs, plan_chunks
+from shard import conformer_cost, select
+from telemetry import progress
+from timings import append_timings, timed
+
+# default number of seconds between commits to the database
+CHECKPOINT_INTERVAL = 300
+
+
+def pending_conformers(store, force_field) -> list[MinimizationInput]:
+    """Return a ``MinimizationInput`` for each QM conformer in ``store`` that
+    does not yet have a corresponding MM conformer for ``force_field``."""
+    inputs = list()
+    for inchi_key in store.get_inchi_keys():
+        molecule_id = store.get_molecule_id_by_inchi_key(inchi_key)
+        done = {
+            record.qcarchive_id
+            for record in store.get_mm_conformer_records_by_molecule_id(
+                molecule_id, force_field
+            )
+        }
+        for qm in store.get_qm_conformer_records_by_molecule_id(molecule_id):
+            if qm.qcarchive_id in done:
+                continue
+            inputs.append(
+                MinimizationInput(
+                    inchi_key=inchi_key,
+                    qcarchive_id=qm.qcarchive_id,
+                    force_field=force_field,
+                    mapped_smiles=qm.mapped_smiles,
+                    coordinates=qm.coordinates,
+                )
+            )
+    return inputs
+
+
+def conformer_costs(stores) -> dict[tuple[int, int], float]:
+    """Return the estimated minimization cost of every QM conformer in
+    ``stores``, keyed by ``(store index, qcarchive_id)``."""
+    return {
+        (i, qm.qcarchive_id): conformer_cost(qm.mapped_smiles)
+        for i, store in enumerate(stores)
+        for molecule_id in store.get_molecule_ids()
+        for qm in store.get_qm_conformer_records_by_molecule_id(molecule_id)
+    }
+
+
+def store_conformers(store, results):
+    """Store a sequence of ``MinimizationResult``s in ``store`` in a single
+    transaction."""
+    if not results:
+        return
+    molecule_ids = {
+        inchi_key: store.get_molecule_id_by_inchi_key(inchi_key)
+        for inchi_key in {result.inchi_key for result in results}
+    }
+    with store._get_session() as db:
+        for result in results:
+            db.store_mm_conformer_record(
+                MMConformerRecord(
+                    molecule_id=molecule_ids[result.inchi_key],
+                    qcarchive_id=result.qcarchive_id,
+                    force_field=result.force_field,
+                    mapped_smiles=result.mapped_smiles,
+                    energy=result.energy,
+                    coordinates=result.coordinates,
+                )
+            )
+
+
+def _checkpointed(results, save, checkpoint_interval):
+    """Pass each item in ``results`` to ``save`` in batches, flushing whenever
+    ``checkpoint_interval`` seconds have passed since the last flush and once
+    more at the end. ``None`` results, from failed minimizations, are
+    dropped."""
+    batch = list()
+    last = time.time()
+    for result in results:
+        if result is not None:
+            batch.append(result)
+        if time.time() - last >= checkpoint_interval:
+            save(batch)
+            batch = list()
+            last = time.time()
+    save(batch)
+
+
+def _init_worker(cache_dir=None):
+    install_charge_cache(cache_dir)
+
+
+def _run_tagged(tagged_input):
+    """Run ``_run_openmm`` on the ``MinimizationInput`` in a ``(tag, input)``
+    pair, returning the tag alongside the result, so it can be routed back to
+    the right store, and a timing row for the minimization."""
+    tag, input = tagged_input
+    result, timing = timed(_run_openmm, input)
+    return tag, result, timing
+
+
+def _run_chunk(chunk):
+    """Run ``_run_tagged`` on each tagged input in a chunk from
+    ``schedule.plan_chunks``."""
+    return [_run_tagged(tagged_input) for tagged_input in chunk]
+
+
+def optimize_mm(
+    stores,
+    force_fields,
+    n_processes,
+    checkpoint_interval=CHECKPOINT_INTERVAL,
+    shard=None,
+    timing_files=None,
+    history=None,
+    cache_dir=None,
+    limits=None,
+):
+    """Minimize the remaining QM conformers in each of the ``MoleculeStore``s
+    in ``stores`` with each of ``force_fields``, committing results every
+    ``checkpoint_interval`` seconds. If ``timing_files`` is provided, the
+    timings for the minimizations for each store are appended to the
+    corresponding CSV file at the same time.
+
+    The conformers from every store and force field are fed into a single
+    process pool, so workers don't sit idle waiting for the last molecules of
+    one dataset or force field to finish before the next one starts. They are
+    dispatched from most to least expensive, as estimated by
+    ``schedule.estimate_costs`` from the wall times in ``history`` where
+    available, so the pool doesn't wait on a long tail of large molecules.
+    Conformers whose minimization fails are not stored and will be retried on
+    the next call.
+
+    If ``shard`` is an ``(index, count)`` pair from ``shard.parse_shard``, only
+    the conformers assigned to that shard are minimized. Partial charges are
+    shared through the ``charge_cache`` in ``cache_dir``, and the worker
+    processes are subject to the ``mempool.Limits`` in ``limits``."""
+    inputs = [
+        (i, input)
+        for i, store in enumerate(stores)
+        for force_field in force_fields
+        for input in pending_conformers(store, force_field)
+    ]
+    if shard is not None:
+        selected = select(conformer_costs(stores), *shard)
+        inputs = [
+            (i, input) for i, input in inputs if (i, input.qcarchive_id) in selected
+        ]
+    print(
+        f"{len(inputs)} conformers left to minimize with "
+        f"{len(force_fields)} force field(s)",
+        flush=True,
+    )
+    if not inputs:
+        return
+
+    def save(batch):
+        by_store = defaultdict(list)
+        timings = defaultdict(list)
+        for i, result, timing in batch:
+            if result is not None:
+                by_store[i].append(result)
+            timings[i].append(timing)
+        for i, results in by_store.items():
+            store_conformers(stores[i], results)
+        if timing_files is not None:
+            for i, rows in timings.items():
+                append_timings(timing_files[i], rows)
+
+    costs = estimate_costs([input for _, input in inputs], history)
+    chunks = plan_chunks(inputs, costs, n_processes)
+
+    with MemoryBoundedPool(
+        n_processes,
+        initializer=_init_worker,
+        initargs=(cache_dir,),
+        limits=limits,
+    ) as pool:
+        _checkpointed(
+            tqdm(
+                progress(
+                    (
+                        result
+                        for chunk in pool.imap_unordered(_run_chunk, chunks)
+                        for result in chunk
+                    ),
+                    "minimize",
+                    len(inputs),
+                    failed=lambda result: result[1] is None,
+                ),
+                total=len(inputs),
+                desc="Building and minimizing systems",
+            ),
+            save,
+            checkpoint_interval,
+        )
+
+
+def pending_torsions(store, force_field) -> list[tuple]:
+    """Return a ``(molecule_id, mapped_smiles, dihedral_indices, force_field,
+    qm_points)`` tuple for each torsion drive in the ``TorsionStore`` ``store``
+    with grid points that have not been minimized with ``force_field``.
+    ``qm_points`` only contains the missing grid points."""
+    drives = list()
+    for molecule_id in store.get_molecule_ids():
+        done = store.get_mm_points_by_molecule_id(molecule_id, force_field)
+        qm_points = {
+            grid_id: coordinates
+            for grid_id, coordinates in store.get_qm_points_by_molecule_id(
+                molecule_id
+            ).items()
+            if grid_id not in done
+        }
+        if not qm_points:
+            continue
+        drives.append(
+            (
+                molecule_id,
+                store.get_smiles_by_molecule_id(molecule_id),
+                store.get_dihedral_indices_by_molecule_id(molecule_id),
+                force_field,
+                qm_points,
+            )
+        )
+    return drives
+
+
+def torsion_costs(store) -> dict[int, float]:
+    """Return the estimated minimization cost of every torsion drive in
+    ``store``, keyed by molecule ID."""
+    return {
+        molecule_id: conformer_cost(store.get_smiles_by_molecule_id(molecule_id))
+        * len(store.get_qm_points_by_molecule_id(molecule_id))
+        for molecule_id in store.get_molecule_ids()
+    }
+
+
+def _drive_inputs(drive) -> list[ConstrainedMinimizationInput]:
+    """Return a ``ConstrainedMinimizationInput`` for each grid point in a
+    single torsion drive from ``pending_torsions``."""
+    molecule_id, mapped_smiles, dihedral_indices, force_field, qm_points = drive
+    return [
+        ConstrainedMinimizationInput(
+            torsion_id=molecule_id,
+            mapped_smiles=mapped_smiles,
+            dihedral_indices=dihedral_indices,
+            force_field=force_field,
+            coordinates=coordinates,
+            grid_id=grid_id,
+        )
+        for grid_id, coordinates in qm_points.items()
+    ]
+
+
+def _minimize_points(chunk):
+    """Minimize each grid point in a chunk from ``schedule.plan_chunks``,
+    returning ``(torsion_id, result)`` pairs."""
+    return [(input.torsion_id, _minimize_constrained(input)) for input in chunk]
+
+
+def _completed_drives(results, sizes):
+    """Collect the ``(torsion_id, result)`` pairs in ``results`` by drive and
+    yield the results for each drive once all ``sizes[torsion_id]`` of its grid
+    points have finished, dropping any failed (``None``) results."""
+    partial = defaultdict(list)
+    for torsion_id, result in results:
+        partial[torsion_id].append(result)
+        if len(partial[torsion_id]) == sizes[torsion_id]:
+            yield [r for r in partial.pop(torsion_id) if r is not None]
+
+
+def store_torsion_points(store, results):
+    """Store a sequence of ``ConstrainedMinimizationResult``s in ``store`` in a
+    single transaction."""
+    if not results:
+        return
+    with store._get_session() as db:
+        for result in results:
+            db.store_mm_torsion_point(
+                MMTorsionPointRecord(
+                    molecule_id=result.torsion_id,
+                    grid_id=result.grid_id,
+                    coordinates=result.coordinates,
+                    force_field=result.force_field,
+                    energy=result.energy,
+                )
+            )
+
+
+def optimize_torsions(
+    store,
+    force_field,
+    n_processes,
+    checkpoint_interval=CHECKPOINT_INTERVAL,
+    shard=None,
+    cache_dir=None,
+    limits=None,
+):
+    """Minimize the remaining torsion drives in the ``TorsionStore`` ``store``
+    with ``force_field``, committing results every ``checkpoint_interval``
+    seconds.
+
+    Every grid point is minimized as a separate task, with the most expensive
+    molecules dispatched first, so a few large drives don't leave most of the
+    pool idle near the end of a run. The results are reassembled by drive in
+    this process, and each drive is only stored once all of its grid points
+    have finished, so an interrupted run never leaves a drive half-finished in
+    the store. If ``shard`` is an ``(index, count)`` pair from
+    ``shard.parse_shard``, only the drives assigned to that shard are
+    minimized."""
+    drives = pending_torsions(store, force_field)
+    if shard is not None:
+        selected = select(torsion_costs(store), *shard)
+        drives = [drive for drive in drives if drive[0] in selected]
+    inputs = [input for drive in drives for input in _drive_inputs(drive)]
+    print(
+        f"{len(drives)} torsion drives ({len(inputs)} grid points) left to "
+        f"minimize with {force_field}",
+        flush=True,
+    )
+    if not drives:
+        return
+
+    sizes = {drive[0]: len(drive[4]) for drive in drives}
+    chunks = plan_chunks(
+        inputs,
+        [conformer_cost(input.mapped_smiles) for input in inputs],
+        n_processes,
+    )
+
+    def save(batch):
+        store_torsion_points(store, [r for drive in batch for r in drive])
+
+    with MemoryBoundedPool(
+        n_processes,
+        initializer=install_charge_cache,
+        initargs=(cache_dir,),
+        limits=limits,
+    ) as pool:
+        points = (
+            result
+            for chunk in pool.imap_unordered(_minimize_points, chunks)
+            for result in chunk
+        )
+        _checkpointed(
+            _completed_drives(
+                tqdm(
+                    progress(
+                        points,
+                        "minimize_torsions",
+                        len(inputs),
+                        failed=lambda point: point[1] is None,
+                    ),
+                    total=len(inputs),
+                    desc=f"Minimizing torsion grid points with {force_field}",
+                ),
+                sizes,
+            ),
+            save,
+            checkpoint_interval,
+        )
+
+
+def copy_mm_conformers(src, dst):
+    """Copy every MM conformer in the ``MoleculeStore`` ``src`` to ``dst``.
+    Both stores must have been cloned from the same pristine store so that
+    their molecule IDs agree."""
+    with dst._get_session() as db:
+        for force_field in src.get_force_fields():
+            for molecule_id in src.get_molecule_ids():
+                for record in src.get_mm_conformer_records_by_molecule_id(
+                    molecule_id, force_field
+                ):
+                    db.store_mm_conformer_record(record)
+
+
+def copy_torsion_points(src, dst):
+    """Copy every MM torsion point in the ``TorsionStore`` ``src`` to ``dst``.
+    Both stores must have been cloned from the same pristine store so that
+    their molecule IDs agree."""
+    with dst._get_session() as db:
+        for force_field in src.get_force_fields():
+            for molecule_id in src.get_molecule_ids():
+                points = src.get_mm_points_by_molecule_id(molecule_id, force_field)
+                energies = src.get_mm_energies_by_molecule_id(molecule_id, force_field)
+                for grid_id, coordinates in points.items():
+                    db.store_mm_torsion_point(
+                        MMTorsionPointRecord(
+                            molecule_id=molecule_id,
+                            grid_id=grid_id,
+                            coordinates=coordinates,
+                            force_field=force_field,
+                            energy=energies[grid_id],
+                        )
+                    )
@@ -0,0 +1,265 @@
+"""Measure the throughput of the benchmarking pipeline itself.
+
+Usage:
+    python pipeline_benchmark.py [-n NPROCS] [--history FILE] [SUBSET ...]
+
+This runs each stage of the optimization and torsion pipelines (ingest,
+minimization, metrics, plotting, and archiving) on fixed subsets of the
+datasets in this repository, and appends the wall time of every stage to a CSV
+history file along with the versions of the main dependencies, so that the
+effect of bumping yammbs, the toolkit, or Interchange in devtools/env.yaml can
+be compared against earlier runs. Each stage is also compared to the median of
+previous runs of the same subset, stage, and process count, and flagged if it
+is more than ``REGRESSION`` times slower.
+
+The subsets are the first conformers or torsion drives of the source datasets,
+so they are the same from run to run as long as the datasets don't change.
+Every run starts from a fresh store and an empty charge cache in a temporary
+directory, so the results don't depend on anything cached by earlier runs.
+"""
+
+import argparse
+import bz2
+import json
+import platform
+import shutil
+import subprocess
+import tarfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pandas
+
+from ingest import iter_entries, stream_molecule_store, stream_torsion_store
+
+FORCE_FIELD = "openff-2.2.1.offxml"
+
+OPT_DATASET = "datasets/OpenFF-Industry-Benchmark-Season-1-v1.1/cache.json"
+TORSION_DATASET = "datasets/torsion-dev/larger.json"
+
+# name -> (kind, source dataset, number of entries)
+SUBSETS = {
+    "opt-small": ("optimization", OPT_DATASET, 100),
+    "opt-medium": ("optimization", OPT_DATASET, 1000),
+    "opt-large": ("optimization", OPT_DATASET, 10000),
+    "torsion-small": ("torsion", TORSION_DATASET, 5),
+    "torsion-medium": ("torsion", TORSION_DATASET, 25),
+    "torsion-large": ("torsion", TORSION_DATASET, 100),
+}
+
+# packages whose versions are recorded with each run
+PACKAGES = ["yammbs", "openff-toolkit", "openff-interchange", "openmm", "rdkit"]
+
+HISTORY_FILE = "pipeline-benchmarks.csv"
+
+# slowdown relative to the median of previous runs that is flagged
+REGRESSION = 1.2
+
+
+def make_subset(kind, source, count, path):
+    """Write the first ``count`` entries of the ``source`` dataset of type
+    ``kind`` to a new dataset at ``path``, returning the number written."""
+    key = "qm_molecules" if kind == "optimization" else "qm_torsions"
+    entries = list()
+    for entry in iter_entries(source, key):
+        entries.append(entry)
+        if len(entries) == count:
+            break
+    with open(path, "w") as out:
+        json.dump({key: entries}, out)
+    return len(entries)
+
+
+def package_versions() -> dict[str, str]:
+    ret = dict()
+    for package in PACKAGES:
+        try:
+            ret[package] = version(package)
+        except PackageNotFoundError:
+            ret[package] = None
+    return ret
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def archive(sqlite_file, out_dir, tar_file):
+    """Compress ``sqlite_file`` and bundle it with ``out_dir`` into
+    ``tar_file``, as the CI workflows do with bzip2 and tar."""
+    compressed = f"{sqlite_file}.bz2"
+    with open(sqlite_file, "rb") as inp, bz2.open(compressed, "wb") as out:
+        shutil.copyfileobj(inp, out)
+    with tarfile.open(tar_file, "w") as tar:
+        tar.add(compressed, arcname=Path(compressed).name)
+        tar.add(out_dir, arcname=Path(out_dir).name)
+
+
+def run_optimization(subset, work, procs, stage):
+    from yammbs import MoleculeStore
+
+    from metrics import compute_metrics, identifiers, write_csvs, write_table
+    from minimize import optimize_mm
+    from plot import plot
+
+    sqlite_file = str(work / "store.sqlite")
+    out_dir = work / "output"
+    out_dir.mkdir()
+
+    with stage("ingest"):
+        stream_molecule_store(subset, sqlite_file)
+    with stage("minimization"):
+        optimize_mm(
+            [MoleculeStore(sqlite_file)],
+            [FORCE_FIELD],
+            n_processes=procs,
+            checkpoint_interval=float("inf"),
+            cache_dir=work,
+        )
+    with stage("metrics"):
+        frames = compute_metrics(sqlite_file, [FORCE_FIELD], procs)[FORCE_FIELD]
+        write_csvs(frames, out_dir)
+        write_table(frames, identifiers(sqlite_file), out_dir)
+    with stage("plotting"):
+        plot([work], str(out_dir))
+    with stage("archiving"):
+        archive(sqlite_file, out_dir, work / "results.tar")
+
+
+def run_torsion(subset, work, procs, stage):
+    from yammbs.torsion import TorsionStore
+
+    from minimize import optimize_torsions
+    from plot_torsions import plot
+    from torsion_outputs import write_results
+
+    sqlite_file = str(work / "store.sqlite")
+    out_dir = work / "output"
+
+    with stage("ingest"):
+        stream_torsion_store(subset, sqlite_file)
+    store = TorsionStore(sqlite_file)
+    with stage("minimization"):
+        optimize_torsions(
+            store,
+            FORCE_FIELD,
+            n_processes=procs,
+            checkpoint_interval=float("inf"),
+            cache_dir=work,
+        )
+    with stage("metrics"):
+        write_results(store, FORCE_FIELD, out_dir)
+    with stage("plotting"):
+        plot(work, str(out_dir), procs)
+    with stage("archiving"):
+        archive(sqlite_file, out_dir, work / "results.tar")
+
+
+def run_subset(name, procs) -> list[dict]:
+    """Run every stage of the pipeline on the subset ``name`` with ``procs``
+    processes and return a row for each stage."""
+    kind, source, count = SUBSETS[name]
+    rows = list()
+    with TemporaryDirectory() as d:
+        work = Path(d)
+        subset = work / "subset.json"
+        n = make_subset(kind, source, count, subset)
+
+        @contextmanager
+        def stage(stage_name):
+            print(f"{name}: starting {stage_name}", flush=True)
+            start = time.perf_counter()
+            yield
+            seconds = time.perf_counter() - start
+            print(f"{name}: finished {stage_name} in {seconds:.1f} sec", flush=True)
+            rows.append(dict(subset=name, stage=stage_name, entries=n, seconds=seconds))
+
+        if kind == "optimization":
+            run_optimization(subset, work, procs, stage)
+        else:
+            run_torsion(subset, work, procs, stage)
+    return rows
+
+
+def compare(rows: pandas.DataFrame, history: pandas.DataFrame) -> str:
+    """Return a table comparing the stage times in ``rows`` with the median of
+    matching runs in ``history``."""
+    lines = list()
+    for row in rows.itertuples():
+        previous = history[
+            (history["subset"] == row.subset)
+            & (history["stage"] == row.stage)
+            & (history["nprocs"] == row.nprocs)
+        ]
+        line = f"{row.subset:>15} {row.stage:>13} {row.seconds:10.1f} sec"
+        if not previous.empty:
+            ratio = row.seconds / previous["seconds"].median()
+            line += f" {ratio:6.2f}x median of {len(previous)} previous"
+            if ratio > REGRESSION:
+                line += "  REGRESSION"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    a = argparse.ArgumentParser(
+        prog="python pipeline_benchmark.py",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    a.add_argument(
+        "subsets",
+        nargs="*",
+        help=f"The subsets to run, from {', '.join(SUBSETS)}. Defaults to the "
+        "small and medium subsets",
+    )
+    a.add_argument(
+        "--nprocs",
+        "-n",
+        type=int,
+        default=1,
+        help="The number of processes to use. Defaults to %(default)d",
+    )
+    a.add_argument(
+        "--history",
+        default=HISTORY_FILE,
+        help="CSV file to append the results to. Defaults to %(default)s",
+    )
+    args = a.parse_args()
+
+    unknown = [s for s in args.subsets if s not in SUBSETS]
+    if unknown:
+        a.error(f"unknown subsets: {', '.join(unknown)}")
+    subsets = args.subsets or [s for s in SUBSETS if not s.endswith("-large")]
+
+    rows = [row for name in subsets for row in run_subset(name, args.nprocs)]
+    rows = pandas.DataFrame(rows)
+    rows.insert(0, "date", datetime.now(timezone.utc).isoformat(timespec="seconds"))
+    rows.insert(1, "commit", git_commit())
+    rows.insert(2, "host", platform.node())
+    rows.insert(3, "nprocs", args.nprocs)
+    for package, v in package_versions().items():
+        rows[package] = v
+
+    history = Path(args.history)
+    if history.exists():
+        print(compare(rows, pandas.read_csv(history)))
+    else:
+        print(compare(rows, rows.iloc[:0]))
+    rows.to_csv(history, mode="a", header=not history.exists(), index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,16 +19,50 @@ warnings.filterwarnings("ignore", message="divide by zero", category=RuntimeWarn
 pandas.set_option("display.max_columns", None)
 
 
+BENCH_COLUMNS = [
+    "rec_id",
+    "dde",
+    "rmsd",
+    "tfd",
+    "bonds",
+    "angles",
+    "dihedrals",
+    "impropers",
+]
+
+
 def load_bench(d: Path) -> pandas.DataFrame:
-    """Load the DDE, RMSD, TFD, and ICRMSD results from the CSV files in ``d``
-    and return the result as a merged dataframe"""
-    dde = pandas.read_csv(d / "output" / "dde.csv")
+    """Load the DDE, RMSD, TFD, and ICRMSD results from ``d`` and return the
+    result as a merged dataframe.
+
+    The results are read from ``d/output``, or from ``d`` itself if it has no
+    ``output`` directory, as for the per-dataset and per-force-field
+    subdirectories of ``output`` written by ``main.py``. The combined
+    ``results.parquet`` table is used if it exists, otherwise the separate CSV
+    files for each metric are loaded and merged.
+
+    Either way, only records with every metric are returned. Records missing a
+    metric are absent from its CSV file but have null values in the table, so
+    those rows are dropped from the table. The exception is the DDE of the
+    reference conformer of each molecule, which is NaN in ``dde.csv`` too."""
+    if (d / "output").is_dir():
+        d = d / "output"
+    table = d / "results.parquet"
+    if table.exists():
+        df = pandas.read_parquet(table, columns=BENCH_COLUMNS + ["molecule_id"])
+        has_dde = df.groupby("molecule_id")["dde"].transform("count") > 0
+        keep = df[BENCH_COLUMNS[2:]].notna().all(axis=1) & (df["dde"].notna() | has_dde)
+        ret = df.loc[keep, BENCH_COLUMNS].reset_index(drop=True)
+        print(f"loaded {ret.shape} rows for {d}")
+        return ret
+
+    dde = pandas.read_csv(d / "dde.csv")
     dde.columns = ["rec_id", "dde"]
-    rmsd = pandas.read_csv(d / "output" / "rmsd.csv")
+    rmsd = pandas.read_csv(d / "rmsd.csv")
     rmsd.columns = ["rec_id", "rmsd"]
-    tfd = pandas.read_csv(d / "output" / "tfd.csv")
+    tfd = pandas.read_csv(d / "tfd.csv")
     tfd.columns = ["rec_id", "tfd"]
-    icrmsd = pandas.read_csv(d / "output" / "icrmsd.csv")
+    icrmsd = pandas.read_csv(d / "icrmsd.csv")
     icrmsd.columns = ["rec_id", "bonds", "angles", "dihedrals", "impropers"]
     ret = dde.merge(rmsd).pipe(DF.merge, tfd).pipe(DF.merge, icrmsd)
     print(f"loaded {ret.shape} rows for {d}")
@@ -0,0 +1,276 @@
+"""Plot and summarize the results of a torsion benchmark.
+
+Usage:
+    python plot_torsions.py [-o OUT_DIR] [-n NPROCS] path/to/submission
+
+This reads the ``minimized.jsonl.gz`` and ``metrics.jsonl.gz`` files written by
+``torsions.py`` to the submission's ``output`` directory and writes:
+
+* ``torsion_summary.csv``, with one row per torsion drive and force field
+  containing the RMSD and EEN along with the RMS and maximum error of the MM
+  energy profile relative to QM and the QM and MM rotational barriers;
+* overview plots of the RMSD, EEN, and profile error distributions
+  (``torsion_rmsd.png``, ``torsion_een.png``, ``torsion_profile_error.png``),
+  of the MM against the QM barriers (``torsion_barriers.png``), and of the
+  mean absolute profile error at each grid angle (``torsion_angle_error.png``);
+  and
+* grids of the relative QM and MM energy profiles of every drive in
+  ``profiles/``, ``PAGE_SIZE`` drives to a page, rendered in parallel.
+
+The profiles are loaded into arrays with one row per drive and one column per
+grid angle, so the per-drive summaries are computed for every drive at once,
+and only the per-drive grids need a plot call for each drive.
+"""
+
+import argparse
+import warnings
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy
+import pandas
+import seaborn as sea
+from matplotlib import pyplot
+
+from torsion_outputs import METRICS_FILE, MINIMIZED_FILE, read_records
+
+# drives per page of profile plots, and the shape of each page
+PAGE_SIZE = 25
+PAGE_COLUMNS = 5
+
+ENERGY_LABEL = "Relative energy (kcal mol$^{-1}$)"
+
+
+def load_profiles(path):
+    """Load the minimized profiles in ``path``, returning a DataFrame with the
+    ``force_field``, ``molecule_id``, and ``mapped_smiles`` of each drive, the
+    sorted grid angles, and arrays of the QM and MM energies with a row for
+    each drive and a column for each angle, containing NaN for missing
+    points."""
+    rows, qm, mm = list(), list(), list()
+    for record in read_records(path):
+        rows.append(
+            dict(
+                force_field=record["force_field"],
+                molecule_id=record["molecule_id"],
+                mapped_smiles=record["mapped_smiles"],
+            )
+        )
+        qm.append(record["qm_energies"])
+        mm.append(record["energies"])
+
+    angles = sorted({float(a) for energies in qm + mm for a in energies})
+    column = {a: i for i, a in enumerate(angles)}
+
+    def to_array(profiles):
+        ret = numpy.full((len(profiles), len(angles)), numpy.nan)
+        for i, energies in enumerate(profiles):
+            cols = [column[float(a)] for a in energies]
+            ret[i, cols] = list(energies.values())
+        return ret
+
+    return pandas.DataFrame(rows), numpy.array(angles), to_array(qm), to_array(mm)
+
+
+def relative(energies):
+    """Return ``energies`` relative to the minimum of each row."""
+    with warnings.catch_warnings():
+        # rows for drives without any results are all NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return energies - numpy.nanmin(energies, axis=1, keepdims=True)
+
+
+def summarize(drives, qm, mm):
+    """Add the profile error and barrier columns for the relative QM and MM
+    energies ``qm`` and ``mm`` to a copy of ``drives``."""
+    error = mm - qm
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        ret = drives.copy()
+        ret["profile_rmse"] = numpy.sqrt(numpy.nanmean(error**2, axis=1))
+        ret["profile_max_error"] = numpy.nanmax(numpy.abs(error), axis=1)
+        ret["qm_barrier"] = numpy.nanmax(qm, axis=1)
+        ret["mm_barrier"] = numpy.nanmax(mm, axis=1)
+    return ret
+
+
+def load_metrics(path) -> pandas.DataFrame:
+    return pandas.DataFrame(
+        list(read_records(path)),
+        columns=["force_field", "molecule_id", "rmsd", "een"],
+    )
+
+
+def plot_distribution(summary, column, label, out_file, log=False):
+    data = summary[["force_field", column]].dropna()
+    if log:
+        data = data[data[column] > 0]
+    fig, (hist, cdf) = pyplot.subplots(1, 2, figsize=(10, 4))
+    sea.histplot(
+        data=data,
+        x=column,
+        hue="force_field",
+        element="step",
+        fill=False,
+        log_scale=log,
+        ax=hist,
+    )
+    sea.ecdfplot(data=data, x=column, hue="force_field", log_scale=log, ax=cdf)
+    hist.set_xlabel(label)
+    cdf.set_xlabel(label)
+    fig.tight_layout()
+    fig.savefig(out_file, dpi=300)
+    pyplot.close(fig)
+
+
+def plot_barriers(summary, out_file):
+    fig, ax = pyplot.subplots(figsize=(5, 5))
+    sea.scatterplot(
+        data=summary, x="qm_barrier", y="mm_barrier", hue="force_field", s=10, ax=ax
+    )
+    top = numpy.nanmax(summary[["qm_barrier", "mm_barrier"]].to_numpy(), initial=1.0)
+    ax.plot([0, top], [0, top], color="grey", linestyle="--", linewidth=1)
+    ax.set_xlabel("QM barrier (kcal mol$^{-1}$)")
+    ax.set_ylabel("MM barrier (kcal mol$^{-1}$)")
+    fig.tight_layout()
+    fig.savefig(out_file, dpi=300)
+    pyplot.close(fig)
+
+
+def plot_angle_error(summary, angles, error, out_file):
+    fig, ax = pyplot.subplots(figsize=(6, 4))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for force_field, rows in summary.groupby("force_field").indices.items():
+            mae = numpy.nanmean(numpy.abs(error[rows]), axis=0)
+            ax.plot(angles, mae, marker="o", markersize=3, label=force_field)
+    ax.set_xlabel("Torsion angle (°)")
+    ax.set_ylabel("Mean absolute error (kcal mol$^{-1}$)")
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(out_file, dpi=300)
+    pyplot.close(fig)
+
+
+def _plot_page(args):
+    """Plot one page of profiles. ``args`` holds the output file, the grid
+    angles, and a tuple of the title, relative QM energies, and dict of
+    relative MM energies by force field for each drive on the page."""
+    out_file, angles, drives = args
+    rows = -(-len(drives) // PAGE_COLUMNS)
+    fig, axes = pyplot.subplots(
+        rows,
+        PAGE_COLUMNS,
+        figsize=(3 * PAGE_COLUMNS, 2.5 * rows),
+        squeeze=False,
+        sharex=True,
+    )
+    for ax, (title, qm, mm) in zip(axes.flat, drives):
+        ok = ~numpy.isnan(qm)
+        ax.plot(angles[ok], qm[ok], color="black", marker="o", markersize=2, label="QM")
+        for force_field, energies in mm.items():
+            ok = ~numpy.isnan(energies)
+            ax.plot(
+                angles[ok], energies[ok], marker="o", markersize=2, label=force_field
+            )
+        ax.set_title(title, fontsize=8)
+    for ax in axes.flat[len(drives) :]:
+        ax.set_axis_off()
+    axes.flat[0].legend(fontsize=6)
+    for ax in axes[:, 0]:
+        ax.set_ylabel(ENERGY_LABEL, fontsize=7)
+    for ax in axes[-1]:
+        ax.set_xlabel("Torsion angle (°)", fontsize=7)
+    # fixed ticks and spacing, since laying these out dominates the run time
+    axes.flat[0].set_xticks(numpy.arange(-180, 181, 90))
+    fig.subplots_adjust(
+        left=0.05, right=0.98, bottom=0.06, top=0.95, wspace=0.25, hspace=0.35
+    )
+    fig.savefig(out_file, dpi=100)
+    pyplot.close(fig)
+    return out_file
+
+
+def profile_pages(summary, angles, qm, mm, out_dir):
+    """Yield the arguments to ``_plot_page`` for each page of drives, with
+    every force field's profile for a molecule on the same plot."""
+    drives = list()
+    for molecule_id, rows in summary.groupby("molecule_id", sort=True).indices.items():
+        row = summary.iloc[rows[0]]
+        title = f"{molecule_id}: RMSD {row['rmsd']:.2f} Å, EEN {row['een']:.2f}"
+        profiles = {summary["force_field"].iloc[i]: mm[i] for i in rows}
+        drives.append((title, qm[rows[0]], profiles))
+    for page, start in enumerate(range(0, len(drives), PAGE_SIZE)):
+        out_file = out_dir / f"profiles-{page + 1:03d}.png"
+        yield out_file, angles, drives[start : start + PAGE_SIZE]
+
+
+def plot(submission, out_dir, nprocs=1):
+    """Summarize and plot the torsion benchmark results in
+    ``submission/output``, writing the results to ``out_dir``."""
+    output = Path(submission) / "output"
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    drives, angles, qm, mm = load_profiles(output / MINIMIZED_FILE)
+    print(f"loaded {len(drives)} profiles from {output}", flush=True)
+    qm, mm = relative(qm), relative(mm)
+
+    metrics = load_metrics(output / METRICS_FILE)
+    summary = summarize(drives, qm, mm).merge(
+        metrics, on=["force_field", "molecule_id"], how="left"
+    )
+    summary.to_csv(out_dir / "torsion_summary.csv", index=False)
+
+    plot_distribution(
+        summary, "rmsd", "RMSD (Å)", out_dir / "torsion_rmsd.png", log=True
+    )
+    plot_distribution(
+        summary, "een", "EEN (kcal mol$^{-1}$)", out_dir / "torsion_een.png"
+    )
+    plot_distribution(
+        summary,
+        "profile_rmse",
+        "Profile RMSE (kcal mol$^{-1}$)",
+        out_dir / "torsion_profile_error.png",
+    )
+    plot_barriers(summary, out_dir / "torsion_barriers.png")
+    plot_angle_error(summary, angles, mm - qm, out_dir / "torsion_angle_error.png")
+
+    profile_dir = out_dir / "profiles"
+    profile_dir.mkdir(exist_ok=True)
+    pages = list(profile_pages(summary, angles, qm, mm, profile_dir))
+    with Pool(nprocs) as pool:
+        for _ in pool.imap_unordered(_plot_page, pages):
+            pass
+    print(f"wrote {len(pages)} pages of profiles to {profile_dir}", flush=True)
+
+
+def main():
+    a = argparse.ArgumentParser(
+        prog="python plot_torsions.py",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    a.add_argument("submission", help="Path to the submission directory")
+    a.add_argument(
+        "--output-dir",
+        "-o",
+        default=None,
+        help="Directory to write the plots and summary to. Defaults to the "
+        "submission's output directory",
+    )
+    a.add_argument(
+        "--nprocs",
+        "-n",
+        type=int,
+        default=1,
+        help="The number of processes to render profiles with. Defaults to %(default)d",
+    )
+    args = a.parse_args()
+    out_dir = args.output_dir or Path(args.submission) / "output"
+    plot(args.submission, out_dir, args.nprocs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Persistent cache of data downloaded from QCArchive.
+
+The dataset scripts used to give ``_CachedPortalClient`` a ``TemporaryDirectory``,
+so every record and molecule downloaded was thrown away when the script
+exited, and a crash or a rerun for the next version of a dataset started from
+scratch. ``PersistentPortalClient`` keeps qcportal's record caches in a
+directory that is reused across runs and datasets instead
+(``DEFAULT_QCA_CACHE_DIR`` by default), and ``download_collection`` saves a copy
+of each downloaded ``OptimizationResultCollection`` there too.
+
+The cache is bounded in size by ``evict``, which deletes the optimization
+records that were least recently requested until the cache fits in the given
+number of GiB. When each record was last requested is tracked in
+``usage.sqlite`` in the cache directory, since qcportal only stores the time
+each record was last modified on the server.
+
+In offline mode, the client never contacts the server: records and datasets
+are only read from the cache, and anything missing raises a
+``ConnectionError``. This allows ``filtered.json`` and ``cache.json`` to be
+rebuilt without network access, after an earlier online run has filled the
+cache. A read-only client is also offline, and doesn't record which records it
+requests either, so that many processes, such as the shards of a job array,
+can read the same cache without writing to it.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from collections.abc import Sequence
+from pathlib import Path
+
+from openff.qcsubmit.results import OptimizationResultCollection
+from openff.qcsubmit.utils import _CachedPortalClient
+from qcportal import __version__ as qcportal_version
+
+from store_cache import DEFAULT_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+QCA_ADDRESS = "https://api.qcarchive.molssi.org:443/"
+
+DEFAULT_QCA_CACHE_DIR = DEFAULT_CACHE_DIR / "qcarchive"
+
+# default size limit of the cache in GiB
+DEFAULT_MAX_SIZE = 50
+
+USAGE_FILE = "usage.sqlite"
+
+# number of records to delete at a time while evicting
+EVICT_BATCH = 1000
+
+
+def add_cache_arguments(parser):
+    """Add flags for the location, size, and offline mode of the QCArchive
+    cache to the ``argparse.ArgumentParser`` ``parser``."""
+    parser.add_argument(
+        "--qca-cache-dir",
+        default=DEFAULT_QCA_CACHE_DIR,
+        type=Path,
+        help="Directory to cache QCArchive downloads in across runs. "
+        "Defaults to %(default)s",
+    )
+    parser.add_argument(
+        "--qca-cache-size",
+        type=float,
+        default=DEFAULT_MAX_SIZE,
+        help="Evict the least recently used records once the QCArchive cache "
+        "exceeds this many GiB. Defaults to %(default)s",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only use data already in the QCArchive cache, without "
+        "contacting the server",
+    )
+
+
+def _usage(cache_dir) -> sqlite3.Connection:
+    path = Path(cache_dir) / USAGE_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("CREATE TABLE IF NOT EXISTS used (id INTEGER PRIMARY KEY, time REAL)")
+    return conn
+
+
+def mark_used(cache_dir, record_ids):
+    """Record that each of ``record_ids`` was requested now."""
+    now = time.time()
+    with _usage(cache_dir) as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO used VALUES (?, ?)",
+            ((record_id, now) for record_id in record_ids),
+        )
+    conn.close()
+
+
+class PersistentPortalClient(_CachedPortalClient):
+    """A ``_CachedPortalClient`` for ``address`` that caches records in
+    ``cache_dir``, records when each optimization was last requested, and
+    never contacts the server if ``offline`` is true. A ``read_only`` client
+    is offline and doesn't record when optimizations were requested."""
+
+    def __init__(self, address, cache_dir, offline=False, read_only=False):
+        # set before initializing the client, which requests the server info
+        self.offline = offline or read_only
+        self.read_only = read_only
+        self.usage_dir = Path(cache_dir)
+        self.usage_dir.mkdir(parents=True, exist_ok=True)
+        super().__init__(address, str(cache_dir))
+
+    def get_server_information(self):
+        if self.offline:
+            return dict(
+                name="offline", api_limits=dict(), version=qcportal_version, motd=""
+            )
+        return super().get_server_information()
+
+    def _request(self, method, endpoint, *args, **kwargs):
+        if self.offline:
+            raise ConnectionError(
+                f"{method.upper()} {endpoint} is not in the QCArchive cache and "
+                "the client is offline"
+            )
+        return super()._request(method, endpoint, *args, **kwargs)
+
+    def get_optimizations(self, record_ids, *args, **kwargs):
+        ret = super().get_optimizations(record_ids, *args, **kwargs)
+        if self.read_only:
+            return ret
+        if isinstance(record_ids, Sequence):
+            mark_used(self.usage_dir, record_ids)
+        else:
+            mark_used(self.usage_dir, [record_ids])
+        return ret
+
+
+def collection_path(cache_dir, name) -> Path:
+    """Return the path of the cached copy of the dataset ``name``."""
+    return Path(cache_dir) / "collections" / f"{name.replace(' ', '-')}.json"
+
+
+def download_collection(client, name, cache_dir) -> OptimizationResultCollection:
+    """Return the ``OptimizationResultCollection`` named ``name``, downloading
+    it with ``client`` and saving a copy to ``cache_dir``, or reading the copy
+    if ``client`` is offline."""
+    path = collection_path(cache_dir, name)
+    if client.offline:
+        if not path.exists():
+            raise ConnectionError(
+                f"{name} is not in the QCArchive cache at {cache_dir} and the "
+                "client is offline"
+            )
+        logger.info(f"loading {name} from {path}")
+        return OptimizationResultCollection.parse_file(path)
+
+    ds = OptimizationResultCollection.from_server(client, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write under a temporary name, so a crash can't leave a partial copy
+    tmp = path.with_name(f"{path.stem}.{os.getpid()}.tmp")
+    with open(tmp, "w") as out:
+        out.write(ds.json())
+    tmp.replace(path)
+    return ds
+
+
+def cache_size(cache_dir) -> int:
+    """Return the total size of the files in ``cache_dir`` in bytes."""
+    return sum(p.stat().st_size for p in Path(cache_dir).rglob("*") if p.is_file())
+
+
+def _record_caches(cache_dir) -> list[Path]:
+    """Return the sqlite files in ``cache_dir`` holding qcportal records."""
+    ret = list()
+    for path in Path(cache_dir).rglob("*.sqlite"):
+        if path.name == USAGE_FILE:
+            continue
+        with sqlite3.connect(path, timeout=60) as conn:
+            found = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'records'"
+            ).fetchone()
+        conn.close()
+        if found:
+            ret.append(path)
+    return ret
+
+
+def evict(cache_dir, max_size=DEFAULT_MAX_SIZE):
+    """Delete the least recently used optimization records in ``cache_dir``
+    until it holds at most ``max_size`` GiB."""
+    limit = max_size * 2**30
+    excess = cache_size(cache_dir) - limit
+    if excess <= 0:
+        return
+
+    caches = [sqlite3.connect(path, timeout=60) for path in _record_caches(cache_dir)]
+    usage = _usage(cache_dir)
+    freed = evicted = 0
+    lru = [row[0] for row in usage.execute("SELECT id FROM used ORDER BY time")]
+    for start in range(0, len(lru), EVICT_BATCH):
+        if freed >= excess:
+            break
+        batch = lru[start : start + EVICT_BATCH]
+        params = ",".join("?" * len(batch))
+        sizes = dict.fromkeys(batch, 0)
+        for conn in caches:
+            for record_id, size in conn.execute(
+                f"SELECT id, LENGTH(record) FROM records WHERE id IN ({params})",
+                batch,
+            ):
+                sizes[record_id] += size
+        # only evict as much of the last batch as needed
+        for n, record_id in enumerate(batch, start=1):
+            freed += sizes[record_id]
+            if freed >= excess:
+                batch = batch[:n]
+                break
+        params = ",".join("?" * len(batch))
+        for conn in caches:
+            conn.execute(f"DELETE FROM records WHERE id IN ({params})", batch)
+            conn.commit()
+        usage.execute(f"DELETE FROM used WHERE id IN ({params})", batch)
+        usage.commit()
+        evicted += len(batch)
+    usage.close()
+
+    # deleted rows only become free space on disk after a VACUUM
+    for conn in caches:
+        conn.execute("VACUUM")
+        conn.close()
+
+    size = cache_size(cache_dir)
+    print(
+        f"evicted {evicted} records from the QCArchive cache, which now holds "
+        f"{size / 2**30:.1f} GiB",
+        flush=True,
+    )
+    if size > limit:
+        logger.warning(
+            f"QCArchive cache at {cache_dir} is still over the limit of "
+            f"{max_size} GiB after evicting every tracked record"
+        )
@@ -0,0 +1,126 @@
+"""Cost-aware ordering of minimizations to avoid long tails in the pool.
+
+If conformers reach the workers in dataset order, a handful of large, flexible
+molecules scheduled near the end can leave most of the pool idle while they
+finish. Instead, ``plan_chunks`` estimates the cost of each conformer, sorts
+them from most to least expensive, and groups them into chunks of roughly
+equal cost: expensive conformers are dispatched first and on their own, while
+cheap ones are batched together to keep the overhead of submitting tasks to
+the pool low. This is the longest-processing-time-first heuristic, which keeps
+all of the workers busy until close to the end of the run.
+
+Costs come from the wall times recorded in previous runs' ``timings.csv``
+files where available, and otherwise from a simple model based on the number
+of atoms and rotatable bonds, scaled to match the recorded timings.
+"""
+
+import glob
+from functools import lru_cache
+
+import numpy
+import pandas
+
+from shard import n_atoms
+from timings import COLUMNS, load_timings
+
+# where to look for timings from previous runs by default
+HISTORY_GLOB = "submissions/*/output/**/timings.csv"
+
+# target number of chunks per worker
+CHUNKS_PER_WORKER = 8
+
+
+@lru_cache(maxsize=None)
+def rotatable_bonds(mapped_smiles: str) -> int:
+    """Return the number of rotatable bonds in ``mapped_smiles``."""
+    from rdkit import Chem
+    from rdkit.Chem.rdMolDescriptors import CalcNumRotatableBonds
+
+    mol = Chem.MolFromSmiles(mapped_smiles, sanitize=False)
+    if mol is None:
+        raise ValueError(f"failed to parse {mapped_smiles}")
+    try:
+        Chem.SanitizeMol(mol)
+    except Chem.MolSanitizeException:
+        # valences or aromaticity that RDKit rejects only cost the estimate
+        # its flexibility term
+        return 0
+    return CalcNumRotatableBonds(mol)
+
+
+def model_cost(mapped_smiles: str) -> float:
+    """Estimate the relative cost of minimizing a conformer of
+    ``mapped_smiles`` without any timing history. The cost of each energy
+    evaluation grows with the square of the number of atoms, and more flexible
+    molecules tend to need more iterations to converge."""
+    return n_atoms(mapped_smiles) ** 2 * (1 + 0.25 * rotatable_bonds(mapped_smiles))
+
+
+def history_timings(pattern=HISTORY_GLOB) -> pandas.DataFrame:
+    """Return the successful minimizations from every timings CSV file
+    matching ``pattern`` in a single DataFrame."""
+    frames = [load_timings(f) for f in glob.glob(pattern, recursive=True)]
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pandas.DataFrame(columns=COLUMNS)
+    df = pandas.concat(frames, ignore_index=True)
+    return df[df["status"] == "ok"]
+
+
+def wall_times(df) -> dict[tuple[int, str], float]:
+    """Return the median wall time in the timings ``df`` of each record ID
+    and force field, keyed by ``(rec_id, force_field)``."""
+    return df.groupby(["rec_id", "force_field"])["wall_time"].median().to_dict()
+
+
+def load_history(pattern=HISTORY_GLOB) -> dict[tuple[int, str], float]:
+    """Return the median recorded wall time of each record ID and force field
+    across every timings CSV file matching ``pattern``. Failed minimizations
+    are ignored."""
+    return wall_times(history_timings(pattern))
+
+
+def estimate_costs(inputs, history=None) -> list[float]:
+    """Estimate the cost in seconds of minimizing each ``MinimizationInput`` in
+    ``inputs``, using the wall times in ``history`` for its record ID and
+    force field where available.
+
+    Model costs are scaled by the median ratio of recorded time to model cost
+    over the records with a history, so both kinds of estimate are in the same
+    units. Without any history, the scale is arbitrary, but the ordering is
+    still meaningful."""
+    history = history or dict()
+    model = numpy.array([model_cost(inp.mapped_smiles) for inp in inputs])
+    known = [
+        (k, history[inp.qcarchive_id, inp.force_field])
+        for k, inp in enumerate(inputs)
+        if (inp.qcarchive_id, inp.force_field) in history
+    ]
+    scale = 1.0
+    if known:
+        scale = numpy.median([t / max(model[k], 1) for k, t in known])
+    costs = model * scale
+    for k, t in known:
+        costs[k] = t
+    return costs.tolist()
+
+
+def plan_chunks(items, costs, n_processes) -> list[list]:
+    """Sort ``items`` by decreasing ``costs`` and group them into chunks with
+    a total cost of about ``1 / CHUNKS_PER_WORKER`` of each worker's share of
+    the work. Items more expensive than that get a chunk to themselves."""
+    order = sorted(range(len(items)), key=lambda k: -costs[k])
+    target = sum(costs) / max(n_processes * CHUNKS_PER_WORKER, 1)
+
+    chunks = list()
+    chunk, total = list(), 0.0
+    for k in order:
+        chunk.append(items[k])
+        total += costs[k]
+        if total >= target:
+            chunks.append(chunk)
+            chunk, total = list(), 0.0
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
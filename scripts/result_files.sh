@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# Usage:
+# scripts/result_files.sh INPUT_DIR
+#
+# Print the result files written by main.py and plot.py to INPUT_DIR/output,
+# one per line. With several datasets or force fields, main.py writes each set
+# of results to its own subdirectory of output, so every directory below
+# output holding a dde.csv file is included.
+
+input_dir=${1?no input directory given}
+
+for d in $(find $input_dir/output -name dde.csv -exec dirname {} \; | sort)
+do
+	printf "%s\n" $d/{dde,icrmsd,rmsd,tfd}.csv $d/results.parquet $d/timings{.csv,_report.txt} \
+		$d/{dde,rmsd,rmsd_cdf,tfd,tfd_cdf,bonds,angles,dihedrals,impropers}.png
+done
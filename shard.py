@@ -0,0 +1,68 @@
+"""Helpers for splitting a benchmark run into shards that can be run on
+separate nodes and merged afterwards with merge.py.
+
+Shards are specified on the command line as ``i/N`` for the ``i``-th of ``N``
+shards, counting from 1. Records are assigned to shards by a greedy
+longest-processing-time partition of their estimated costs, so every shard gets
+roughly the same amount of work, and the assignment only depends on the
+contents of the pristine store. Every shard therefore agrees on the partition
+without any coordination, even when some of them are resumed.
+"""
+
+import heapq
+import re
+from pathlib import Path
+
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """Parse a shard specification of the form ``i/N`` into ``(i, N)``."""
+    try:
+        index, count = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"invalid shard specification: {spec!r}, expected i/N")
+    if not 1 <= index <= count:
+        raise ValueError(f"shard index must be between 1 and {count}: {spec!r}")
+    return index, count
+
+
+def n_atoms(mapped_smiles: str) -> int:
+    """Return the number of atoms in ``mapped_smiles`` by counting atom map
+    indices, without needing to build a molecule."""
+    return len(re.findall(r":\d+\]", mapped_smiles))
+
+
+def conformer_cost(mapped_smiles: str) -> float:
+    """Estimate the relative cost of minimizing a single conformer of
+    ``mapped_smiles``. Systems are built without a nonbonded cutoff, so this
+    grows with the square of the number of atoms."""
+    return n_atoms(mapped_smiles) ** 2
+
+
+def partition(costs: dict, count: int) -> list[set]:
+    """Split the keys of ``costs`` into ``count`` sets with approximately equal
+    total cost.
+
+    Keys are assigned in order of decreasing cost to the set with the lowest
+    running total, with ties broken by key and then by set index, so the result
+    is deterministic for a given ``costs``."""
+    shards = [set() for _ in range(count)]
+    heap = [(0, i) for i in range(count)]
+    for key in sorted(costs, key=lambda k: (-costs[k], k)):
+        total, i = heapq.heappop(heap)
+        shards[i].add(key)
+        heapq.heappush(heap, (total + costs[key], i))
+    return shards
+
+
+def select(costs: dict, index: int, count: int) -> set:
+    """Return the keys of ``costs`` assigned to shard ``index`` of ``count``."""
+    return partition(costs, count)[index - 1]
+
+
+def fragment_path(sqlite_file, index: int, count: int) -> Path:
+    """Return the path of the sqlite fragment written by shard ``index`` of
+    ``count`` in place of ``sqlite_file``."""
+    sqlite_file = Path(sqlite_file)
+    return sqlite_file.with_name(
+        f"{sqlite_file.stem}-shard-{index}-of-{count}{sqlite_file.suffix}"
+    )
@@ -0,0 +1,78 @@
+"""Content-addressed cache of pristine, QM-only yammbs stores.
+
+Ingesting a dataset JSON file into a fresh sqlite store is one of the slowest
+parts of setting up a benchmark run, and it produces exactly the same database
+every time for a given dataset file and yammbs version. Instead of repeating
+that work for every submission, the pristine store is built once, saved in a
+cache directory under a name derived from a hash of the dataset file contents
+and the installed yammbs version, and simply copied into place for each new
+run.
+
+The default cache directory is ``~/.cache/yammbs-dataset-submission``, but this
+can be overridden with the ``YDS_CACHE_DIR`` environment variable or by passing
+``cache_dir`` explicitly.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+from importlib.metadata import version
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get(
+        "YDS_CACHE_DIR", Path.home() / ".cache" / "yammbs-dataset-submission"
+    )
+)
+
+
+def dataset_key(dataset, kind: str) -> str:
+    """Return a hex digest identifying the store built from ``dataset``.
+
+    ``kind`` distinguishes between store types built from the same file (e.g.
+    ``"molecule"`` or ``"torsion"``), and the installed yammbs version is
+    included so that a yammbs upgrade, which may change the database schema,
+    never reuses an old store."""
+    h = hashlib.sha256()
+    h.update(kind.encode())
+    h.update(version("yammbs").encode())
+    with open(dataset, "rb") as inp:
+        for chunk in iter(lambda: inp.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cached_store_path(dataset, kind: str, cache_dir=None) -> Path:
+    """Return the path to the pristine store for ``dataset`` in ``cache_dir``,
+    whether or not it exists yet."""
+    cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+    return cache_dir / f"{kind}-{dataset_key(dataset, kind)}.sqlite"
+
+
+def clone_store(dataset, sqlite_file, build, kind: str, cache_dir=None):
+    """Copy the pristine store for ``dataset`` to ``sqlite_file``.
+
+    If the store is not already cached, ``build(dataset, path)`` is called to
+    ingest ``dataset`` into a new sqlite database at ``path`` first. The store
+    is built under a temporary name and moved into place afterwards, so an
+    interrupted build never leaves a partial store in the cache."""
+    cached = cached_store_path(dataset, kind, cache_dir)
+    if cached.exists():
+        print(f"using cached {kind} store for {dataset}: {cached}", flush=True)
+    else:
+        print(f"building {kind} store for {dataset} in {cached}", flush=True)
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        # yammbs insists on a .sqlite suffix, so keep it on the temporary file
+        tmp = cached.with_name(f"{cached.stem}.{os.getpid()}.sqlite")
+        try:
+            build(dataset, tmp)
+            os.replace(tmp, cached)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    logger.info(f"copying {cached} to {sqlite_file}")
+    shutil.copyfile(cached, sqlite_file)
@@ -0,0 +1,260 @@
+"""A JSON-lines stream of progress events for long-running scripts.
+
+``main.py``, ``torsions.py``, ``merge.py``, and
+``datasets/download_and_filter_dataset.py`` append one JSON object per line to
+an events file (``events.jsonl`` by default) as they run. Every event has a
+``time``, an ``event`` type, and the ``pid`` of the process that wrote it:
+
+* ``run_start`` is written when a script starts writing events, with its
+  command line in ``argv``. Since runs append to the same file, summaries only
+  cover the events after the last ``run_start``;
+* ``stage_start`` and ``stage_end`` bracket each stage of a run, with the
+  stage's ``duration`` and ``status`` (``ok`` or ``failed``) at the end;
+* ``progress`` events are written every ``PROGRESS_INTERVAL`` seconds while
+  items are processed, with the number ``done`` out of ``total``, the number
+  of ``failures``, the ``rate`` over the last ``RATE_WINDOW`` seconds, an
+  ``eta`` in seconds, and the current resource usage.
+
+Summarize a run's events, optionally following the file as it grows and
+warning if the run is projected to take longer than a limit, with:
+
+    python telemetry.py [--follow] [--limit HOURS] events.jsonl
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from mempool import rss
+
+DEFAULT_EVENTS = "events.jsonl"
+
+# seconds between progress events
+PROGRESS_INTERVAL = 10
+
+# seconds over which the rolling throughput is measured
+RATE_WINDOW = 300
+
+# where events are written, set by configure
+_stream = dict(path=None)
+
+
+def add_events_argument(parser):
+    """Add an ``--events`` flag to the ``argparse.ArgumentParser``
+    ``parser``."""
+    parser.add_argument(
+        "--events",
+        default=DEFAULT_EVENTS,
+        help="File to append JSON-lines progress events to, or an empty "
+        "string to disable them. Defaults to %(default)s",
+    )
+
+
+def configure(path):
+    """Write events from this process to ``path``, or disable them if
+    ``path`` is empty or ``None``, starting with a ``run_start`` event."""
+    _stream["path"] = path or None
+    emit("run_start", argv=sys.argv)
+
+
+def emit(event, **fields):
+    """Append an event of type ``event`` with ``fields`` to the events file,
+    if one has been configured."""
+    if _stream["path"] is None:
+        return
+    record = dict(time=time.time(), event=event, pid=os.getpid(), **fields)
+    with open(_stream["path"], "a") as out:
+        out.write(json.dumps(record) + "\n")
+
+
+def resources() -> dict:
+    """Return the load average, this process's resident memory in MiB, and
+    the available system memory in MiB, where they can be read."""
+    ret = dict(rss=rss())
+    try:
+        ret["load"] = os.getloadavg()[0]
+    except OSError:
+        pass
+    try:
+        with open("/proc/meminfo") as inp:
+            for line in inp:
+                if line.startswith("MemAvailable:"):
+                    ret["mem_available"] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return ret
+
+
+@contextmanager
+def stage(name, **fields):
+    """Emit ``stage_start`` and ``stage_end`` events around a block of code
+    for the stage ``name``."""
+    emit("stage_start", stage=name, **fields)
+    start = time.time()
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    finally:
+        emit(
+            "stage_end",
+            stage=name,
+            status=status,
+            duration=time.time() - start,
+            **fields,
+        )
+
+
+def progress(items, stage, total, failed=None, interval=PROGRESS_INTERVAL):
+    """Yield each of ``items`` unchanged, emitting ``progress`` events for
+    ``stage`` out of ``total`` items every ``interval`` seconds and once at
+    the end. Items for which ``failed(item)`` is true are counted as
+    failures."""
+    done = failures = 0
+    start = last = time.time()
+    window = deque([(start, 0)])
+
+    def report(now):
+        while len(window) > 1 and window[0][0] < now - RATE_WINDOW:
+            window.popleft()
+        t0, n0 = window[0]
+        rate = (done - n0) / (now - t0) if now > t0 else 0.0
+        eta = (total - done) / rate if rate > 0 else None
+        emit(
+            "progress",
+            stage=stage,
+            done=done,
+            total=total,
+            failures=failures,
+            elapsed=now - start,
+            rate=rate,
+            eta=eta,
+            **resources(),
+        )
+
+    for item in items:
+        done += 1
+        if failed is not None and failed(item):
+            failures += 1
+        now = time.time()
+        if now - last >= interval:
+            window.append((now, done))
+            report(now)
+            last = now
+        yield item
+    report(time.time())
+
+
+def summarize(events, limit=None) -> str:
+    """Return a plain-text summary of the parsed ``events`` of the most
+    recent run, warning if it is projected to take longer than ``limit``
+    hours in total."""
+    starts = [i for i, e in enumerate(events) if e["event"] == "run_start"]
+    if starts:
+        events = events[starts[-1] :]
+    if not events:
+        return "no events yet"
+    start = events[0]["time"]
+    stages = dict()
+    for event in events:
+        if "stage" not in event:
+            continue
+        s = stages.setdefault(event["stage"], dict())
+        if event["event"] == "stage_start":
+            s.clear()
+            s["start"] = event["time"]
+        elif event["event"] == "stage_end":
+            s["end"] = event
+        elif event["event"] == "progress":
+            s["progress"] = event
+
+    now = time.time()
+    lines = [f"{len(events)} events over {(events[-1]['time'] - start) / 60:.1f} min"]
+    projected = None
+    for name, s in stages.items():
+        if "end" in s:
+            end = s["end"]
+            lines.append(
+                f"  {name}: {end['status']} after {end['duration'] / 60:.1f} min"
+            )
+            continue
+        line = f"  {name}: running"
+        p = s.get("progress")
+        if p is not None:
+            line += (
+                f", {p['done']}/{p['total']} done, {p['failures']} failed, "
+                f"{60 * p['rate']:.1f}/min"
+            )
+            if p["eta"] is not None:
+                line += f", ETA {p['eta'] / 60:.1f} min"
+                projected = p["time"] + p["eta"] - start
+            if "rss" in p and p["rss"] is not None:
+                line += f", parent RSS {p['rss']:.0f} MiB"
+            if "mem_available" in p:
+                line += f", {p['mem_available'] / 1024:.1f} GiB free"
+            if "load" in p:
+                line += f", load {p['load']:.1f}"
+            if now - p["time"] > 3 * PROGRESS_INTERVAL:
+                line += f" (no progress for {(now - p['time']) / 60:.1f} min)"
+        lines.append(line)
+
+    if limit is not None and projected is not None and projected > 3600 * limit:
+        lines.append(
+            f"WARNING: projected to run for {projected / 3600:.1f} hours, "
+            f"over the limit of {limit} hours"
+        )
+    return "\n".join(lines)
+
+
+def read_events(path, offset=0) -> tuple[list[dict], int]:
+    """Return the complete events in ``path`` after byte ``offset`` and the
+    offset to continue from."""
+    events = list()
+    with open(path, "rb") as inp:
+        inp.seek(offset)
+        for line in inp:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            events.append(json.loads(line))
+    return events, offset
+
+
+def main():
+    a = argparse.ArgumentParser(
+        prog="python telemetry.py",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    a.add_argument("events", help="Path to the JSON-lines events file")
+    a.add_argument(
+        "--follow",
+        "-f",
+        action="store_true",
+        help="Keep reading events as they are written and reprint the summary",
+    )
+    a.add_argument(
+        "--limit",
+        type=float,
+        default=None,
+        help="Warn if the run is projected to take longer than this many hours",
+    )
+    args = a.parse_args()
+
+    events, offset = read_events(args.events)
+    print(summarize(events, args.limit), flush=True)
+    while args.follow:
+        time.sleep(PROGRESS_INTERVAL)
+        new, offset = read_events(args.events, offset)
+        if new:
+            events.extend(new)
+            print(flush=True)
+            print(summarize(events, args.limit), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+pytest.importorskip("ijson")
+
+from dataset_pack import PackedDataset, is_packed, pack, subset, unpack  # noqa: E402
+
+ADDRESS = "https://api.qcarchive.molssi.org:443/"
+
+
+def molecules(n):
+    return dict(
+        tag="QCArchive dataset",
+        version=1,
+        qm_molecules=[
+            dict(qcarchive_id=100 + i, mapped_smiles="[H:1][H:2]", energy=-1.5 * i)
+            for i in range(n)
+        ],
+    )
+
+
+def collection(n):
+    return dict(
+        entries={
+            ADDRESS: [
+                dict(record_id=i, cmiles="[H:1][H:2]", inchi_key=f"KEY{i // 3}")
+                for i in range(n)
+            ]
+        },
+        provenance=dict(applied_filters=dict()),
+        type="OptimizationResultCollection",
+    )
+
+
+@pytest.mark.parametrize(
+    "doc, n", [(molecules(10), 10), (molecules(8), 8), (collection(11), 11)]
+)
+def test_round_trip(tmp_path, doc, n):
+    src, packed, out = tmp_path / "in.json", tmp_path / "in.pack", tmp_path / "out.json"
+    src.write_text(json.dumps(doc))
+
+    assert pack(src, packed, chunk_size=4) == n
+    assert is_packed(packed) and not is_packed(src)
+    unpack(packed, out)
+    assert json.loads(out.read_text()) == doc
+
+
+def test_random_access(tmp_path):
+    src, packed = tmp_path / "in.json", tmp_path / "in.pack"
+    doc = molecules(10)
+    src.write_text(json.dumps(doc))
+    pack(src, packed, chunk_size=3)
+
+    with PackedDataset(packed) as ds:
+        assert len(ds) == 10
+        assert ds.ids() == list(range(100, 110))
+        assert ds.get(107) == doc["qm_molecules"][7]
+        assert 200 not in ds
+        with pytest.raises(KeyError):
+            ds.get(200)
+        assert [e["qcarchive_id"] for _, e in ds.entries([109, 101])] == [101, 109]
+
+
+def test_subset(tmp_path):
+    src, packed = tmp_path / "in.json", tmp_path / "in.pack"
+    doc = collection(11)
+    src.write_text(json.dumps(doc))
+    pack(src, packed)
+
+    for dataset in [src, packed]:
+        out = tmp_path / "out.json"
+        assert subset(dataset, out, record_ids=[2, 5, 8, 40], first=2) == 2
+        got = json.loads(out.read_text())
+        assert [e["record_id"] for e in got["entries"][ADDRESS]] == [2, 5]
+        assert got["type"] == doc["type"]
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+pytest.importorskip("ijson")
+pytest.importorskip("yammbs")
+
+from yammbs import MoleculeStore  # noqa: E402
+from yammbs.exceptions import DatabaseExistsError  # noqa: E402
+from yammbs.torsion import TorsionStore  # noqa: E402
+
+from ingest import stream_molecule_store, stream_torsion_store  # noqa: E402
+
+WATER = "[H:2][O:1][H:3]"
+ETHANE = "[H:3][C:1]([H:4])([H:5])[C:2]([H:6])([H:7])[H:8]"
+METHANE = "[H:2][C:1]([H:3])([H:4])[H:5]"
+
+
+def conformer(qcarchive_id, smiles, n_atoms):
+    coordinates = [[0.1 * qcarchive_id + i, 0.0, 0.0] for i in range(n_atoms)]
+    return dict(
+        qcarchive_id=qcarchive_id,
+        mapped_smiles=smiles,
+        coordinates=coordinates,
+        final_energy=-1.5 * qcarchive_id,
+    )
+
+
+def test_stream_molecule_store(tmp_path):
+    molecules = [conformer(i, WATER, 3) for i in range(3)]
+    molecules += [conformer(i, METHANE, 5) for i in range(3, 8)]
+    dataset, sqlite_file = tmp_path / "cache.json", tmp_path / "store.sqlite"
+    dataset.write_text(json.dumps(dict(qm_molecules=molecules)))
+
+    stream_molecule_store(dataset, sqlite_file, batch_size=2)
+
+    store = MoleculeStore(sqlite_file)
+    assert len(store.get_molecule_ids()) == 2
+    assert sorted(
+        qcarchive_id
+        for molecule_id in store.get_molecule_ids()
+        for qcarchive_id in store.get_qcarchive_ids_by_molecule_id(molecule_id)
+    ) == list(range(8))
+
+    with pytest.raises(DatabaseExistsError):
+        stream_molecule_store(dataset, sqlite_file, batch_size=2)
+
+
+def test_stream_torsion_store(tmp_path):
+    drives = [
+        dict(
+            id=100 + i,
+            mapped_smiles=ETHANE,
+            dihedral_indices=[3, 1, 2, 6],
+            coordinates={
+                angle: [[0.1 * i + j, angle / 100, 0.0] for j in range(8)]
+                for angle in [-60, 0, 60]
+            },
+            energies={angle: -1.5 * i + angle / 1000 for angle in [-60, 0, 60]},
+        )
+        for i in range(5)
+    ]
+    dataset, sqlite_file = tmp_path / "torsions.json", tmp_path / "store.sqlite"
+    dataset.write_text(json.dumps(dict(qm_torsions=drives)))
+
+    stream_torsion_store(dataset, sqlite_file, batch_size=2)
+
+    assert len(TorsionStore(sqlite_file).get_molecule_ids()) == 5
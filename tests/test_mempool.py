@@ -0,0 +1,68 @@
+import os
+from functools import partial
+
+import pytest
+
+from mempool import Limits, MemoryBoundedPool
+
+
+def square(x):
+    return x * x
+
+
+def crash_once(path, x):
+    if x == 3 and not os.path.exists(path):
+        open(path, "w").close()
+        os._exit(1)
+    return x * x
+
+
+def crash(x):
+    if x == 3:
+        os._exit(1)
+    return x * x
+
+
+def fail(x):
+    raise ValueError(x)
+
+
+def fail_init():
+    raise ValueError("initializer")
+
+
+def test_recycling():
+    with MemoryBoundedPool(2, limits=Limits(max_tasks=2)) as pool:
+        results = sorted(pool.imap_unordered(square, range(20), chunksize=3))
+        assert results == [x * x for x in range(20)]
+        # 7 chunks, retiring each worker after 2 of them
+        assert pool.stats.recycled >= 3
+
+
+def test_dead_worker_is_retried(tmp_path):
+    fn = partial(crash_once, tmp_path / "crashed")
+    with MemoryBoundedPool(2) as pool:
+        results = sorted(pool.imap_unordered(fn, range(10)))
+    assert results == [x * x for x in range(10)]
+    assert pool.stats.lost == 0
+
+
+def test_twice_dead_worker_raises():
+    results = list()
+    with pytest.raises(RuntimeError, match="1 item"):
+        with MemoryBoundedPool(2) as pool:
+            results.extend(pool.imap_unordered(crash, range(10)))
+    assert sorted(results) == [x * x for x in range(10) if x != 3]
+    assert pool.stats.lost == 1
+
+
+def test_initializer_errors_are_raised():
+    with pytest.raises(ValueError, match="initializer"):
+        with MemoryBoundedPool(2, initializer=fail_init) as pool:
+            list(pool.imap_unordered(square, range(4)))
+
+
+def test_errors_are_raised():
+    with pytest.raises(ValueError):
+        with MemoryBoundedPool(2) as pool:
+            list(pool.imap_unordered(fail, range(4)))
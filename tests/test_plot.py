@@ -0,0 +1,58 @@
+import pytest
+
+numpy = pytest.importorskip("numpy")
+pandas = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+pytest.importorskip("click")
+pytest.importorskip("seaborn")
+pytest.importorskip("matplotlib")
+
+from plot import BENCH_COLUMNS, load_bench  # noqa: E402
+
+# molecule 1 has three conformers, molecule 2 only one, so it has no DDE, and
+# the TFD failed for the first conformer of molecule 3
+MOLECULES = {1: 1, 2: 1, 3: 1, 4: 2, 5: 3, 6: 3}
+DDE = {1: numpy.nan, 2: 0.5, 3: -1.0, 5: numpy.nan, 6: 2.0}
+TFD = {1: 0.1, 2: 0.2, 3: 0.3, 4: 0.4, 6: 0.6}
+
+
+def write_results(d):
+    """Write the same results in the CSV and table formats of ``metrics.py``."""
+    ids = list(MOLECULES)
+    frames = dict(
+        dde=pandas.DataFrame({"difference": DDE}),
+        rmsd=pandas.DataFrame({"rmsd": {i: 0.01 * i for i in ids}}),
+        tfd=pandas.DataFrame({"tfd": TFD}),
+        icrmsd=pandas.DataFrame(
+            {
+                column: {i: n + 0.1 * i for i in ids}
+                for n, column in enumerate(["Bond", "Angle", "Dihedral", "Improper"])
+            }
+        ),
+    )
+    renames = dict(
+        difference="dde",
+        Bond="bonds",
+        Angle="angles",
+        Dihedral="dihedrals",
+        Improper="impropers",
+    )
+    table = pandas.DataFrame({"molecule_id": MOLECULES})
+    for metric, frame in frames.items():
+        frame.to_csv(d / f"{metric}.csv")
+        table = table.join(frame.rename(columns=renames), how="left")
+    table.rename_axis("rec_id").reset_index().to_parquet(d / "results.parquet")
+
+
+def test_load_bench(tmp_path):
+    write_results(tmp_path)
+    table = load_bench(tmp_path)
+    (tmp_path / "results.parquet").unlink()
+    csvs = load_bench(tmp_path)
+
+    assert list(table.columns) == BENCH_COLUMNS
+    assert table["rec_id"].tolist() == [1, 2, 3, 6]
+    pandas.testing.assert_frame_equal(
+        table.sort_values("rec_id").reset_index(drop=True),
+        csvs.sort_values("rec_id").reset_index(drop=True),
+    )
@@ -0,0 +1,71 @@
+import pytest
+
+numpy = pytest.importorskip("numpy")
+pandas = pytest.importorskip("pandas")
+pytest.importorskip("seaborn")
+pytest.importorskip("matplotlib")
+
+from plot_torsions import plot  # noqa: E402
+from torsion_outputs import METRICS_FILE, MINIMIZED_FILE, write_records  # noqa: E402
+
+QM = {
+    1: {"-90": 3.0, "0": 1.0, "90": 5.0},
+    2: {"-90": 0.0, "0": 1.0, "90": 2.0},
+}
+# the MM energies of openff-b are shifted, and it is missing a point of
+# molecule 2
+MM = {
+    ("openff-a", 1): {"-90": 2.0, "0": 0.0, "90": 4.0},
+    ("openff-a", 2): {"-90": 0.0, "0": 1.0, "90": 2.0},
+    ("openff-b", 1): {"-90": 11.0, "0": 10.0, "90": 13.0},
+    ("openff-b", 2): {"-90": 5.0, "0": 7.0},
+}
+# there are no metrics for openff-b on molecule 2, and they are written in a
+# different order from the profiles
+METRICS = [
+    dict(force_field="openff-b", molecule_id=1, rmsd=0.3, een=1.5),
+    dict(force_field="openff-a", molecule_id=2, rmsd=0.2, een=0.5),
+    dict(force_field="openff-a", molecule_id=1, rmsd=0.1, een=0.0),
+]
+
+
+def minimized():
+    for (force_field, molecule_id), energies in MM.items():
+        yield dict(
+            force_field=force_field,
+            molecule_id=molecule_id,
+            mapped_smiles="[H:3][C:1]([H:4])([H:5])[C:2]([H:6])([H:7])[H:8]",
+            dihedral_indices=[2, 0, 1, 5],
+            coordinates=dict(),
+            energies=energies,
+            qm_energies=QM[molecule_id],
+        )
+
+
+def test_torsion_summary(tmp_path):
+    output = tmp_path / "output"
+    output.mkdir()
+    write_records(output / MINIMIZED_FILE, minimized())
+    write_records(output / METRICS_FILE, METRICS)
+
+    plot(tmp_path, tmp_path / "plots")
+
+    summary = pandas.read_csv(tmp_path / "plots" / "torsion_summary.csv")
+    summary = summary.set_index(["force_field", "molecule_id"])
+    assert len(summary) == 4
+    numpy.testing.assert_allclose(
+        summary["profile_rmse"].loc[[("openff-a", 1), ("openff-a", 2)]], 0.0
+    )
+    assert summary.loc[("openff-b", 1), "profile_rmse"] == pytest.approx((2 / 3) ** 0.5)
+    # the missing point is skipped rather than counted as an error
+    assert summary.loc[("openff-b", 2), "profile_rmse"] == pytest.approx(0.5**0.5)
+    assert summary.loc[("openff-b", 2), "profile_max_error"] == pytest.approx(1.0)
+    assert summary.loc[("openff-b", 1), "qm_barrier"] == pytest.approx(4.0)
+    assert summary.loc[("openff-b", 1), "mm_barrier"] == pytest.approx(3.0)
+    assert summary.loc[("openff-b", 2), "mm_barrier"] == pytest.approx(2.0)
+
+    assert summary.loc[("openff-a", 1), "rmsd"] == pytest.approx(0.1)
+    assert summary.loc[("openff-a", 2), "een"] == pytest.approx(0.5)
+    assert summary.loc[("openff-b", 1), "een"] == pytest.approx(1.5)
+    assert numpy.isnan(summary.loc[("openff-b", 2), "rmsd"])
+    assert (tmp_path / "plots" / "profiles" / "profiles-001.png").exists()
@@ -0,0 +1,37 @@
+import pytest
+
+from shard import fragment_path, n_atoms, parse_shard, partition, select
+
+
+def test_parse_shard():
+    assert parse_shard("1/4") == (1, 4)
+    assert parse_shard("4/4") == (4, 4)
+
+    for bad in ["0/4", "5/4", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            parse_shard(bad)
+
+
+def test_n_atoms():
+    assert n_atoms("[H:2][C:1]([H:3])([H:4])[H:5]") == 5
+
+
+def test_partition():
+    costs = {i: c for i, c in enumerate([10, 9, 8, 7, 6, 5, 4, 3, 2, 1])}
+    shards = partition(costs, 3)
+
+    # every key lands in exactly one shard
+    assert sorted(k for s in shards for k in s) == sorted(costs)
+
+    # and the shards are balanced
+    totals = [sum(costs[k] for k in s) for s in shards]
+    assert max(totals) - min(totals) <= max(costs.values())
+
+    # and independent of insertion order
+    reordered = dict(reversed(costs.items()))
+    assert partition(reordered, 3) == shards
+    assert select(reordered, 2, 3) == shards[1]
+
+
+def test_fragment_path():
+    assert str(fragment_path("tmp.sqlite", 2, 8)) == "tmp-shard-2-of-8.sqlite"
@@ -0,0 +1,44 @@
+import telemetry
+
+
+def test_events(tmp_path):
+    path = tmp_path / "events.jsonl"
+    telemetry.configure(path)
+    try:
+        with telemetry.stage("minimize"):
+            items = telemetry.progress(
+                range(10), "minimize", 10, failed=lambda x: x % 5 == 0
+            )
+            assert list(items) == list(range(10))
+    finally:
+        telemetry.configure(None)
+
+    events, offset = telemetry.read_events(path)
+    assert offset == path.stat().st_size
+    assert [e["event"] for e in events] == [
+        "run_start",
+        "stage_start",
+        "progress",
+        "stage_end",
+    ]
+    assert events[2]["done"] == 10
+    assert events[2]["failures"] == 2
+    assert events[3]["status"] == "ok"
+    assert "minimize: ok" in telemetry.summarize(events)
+
+
+def test_summarize_last_run(tmp_path):
+    path = tmp_path / "events.jsonl"
+    for name in ["first", "second"]:
+        telemetry.configure(path)
+        try:
+            with telemetry.stage(name):
+                pass
+        finally:
+            telemetry.configure(None)
+
+    events, _ = telemetry.read_events(path)
+    summary = telemetry.summarize(events)
+    assert summary.startswith("3 events")
+    assert "second: ok" in summary
+    assert "first" not in summary
@@ -0,0 +1,22 @@
+import pytest
+
+pandas = pytest.importorskip("pandas")
+
+from torsion_outputs import metric_records, read_records, write_records  # noqa: E402
+
+
+def test_round_trip(tmp_path):
+    rmsds = pandas.DataFrame({"rmsd": {3: 0.25, 1: 0.5, 2: 1.0}})
+    eens = pandas.DataFrame({"een": {1: -1.5, 2: 0.0, 3: 2.0}})
+    path = tmp_path / "metrics.jsonl.gz"
+
+    assert write_records(path, metric_records("openff-2.2.0", rmsds, eens)) == 3
+
+    records = list(read_records(path))
+    assert records == [
+        dict(force_field="openff-2.2.0", molecule_id=3, rmsd=0.25, een=2.0),
+        dict(force_field="openff-2.2.0", molecule_id=1, rmsd=0.5, een=-1.5),
+        dict(force_field="openff-2.2.0", molecule_id=2, rmsd=1.0, een=0.0),
+    ]
+    assert list(read_records(path, [2, 3, 4])) == [records[0], records[2]]
+    assert list(read_records(path, [])) == []
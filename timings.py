@@ -0,0 +1,206 @@
+"""Per-conformer timing and convergence instrumentation for minimizations.
+
+Every minimization run through ``minimize.optimize_mm`` records its wall time,
+number of minimizer iterations, atom count, status, and the PID and peak memory
+of the worker that ran it. OpenMM's minimizer reports each iteration but not
+the number of energy and force evaluations it makes, so those aren't recorded.
+These rows are appended to a CSV file next to the sqlite store each time
+results are checkpointed, so they survive resumed and sharded runs, and are
+copied to ``timings.csv`` in the output directory at the end of a run, along
+with a short text report summarizing them.
+
+The report can also be regenerated from a timings CSV file with:
+
+    python timings.py path/to/timings.csv
+"""
+
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas
+
+from shard import n_atoms
+
+COLUMNS = [
+    "rec_id",
+    "force_field",
+    "n_atoms",
+    "status",
+    "iterations",
+    "pid",
+    "max_rss",
+    "start",
+    "end",
+    "wall_time",
+]
+
+# number of iterations taken by the most recent minimization in this process,
+# updated by the reporter installed by counting_iterations
+_iterations = [0]
+
+
+@contextmanager
+def counting_iterations():
+    """Wrap ``openmm.LocalEnergyMinimizer.minimize`` within the block so that
+    it records the number of iterations taken by each minimization, restoring
+    the original method on exit.
+
+    yammbs does not expose the iteration count, so this attaches a
+    ``MinimizationReporter`` to any call that doesn't already have one. The
+    reporter never asks the minimizer to stop, so the results are unchanged."""
+    import openmm
+
+    class IterationCounter(openmm.MinimizationReporter):
+        def report(self, iteration, x, grad, args):
+            _iterations[0] = iteration + 1
+            return False
+
+    minimize = openmm.LocalEnergyMinimizer.minimize
+
+    def counted(context, tolerance=10, maxIterations=0, reporter=None):
+        if reporter is None:
+            reporter = IterationCounter()
+        return minimize(context, tolerance, maxIterations, reporter)
+
+    _iterations[0] = 0
+    openmm.LocalEnergyMinimizer.minimize = staticmethod(counted)
+    try:
+        yield
+    finally:
+        openmm.LocalEnergyMinimizer.minimize = staticmethod(minimize)
+
+
+def timed(fn, input) -> tuple:
+    """Call ``fn(input)`` for the ``MinimizationInput`` ``input``, counting
+    the minimizer's iterations, and return the result along with a timing row
+    for it."""
+    start = time.time()
+    try:
+        with counting_iterations():
+            result = fn(input)
+    finally:
+        end = time.time()
+    row = dict(
+        rec_id=input.qcarchive_id,
+        force_field=input.force_field,
+        n_atoms=n_atoms(input.mapped_smiles),
+        status="failed" if result is None else "ok",
+        iterations=_iterations[0],
+        pid=os.getpid(),
+        # peak resident memory of the worker so far, in MiB
+        max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        start=start,
+        end=end,
+        wall_time=end - start,
+    )
+    return result, row
+
+
+def sidecar_path(sqlite_file) -> Path:
+    """Return the path of the timings CSV file for the store in
+    ``sqlite_file``."""
+    sqlite_file = Path(sqlite_file)
+    return sqlite_file.with_name(f"{sqlite_file.stem}.timings.csv")
+
+
+def append_timings(path, rows):
+    """Append the timing ``rows`` to the CSV file at ``path``, creating it if
+    necessary.
+
+    A file written by an older version with different columns, such as one
+    without ``max_rss``, is first rewritten with the current columns, leaving
+    the values of any new columns empty in its existing rows."""
+    if not rows:
+        return
+    path = Path(path)
+    if path.exists():
+        with open(path) as f:
+            header = f.readline().rstrip("\n").split(",")
+        if header != COLUMNS:
+            df = pandas.read_csv(path).reindex(columns=COLUMNS)
+            df.to_csv(path, index=False)
+    pandas.DataFrame(rows, columns=COLUMNS).to_csv(
+        path, mode="a", header=not path.exists(), index=False
+    )
+
+
+def load_timings(path) -> pandas.DataFrame:
+    """Load the timings CSV file at ``path``, returning an empty DataFrame if
+    it doesn't exist. Only the last row for each record and force field is
+    kept, since failed minimizations are retried by resumed runs."""
+    path = Path(path)
+    if not path.exists():
+        return pandas.DataFrame(columns=COLUMNS)
+    df = pandas.read_csv(path)
+    return df.drop_duplicates(["rec_id", "force_field"], keep="last")
+
+
+def report(df: pandas.DataFrame, top=20, bins=20) -> str:
+    """Return a plain-text summary of the timings in ``df``: overall totals,
+    the ``top`` slowest records, throughput over ``bins`` equal time windows,
+    and the utilisation of each worker process."""
+    if df.empty:
+        return "no timings recorded\n"
+
+    lines = list()
+    span = df["end"].max() - df["start"].min()
+    failed = (df["status"] != "ok").sum()
+    lines.append(
+        f"{len(df)} minimizations ({failed} failed) on {df['pid'].nunique()} "
+        f"workers in {span:.1f} sec, {df['wall_time'].sum():.1f} sec of "
+        "minimization time"
+    )
+    lines.append(
+        f"wall time per minimization: median {df['wall_time'].median():.2f} "
+        f"sec, max {df['wall_time'].max():.2f} sec"
+    )
+
+    lines.append("")
+    lines.append(f"slowest {top} minimizations:")
+    slowest = df.nlargest(top, "wall_time")[
+        ["rec_id", "force_field", "n_atoms", "iterations", "status", "wall_time"]
+    ]
+    lines.append(slowest.to_string(index=False))
+
+    lines.append("")
+    lines.append("throughput over time (minimizations finished per minute):")
+    elapsed = df["end"] - df["start"].min()
+    width = max(span / bins, 1e-9)
+    counts = (elapsed // width).clip(upper=bins - 1).value_counts().sort_index()
+    for b, count in counts.items():
+        lines.append(
+            f"  {b * width:10.1f} - {(b + 1) * width:10.1f} sec: "
+            f"{60 * count / width:8.1f}"
+        )
+
+    lines.append("")
+    lines.append("per-worker utilisation:")
+    workers = df.groupby("pid").agg(
+        tasks=("wall_time", "size"),
+        busy=("wall_time", "sum"),
+        last=("end", "max"),
+    )
+    workers["utilisation"] = workers["busy"] / span
+    workers["idle_at_end"] = df["end"].max() - workers["last"]
+    lines.append(
+        workers[["tasks", "busy", "utilisation", "idle_at_end"]].to_string(
+            float_format=lambda x: f"{x:.2f}"
+        )
+    )
+
+    return "\n".join(lines) + "\n"
+
+
+def write_timings(df: pandas.DataFrame, out_dir):
+    """Write the timings in ``df`` and their report to ``out_dir``."""
+    df.to_csv(f"{out_dir}/timings.csv", index=False)
+    with open(f"{out_dir}/timings_report.txt", "w") as out:
+        out.write(report(df))
+
+
+if __name__ == "__main__":
+    print(report(load_timings(sys.argv[1])), end="")
@@ -0,0 +1,137 @@
+"""Streaming, compressed output files for torsion benchmarks.
+
+``store.get_outputs().model_dump_json()`` builds every minimized torsion
+profile for every force field as one pydantic model and then one JSON string
+before anything is written, which doubles the peak memory of a torsion run
+right at the end. Instead, ``torsions.py`` writes its outputs as
+gzip-compressed JSON lines, one torsion drive per line, querying the store for
+one drive at a time:
+
+* ``minimized.jsonl.gz`` has the ``force_field``, ``molecule_id``,
+  ``mapped_smiles``, ``dihedral_indices``, flattened MM ``coordinates``, and
+  MM ``energies`` of each drive, keyed by grid angle, as in the profiles of
+  the old ``minimized.json``, along with the ``qm_energies`` for comparison;
+  and
+* ``metrics.jsonl.gz`` has the ``force_field``, ``molecule_id``, ``rmsd``, and
+  ``een`` of each drive, as in the old ``metrics.json``.
+
+Read them back one drive at a time with ``read_records``, for example:
+
+    for drive in read_records("output/minimized.jsonl.gz"):
+        ...
+"""
+
+import gzip
+import json
+import os
+
+import numpy
+
+MINIMIZED_FILE = "minimized.jsonl.gz"
+METRICS_FILE = "metrics.jsonl.gz"
+
+
+def write_records(path, records) -> int:
+    """Write each of the dicts in ``records`` to ``path`` as a line of
+    gzip-compressed JSON, returning the number written."""
+    n = 0
+    with gzip.open(path, "wt") as out:
+        for record in records:
+            out.write(json.dumps(record) + "\n")
+            n += 1
+    return n
+
+
+def read_records(path, molecule_ids=None):
+    """Yield the records in the gzip-compressed JSON-lines file ``path`` one
+    at a time, optionally only those with a ``molecule_id`` in
+    ``molecule_ids``.
+
+    There is no index, so selecting by ``molecule_ids`` is a linear scan that
+    still decompresses and parses every line of the file, and only saves the
+    memory of the records that are skipped."""
+    if molecule_ids is not None:
+        molecule_ids = set(molecule_ids)
+    with gzip.open(path, "rt") as inp:
+        for line in inp:
+            record = json.loads(line)
+            if molecule_ids is None or record["molecule_id"] in molecule_ids:
+                yield record
+
+
+def minimized_records(store):
+    """Yield the minimized MM torsion profile of each drive in the
+    ``TorsionStore`` ``store`` for each of its force fields."""
+    for force_field in store.get_force_fields():
+        for molecule_id in store.get_molecule_ids():
+            qm_energies = store.get_qm_energies_by_molecule_id(molecule_id)
+            points = store.get_mm_points_by_molecule_id(
+                molecule_id, force_field=force_field
+            )
+            energies = store.get_mm_energies_by_molecule_id(
+                molecule_id, force_field=force_field
+            )
+            yield dict(
+                force_field=force_field,
+                molecule_id=molecule_id,
+                mapped_smiles=store.get_smiles_by_molecule_id(molecule_id),
+                dihedral_indices=list(
+                    store.get_dihedral_indices_by_molecule_id(molecule_id)
+                ),
+                coordinates={
+                    str(angle): numpy.asarray(xyz).flatten().tolist()
+                    for angle, xyz in sorted(points.items())
+                },
+                energies={
+                    str(angle): float(energy)
+                    for angle, energy in sorted(energies.items())
+                },
+                qm_energies={
+                    str(angle): float(energy)
+                    for angle, energy in sorted(qm_energies.items())
+                },
+            )
+
+
+def metric_records(force_field, rmsds, eens):
+    """Yield the metrics of each drive for ``force_field`` from the
+    ``rmsds`` and ``eens`` DataFrames returned by ``TorsionStore.get_rmsd``
+    and ``TorsionStore.get_een``."""
+    eens = eens["een"]
+    for molecule_id, rmsd in rmsds["rmsd"].items():
+        yield dict(
+            force_field=force_field,
+            molecule_id=int(molecule_id),
+            rmsd=float(rmsd),
+            een=float(eens[molecule_id]),
+        )
+
+
+def make_csvs(store, forcefield, out_dir):
+    print("getting metrics and writing to CSVs")
+
+    print("getting rmsds")
+    rmsds = store.get_rmsd(forcefield, skip_check=True)
+    print("got rmsds, writing to CSV")
+    rmsds.to_csv(f"{out_dir}/rmsd.csv")
+
+    print("getting een")
+    eens = store.get_een(forcefield, skip_check=True)
+    print("got een, writing to CSV")
+    eens.to_csv(f"{out_dir}/een.csv")
+
+    return rmsds, eens
+
+
+def write_results(store, forcefield, out_dir):
+    """Write the minimized torsion profiles, metrics, and CSV files for
+    ``forcefield`` on ``store`` to ``out_dir``."""
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    print("writing minimized torsion profiles", flush=True)
+    n = write_records(f"{out_dir}/{MINIMIZED_FILE}", minimized_records(store))
+    print(f"wrote {n} minimized torsion profiles", flush=True)
+
+    rmsds, eens = make_csvs(store, forcefield, out_dir)
+    write_records(f"{out_dir}/{METRICS_FILE}", metric_records(forcefield, rmsds, eens))
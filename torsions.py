@@ -1,9 +1,11 @@
 # Usage:
-# python torsions.py path/to/config.yaml ncpus
+# python torsions.py [--cache-dir CACHE_DIR] [--resume] [--checkpoint-interval SEC] \
+#     [--shard i/N] [--max-tasks-per-worker N] [--max-worker-rss MIB] \
+#     [--memory-budget MIB] [--events PATH] path/to/config.yaml ncpus
 
+import argparse
 import logging
 import os
-import sys
 import time
 from pathlib import Path
 
@@ -12,66 +14,108 @@ if True:  # to prevent future reordering around this import
 
 from openff.toolkit.utils import OpenEyeToolkitWrapper
 from yammbs.torsion import TorsionStore
-from yammbs.torsion.inputs import QCArchiveTorsionDataset
 
 from config import Config
-
-logging.basicConfig(level=logging.DEBUG)
-
-
-assert OpenEyeToolkitWrapper().is_available()
-
-
-def make_csvs(store, forcefield, out_dir):
-    print("getting metrics and writing to CSVs")
-
-    print("getting rmsds")
-    rmsds = store.get_rmsd(forcefield, skip_check=True)
-    print("got rmsds, writing to CSV")
-    rmsds.to_csv(f"{out_dir}/rmsd.csv")
-
-    print("getting een")
-    eens = store.get_een(forcefield, skip_check=True)
-    print("got een, writing to CSV")
-    eens.to_csv(f"{out_dir}/een.csv")
-
-
-def _main(forcefield, dataset, sqlite_file, out_dir, procs, invalidate_cache):
-    if invalidate_cache and os.path.exists(sqlite_file):
-        os.remove(sqlite_file)
-    if os.path.exists(sqlite_file):
-        print(f"loading existing database from {sqlite_file}", flush=True)
+from ingest import stream_torsion_store
+from mempool import add_limit_arguments, limits_from_args
+from minimize import CHECKPOINT_INTERVAL, optimize_torsions
+from shard import fragment_path, parse_shard
+from store_cache import clone_store
+from telemetry import add_events_argument, configure, stage
+from torsion_outputs import write_results
+
+
+def build_store(dataset, sqlite_file):
+    """Ingest the ``QCArchiveTorsionDataset`` in ``dataset`` into a new
+    ``TorsionStore`` at ``sqlite_file``."""
+    print(f"loading YAMMBS input model dataset from {dataset}", flush=True)
+    stream_torsion_store(dataset, sqlite_file)
+
+
+def _main(
+    forcefield,
+    dataset,
+    sqlite_file,
+    out_dir,
+    procs,
+    invalidate_cache,
+    cache_dir=None,
+    checkpoint_interval=CHECKPOINT_INTERVAL,
+    shard=None,
+    limits=None,
+):
+    if shard is not None:
+        sqlite_file = str(fragment_path(sqlite_file, *shard))
+    with stage("stores"):
+        if invalidate_cache or not os.path.exists(sqlite_file):
+            clone_store(dataset, sqlite_file, build_store, "torsion", cache_dir)
+        else:
+            print(f"loading existing database from {sqlite_file}", flush=True)
         store = TorsionStore(sqlite_file)
-    else:
-        print(f"loading YAMMBS input model dataset from {dataset}", flush=True)
-        with open(dataset) as inp:
-            crc = QCArchiveTorsionDataset.model_validate_json(inp.read())
-        store = TorsionStore.from_torsion_dataset(crc, sqlite_file)
 
     print(f"num molecule IDs: {len(store.get_molecule_ids())}", flush=True)
     print(f"started optimizing store with {procs=}", flush=True)
     start = time.time()
-    store.optimize_mm(force_field=forcefield, n_processes=procs)
+    with stage("minimize_torsions"):
+        optimize_torsions(
+            store,
+            forcefield,
+            n_processes=procs,
+            checkpoint_interval=checkpoint_interval,
+            shard=shard,
+            cache_dir=cache_dir,
+            limits=limits,
+        )
     print(f"finished optimizing after {time.time() - start} sec")
 
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
+    if shard is not None:
+        print(f"finished shard {shard[0]}/{shard[1]}, wrote {sqlite_file}")
+        return
 
-    with open(f"{out_dir}/minimized.json", "w") as f:
-        f.write(store.get_outputs().model_dump_json())
-
-    with open(f"{out_dir}/metrics.json", "w") as f:
-        f.write(store.get_metrics().model_dump_json())
-
-    make_csvs(store, forcefield, out_dir)
+    with stage("write_results"):
+        write_results(store, forcefield, out_dir)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Not enough arguments")
-        exit(1)
+    logging.basicConfig(level=logging.DEBUG)
+
+    assert OpenEyeToolkitWrapper().is_available()
+
+    a = argparse.ArgumentParser(prog="python torsions.py")
+    a.add_argument("config", help="Path to the submission's input YAML file")
+    a.add_argument("nprocs", type=int, help="Number of processes to use")
+    a.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory holding pristine stores for each dataset. Defaults "
+        "to $YDS_CACHE_DIR or ~/.cache/yammbs-dataset-submission",
+    )
+    a.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue from an existing sqlite file, only minimizing the "
+        "torsion drives without results for the force field",
+    )
+    a.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=CHECKPOINT_INTERVAL,
+        help="Seconds between commits of minimization results to the "
+        "database. Defaults to %(default)d",
+    )
+    a.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Only minimize shard i of N, given as i/N, writing the results "
+        "to a separate sqlite fragment. Combine the fragments with merge.py",
+    )
+    add_limit_arguments(a)
+    add_events_argument(a)
+    args = a.parse_args()
+    configure(args.events)
 
-    conf = Config.from_file(sys.argv[1])
+    conf = Config.from_file(args.config)
 
     ndatasets = len(conf.datasets)
     if ndatasets == 0:
@@ -80,15 +124,22 @@ if __name__ == "__main__":
     if ndatasets > 1:
         print("Only single dataset currently supported")
         exit(1)
+    if len(conf.forcefields) > 1:
+        print("Only single force field currently supported")
+        exit(1)
 
-    p = Path(sys.argv[1])
+    p = Path(args.config)
     out_dir = p.parent / "output"
 
     _main(
-        forcefield=conf.forcefield,
+        forcefield=conf.forcefields[0],
         dataset=conf.datasets[0],
         sqlite_file="torsions-dev.sqlite",
         out_dir=out_dir,
-        procs=int(sys.argv[2]),
-        invalidate_cache=True,
+        procs=args.nprocs,
+        invalidate_cache=not args.resume,
+        cache_dir=args.cache_dir,
+        checkpoint_interval=args.checkpoint_interval,
+        shard=args.shard,
+        limits=limits_from_args(args),
     )